@@ -0,0 +1,542 @@
+# -----------------------------------------------------------------------------
+"""
+Emulator Benchmarks
+"""
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+import getopt
+import time
+import resource
+import tempfile
+import tracemalloc
+
+os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+
+import memory
+import z80gen
+import z80core
+import z80
+import z80pd
+import z80bt
+import z80idle
+import z80si
+import z80cond
+import z80sample
+import z80trace
+import z80tracefile
+import scheduler
+import jace
+
+# -----------------------------------------------------------------------------
+
+
+def load_core(name, **options):
+    """return a cpu core module generated with the given z80gen options (cached by z80core)"""
+    return z80core.load(name, **options)
+
+# -----------------------------------------------------------------------------
+
+
+def rss():
+    """return the maximum resident set size of this process in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# -----------------------------------------------------------------------------
+
+
+def bench_construct(n):
+    """time cpu construction and measure the memory used per instance"""
+    n = n or 10000
+    mem = memory.ram(16)
+    rss0 = rss()
+    t0 = time.perf_counter()
+    cpus = [z80.cpu(mem, None) for i in range(n)]
+    t1 = time.perf_counter()
+    rss1 = rss()
+    del cpus
+    tracemalloc.start()
+    cpus = [z80.cpu(mem, None) for i in range(n)]
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("instances     : %d" % len(cpus))
+    print("construction  : %.2f us/cpu" % (1e6 * (t1 - t0) / n))
+    print("heap          : %.0f bytes/cpu" % (float(heap) / n))
+    print("rss growth    : %.0f bytes/cpu" % (1024.0 * (rss1 - rss0) / n))
+
+
+# -----------------------------------------------------------------------------
+
+
+class null_io:
+    """io handler for benchmarks"""
+
+    def rd(self, adr):
+        return 0xFF
+
+    def wr(self, adr, val):
+        pass
+
+
+def time_handler(cpu, fn, args, n):
+    """return the time in ns for a call to an instruction handler"""
+    t0 = time.perf_counter_ns()
+    for i in range(n):
+        cpu.pc = 0x100
+        cpu.sp = 0x8000
+        fn(cpu, *args)
+    return (time.perf_counter_ns() - t0) / n
+
+
+def handler_name(fn):
+    """return the disassembled instruction for an instruction handler"""
+    label = fn.__name__[len("_ins_") :]
+    mem = memory.ram(4)
+    mem.load(0, [int(label[i : i + 2], 16) for i in range(0, len(label), 2)])
+    (operation, operands, nbytes) = z80gen.z80da.disassemble(mem, 0)
+    return " ".join((operation, operands))
+
+
+def bench_inline(n):
+    """time each instruction handler with and without helper inlining"""
+    n = n or 2000
+    cores = (load_core("z80_helpers", inlined=False), load_core("z80_inlined", inlined=True))
+    cpus = []
+    for core in cores:
+        mem = memory.ram(16)
+        mem.load(0x100, (0x12, 0x34, 0x56, 0x78))
+        cpus.append(core.cpu(mem, null_io()))
+    print("%-14s %-20s %8s %8s %6s" % ("table", "instruction", "helpers", "inlined", "ratio"))
+    total = [0, 0]
+    count = 0
+    for table in sorted([x for x in dir(cores[0].cpu) if x.startswith("opcodes")]):
+        seen = {}
+        for code, fn in enumerate(getattr(cores[0].cpu, table)):
+            if fn.__name__ in seen or not fn.__name__.startswith("_ins_"):
+                continue
+            seen[fn.__name__] = True
+            args = ((), (5,))[table.endswith("cb00")]
+            t = []
+            for cpu, core in zip(cpus, cores):
+                try:
+                    fn = getattr(core.cpu, table)[code]
+                    t.append(time_handler(cpu, fn, args, n))
+                except (core.Error, AssertionError):
+                    break
+            if len(t) != 2:
+                continue
+            total[0] += t[0]
+            total[1] += t[1]
+            count += 1
+            print("%-14s %-20s %8.0f %8.0f %6.2f" % (table, handler_name(fn), t[0], t[1], t[0] / t[1]))
+    print("%d handlers, mean %.0f ns with helpers, %.0f ns inlined, ratio %.2f" % (count, total[0] / count, total[1] / count, total[0] / total[1]))
+
+
+def bench_alu(n):
+    """time the 8 bit add/sub handlers with table and computed flags"""
+    n = n or 20000
+    cpu = z80.cpu(memory.ram(16), null_io())
+    cpu.h = cpu.l = 0
+    print("%-14s %8s %8s %6s" % ("instruction", "computed", "tables", "ratio"))
+    total = [0, 0]
+    codes = [x for x in range(0x80, 0xC0) if x < 0xA0 or x >= 0xB8] + [0xC6, 0xCE, 0xD6, 0xDE, 0xFE]
+    for code in codes:
+        text = z80gen.inline(z80gen.instruction_code([code]))
+        ns = {}
+        exec("def computed(self):\n%s" % "".join(["    %s\n" % l for l in text.splitlines()]), z80.__dict__, ns)
+        t = [time_handler(cpu, fn, (), n) for fn in (ns["computed"], z80.cpu.opcodes[code])]
+        total[0] += t[0]
+        total[1] += t[1]
+        print("%-14s %8.0f %8.0f %6.2f" % (handler_name(z80.cpu.opcodes[code]), t[0], t[1], t[0] / t[1]))
+    print("%d handlers, mean %.0f ns computed, %.0f ns tables, ratio %.2f" % (len(codes), total[0] / len(codes), total[1] / len(codes), total[0] / total[1]))
+
+
+# -----------------------------------------------------------------------------
+
+
+class ace:
+    """headless Jupiter ACE"""
+
+    def __init__(self, core=z80):
+        self.mem = jace.memmap()
+        self.keyboard = jace.keyboard()
+        self.io = jace.io()
+        self.io.keyboard = self.keyboard.rd
+        self.cpu = core.cpu(self.mem, self.io)
+        self.sched = scheduler.scheduler(self.cpu)
+        self.sched.add(jace._IRQ_CLKS, self.irq, jace._IRQ_CLKS)
+
+    def irq(self):
+        """frame interrupt"""
+        self.cpu.interrupt()
+
+    def frames(self, n):
+        """run n frames"""
+        self.sched.run(n * jace._IRQ_CLKS)
+
+    def key(self, c):
+        """press and release a key (for 100 ms each)"""
+        (port, bits) = self.keyboard.keys[ord(c)]
+        self.keyboard.ports[port] &= ~bits
+        self.frames(5)
+        self.keyboard.ports[port] |= bits
+        self.frames(5)
+
+    def type(self, s):
+        """type a string"""
+        for c in s:
+            self.key(c)
+
+    def screen(self):
+        """return the screen contents as a string"""
+        rows = []
+        for y in range(jace._ROWS):
+            row = [self.mem[jace._CHAR_ADR - 0x800 + (y * jace._COLS) + x] & 0x7F for x in range(jace._COLS)]
+            rows.append("".join([(".", chr(c))[32 <= c < 127] for c in row]))
+        return "\n".join(rows)
+
+    def workload(self):
+        """boot and list the forth dictionary"""
+        self.frames(25)
+        self.type("vlist\r")
+        self.frames(150)
+
+
+def bench_predecode(n):
+    """ace boot and forth workload with and without the predecode cache"""
+    t = []
+    for predecode in (False, True):
+        machine = ace()
+        if predecode:
+            z80pd.enable(machine.cpu)
+        t0 = time.perf_counter()
+        machine.workload()
+        t.append(time.perf_counter() - t0)
+        assert " OK" in machine.screen()
+    cache = machine.cpu.predecode
+    print("interpreted   : %.2f s" % t[0])
+    print("predecoded    : %.2f s" % t[1])
+    print("speedup       : %.2f" % (t[0] / t[1]))
+    print("lookups       : %d" % cache.lookups)
+    print("misses        : %d" % cache.misses)
+    print("hit rate      : %.4f" % cache.hit_rate())
+    print("handlers      : %d" % len(cache.handlers))
+
+
+def bench_translate(n):
+    """ace boot and forth workload: interpreted, predecoded and translated (best of n)"""
+    n = n or 3
+    t = [best_workload(z80, enable, n) for enable in (None, z80pd.enable, z80bt.enable)]
+    machine = ace()
+    cache = z80bt.enable(machine.cpu)
+    machine.workload()
+    print("interpreted   : %.2f s" % t[0])
+    print("predecoded    : %.2f s (%.2fx)" % (t[1], t[0] / t[1]))
+    print("translated    : %.2f s (%.2fx)" % (t[2], t[0] / t[2]))
+    print("blocks run    : %d" % cache.executed)
+    print("translations  : %d" % cache.translations)
+    print("invalidations : %d" % cache.invalidations)
+
+
+def best_workload(core, enable, n):
+    """return the best time for n runs of the ace workload"""
+    best = None
+    for i in range(n):
+        machine = ace(core)
+        if enable:
+            enable(machine.cpu)
+        t0 = time.perf_counter()
+        machine.workload()
+        t1 = time.perf_counter()
+        assert " OK" in machine.screen()
+        if best is None or t1 - t0 < best:
+            best = t1 - t0
+    return best
+
+
+def bench_lazy(n):
+    """ace workload and alu handlers with eager and lazy flag evaluation"""
+    n = n or 3
+    cores = (load_core("z80_eager"), load_core("z80_lazy", lazy=True))
+    for name, enable in (("interpreted", None), ("translated", z80bt.enable)):
+        t = [best_workload(core, enable, n) for core in cores]
+        print("%-13s : eager %.2f s, lazy %.2f s (%.2fx)" % (name, t[0], t[1], t[0] / t[1]))
+    for code in (0x80, 0xB8, 0x3C, 0xF5):
+        t = []
+        for core in cores:
+            cpu = core.cpu(memory.ram(16), null_io())
+            fn = core.cpu.opcodes[code]
+            t.append(time_handler(cpu, fn, (), 20000))
+        print("%-13s : eager %.0f ns, lazy %.0f ns" % (handler_name(fn), t[0], t[1]))
+
+
+def bench_profile(n):
+    """ace workload and a copy loop with the accurate and fast generator profiles"""
+    n = n or 3
+    cores = [load_core("z80_%s" % name, **z80gen.profiles[name]) for name in ("accurate", "fast")]
+    t = [best_workload(core, None, n) for core in cores]
+    print("%-13s : accurate %.2f s, fast %.2f s (%.2fx)" % ("ace workload", t[0], t[1], t[0] / t[1]))
+    # ld hl,0x4000; ld de,0x5000; ld bc,0x4000; loop: ldi; add a,(hl); rla; ex af,af'
+    # ld a,b; or c; jp z,done; ex af,af'; jp loop; done: halt
+    code = (0x21, 0x00, 0x40, 0x11, 0x00, 0x50, 0x01, 0x00, 0x40, 0xED, 0xA0, 0x86, 0x17, 0x08,
+            0x78, 0xB1, 0xCA, 0x17, 0x00, 0x08, 0xC3, 0x09, 0x00, 0x76)
+    t = []
+    for core in cores:
+        best = None
+        for i in range(n):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = core.cpu(mem, null_io())
+            t0 = time.perf_counter()
+            cpu.run(1 << 30)
+            t1 = time.perf_counter()
+            if best is None or t1 - t0 < best:
+                best = t1 - t0
+        t.append(best)
+    mips = [cpu.instructions / x / 1e6 for x in t]
+    print("%-13s : accurate %.2f MIPS, fast %.2f MIPS (%.2fx)" % ("copy loop", mips[0], mips[1], t[0] / t[1]))
+
+
+def bench_fused(n):
+    """ace workload with and without superinstructions, fused from its own sequence profile"""
+    n = n or 3
+    machine = ace()
+    rec = z80si.record(machine.cpu)
+    machine.workload()
+    rec.close()
+    fname = os.path.join(tempfile.mkdtemp(), "ace.seq")
+    rec.save(fname)
+    idle = lambda cpu: z80idle.enable(cpu, ports=True)
+    both = lambda cpu: (idle(cpu), z80si.enable(cpu))
+    for k in (8, 32):
+        core = load_core("z80_fused%d" % k, sequences=z80gen.read_profile(fname, k))
+        for name, enables in (("stepped", (None, z80si.enable)), ("idle", (idle, both))):
+            t = [best_workload(core, enable, n) for enable in enables]
+            print("%2d sequences, %-7s : plain %.2f s, fused %.2f s (%.2fx)" % (k, name, t[0], t[1], t[0] / t[1]))
+
+
+def bench_startup(n):
+    """cpu core startup: cold (generate and byte-compile) and warm (load from the cache)"""
+    n = n or 5
+    cache = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    z80core.load("z80", seq="roms/ace.seq", cache=cache)
+    t1 = time.perf_counter()
+    warm = []
+    check = []
+    for i in range(n):
+        t2 = time.perf_counter()
+        z80core.key({"n": z80gen._SEQUENCES}, "roms/ace.seq")
+        t3 = time.perf_counter()
+        z80core.load("z80", seq="roms/ace.seq", cache=cache)
+        t4 = time.perf_counter()
+        check.append(t3 - t2)
+        warm.append(t4 - t3)
+    print("cold          : %.3f s" % (t1 - t0))
+    print("warm          : %.1f ms" % (1e3 * min(warm)))
+    print("hash check    : %.1f ms" % (1e3 * min(check)))
+
+
+def stepped(cpu):
+    """make the cpu execute repeating block instructions one iteration at a time"""
+    cpu._repeat = lambda left: 0
+
+
+def bench_block(n):
+    """repeating block instructions: one iteration at a time and in bulk"""
+    n = n or 20
+    programs = (
+        ("ldir 16K", 0x4000, 0x0000, 0x4000, (0xED, 0xB0)),
+        ("lddr 16K", 0x7FFF, 0x3FFF, 0x4000, (0xED, 0xB8)),
+        ("ldir fill 16K", 0x4000, 0x4001, 0x3FFF, (0xED, 0xB0)),
+        ("cpir 16K", 0x4000, 0, 0x4000, (0xED, 0xB1)),
+        ("otir 256", 0x4000, 0, 0x0000, (0xED, 0xB3)),
+        ("inir 256", 0x4000, 0, 0x0000, (0xED, 0xB2)),
+    )
+    print("%-14s %10s %10s %8s" % ("program", "stepped", "bulk", "ratio"))
+    for (name, hl, de, bc, code) in programs:
+        t = []
+        for bulk in (False, True):
+            cpu = z80.cpu(memory.ram(16), null_io())
+            if not bulk:
+                stepped(cpu)
+            best = None
+            for i in range(n):
+                cpu.mem.load(0x8000, code + (0x76,))
+                cpu.reset()
+                cpu.pc = 0x8000
+                cpu.a = 0xAA
+                cpu._set_hl(hl)
+                cpu._set_de(de)
+                cpu._set_bc(bc)
+                t0 = time.perf_counter()
+                cpu.run(1 << 30)
+                t1 = time.perf_counter()
+                if best is None or t1 - t0 < best:
+                    best = t1 - t0
+            t.append(best)
+        print("%-14s %8.2f ms %8.2f ms %8.1f" % (name, 1e3 * t[0], 1e3 * t[1], t[0] / t[1]))
+    t = [best_workload(z80, enable, 3) for enable in (stepped, None)]
+    print("%-14s %8.2f s  %8.2f s  %8.2f" % ("ace workload", t[0], t[1], t[0] / t[1]))
+
+
+def bench_idle(n):
+    """ace boot and forth workload with and without idle loop skipping (best of n)"""
+    n = n or 3
+    enable = lambda cpu: z80idle.enable(cpu, ports=True)
+    t = [best_workload(z80, x, n) for x in (None, enable)]
+    machine = ace()
+    idle = enable(machine.cpu)
+    machine.workload()
+    print("stepped       : %.2f s" % t[0])
+    print("skipped       : %.2f s (%.2fx)" % (t[1], t[0] / t[1]))
+    print("loops skipped : %d" % idle.loops)
+    print("iterations    : %d" % idle.iterations)
+    print("clocks        : %d" % idle.skipped)
+
+
+# -----------------------------------------------------------------------------
+
+
+def bench_sample(n):
+    """ace workload with and without pc sampling (best of n)"""
+    n = n or 3
+    t = [None, None]
+    for i in range(n):
+        for on in (0, 1):
+            machine = ace()
+            sampler = z80sample.sampler(machine.cpu)
+            if on:
+                sampler.on()
+            sampler.start()
+            t0 = time.process_time()
+            machine.workload()
+            t1 = time.process_time()
+            sampler.off()
+            if t[on] is None or t1 - t0 < t[on]:
+                t[on] = t1 - t0
+    print("not sampled : %.2f s" % t[0])
+    print("sampled     : %.2f s (%+.1f%%)" % (t[1], 100.0 * (t[1] - t[0]) / t[0]))
+    print(sampler.report_routines(5))
+
+
+# -----------------------------------------------------------------------------
+
+
+def bench_condition(n):
+    """hot loop with a conditional breakpoint: condition evaluations per second"""
+    n = n or 3
+    # ld hl,0100; loop: inc a; jr loop
+    code = (0x21, 0x00, 0x01, 0x3C, 0x18, 0xFD)
+    expr = "b == 1 and mem[hl] > 3"
+    compiled = z80cond.condition(expr)
+    # evaluate the source text on each hit
+    parsed = lambda cpu, mem: eval(expr, {"__builtins__": {}}, {"b": cpu.b, "hl": (cpu.h << 8) | cpu.l, "mem": mem})
+    tstates = 2000000
+    for name, cond in (("no breakpoints", None), ("unconditional", None), ("compiled", compiled), ("source text", parsed)):
+        best = None
+        for i in range(n):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = z80.cpu(mem, None)
+            if name != "no breakpoints":
+                cpu.breaks = bytearray(0x10000)
+                # the unconditional breakpoint is never reached
+                cpu.breaks[(0xFFFF, 3)[cond is not None]] = 1
+                if cond is not None:
+                    cpu.conditions[3] = cond
+            t0 = time.perf_counter()
+            assert cpu.run(tstates)[1] == z80.STOP_BUDGET
+            t1 = time.perf_counter()
+            if best is None or t1 - t0 < best:
+                best = t1 - t0
+        # inc a; jr: 16 clock cycles per iteration, one evaluation
+        rate = "%.2f M evaluations/s" % (tstates / 16 / best / 1e6)
+        if cond is None:
+            rate = "%.2f M iterations/s" % (tstates / 16 / best / 1e6)
+        print("%-14s : %.3f s, %s" % (name, best, rate))
+
+
+# -----------------------------------------------------------------------------
+
+
+def bench_trace(n):
+    """ace workload: not traced, traced to the ring buffer, streamed to zlib and lzma trace files (best of n)"""
+    n = n or 3
+    t0 = best_workload(z80, None, n)
+    t1 = best_workload(z80, z80trace.enable, n)
+    print("not traced  : %.2f s" % t0)
+    print("traced      : %.2f s (x%.2f)" % (t1, t1 / t0))
+    fname = os.path.join(tempfile.mkdtemp(), "ace.trc")
+    for method in ("zlib", "lzma"):
+        writers = []
+        t = best_workload(z80, lambda cpu: writers.append(z80tracefile.writer(cpu, fname, method=method)), n)
+        t2 = time.perf_counter()
+        writers[-1].close()
+        t3 = time.perf_counter()
+        r = z80tracefile.reader(fname)
+        t4 = time.perf_counter()
+        hits = len(list(r.hits(r[len(r) // 2][1])))
+        t5 = time.perf_counter()
+        x = r[len(r) // 3]
+        t6 = time.perf_counter()
+        print("%-11s : %.2f s (x%.2f), %.3f s to close" % (method, t, t / t0, t3 - t2))
+        print("  %d instructions, %.2f bytes per instruction, %d chunks" % (len(r), os.path.getsize(fname) / len(r), len(r.chunks)))
+        print("  open %.3f s, pc search %.3f s (%d hits), state at an instruction %.4f s" % (t4 - t3, t5 - t4, hits, t6 - t5))
+        r.close()
+    os.remove(fname)
+    os.rmdir(os.path.dirname(fname))
+
+
+# -----------------------------------------------------------------------------
+
+_benchmarks = {
+    "alu": bench_alu,
+    "block": bench_block,
+    "condition": bench_condition,
+    "construct": bench_construct,
+    "fused": bench_fused,
+    "idle": bench_idle,
+    "inline": bench_inline,
+    "lazy": bench_lazy,
+    "profile": bench_profile,
+    "sample": bench_sample,
+    "startup": bench_startup,
+    "trace": bench_trace,
+    "predecode": bench_predecode,
+    "translate": bench_translate,
+}
+
+
+def usage():
+    print("usage:")
+    print("%s [-n COUNT] BENCHMARK" % sys.argv[0])
+    print("benchmarks: %s" % " ".join(sorted(_benchmarks)))
+    sys.exit(2)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main():
+    n = 0
+    try:
+        optlist, arglist = getopt.gnu_getopt(sys.argv[1:], "n:")
+    except getopt.GetoptError:
+        usage()
+    for opt in optlist:
+        if opt[0] == "-n":
+            n = int(opt[1])
+    if len(arglist) != 1 or arglist[0] not in _benchmarks:
+        usage()
+    _benchmarks[arglist[0]](n)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+# -----------------------------------------------------------------------------
@@ -7,6 +7,9 @@ Jupiter ACE Emulator
 import memory
 import z80da
 import z80
+import z80idle
+import z80si
+import scheduler
 import monitor
 import util
 import pygame
@@ -32,6 +35,16 @@ _border_y = 20
 
 _scale = 2
 
+# cpu clock rate and frame rate
+_CPU_CLK = 3250000
+_FRAME_RATE = 50
+
+# cpu clocks between frame interrupts
+_IRQ_CLKS = _CPU_CLK // _FRAME_RATE
+
+_help_idle = (("[on|off]", "skip idle loops - default is to show the counters"),)
+_help_turbo = (("[on|off]", "run unthrottled - default is to show the emulation speed"),)
+
 _keyboard_h = 242
 _keyboard_y = (_scale * _PIXELS_V) + (2 * _border_y)
 
@@ -214,7 +227,7 @@ class keyboard:
 # -----------------------------------------------------------------------------
 
 
-class memmap:
+class memmap(memory.memmap):
     """memory devices and address map"""
 
     def __init__(self, romfile="./roms/ace.rom"):
@@ -224,53 +237,44 @@ class memmap:
         self.char = memory.wom(10)
         self.ram = memory.ram(10)
         self.empty = memory.null()
-
-    def select(self, adr):
-        """return the memory object selected by this address"""
         # select with 2k granularity
-        memmap = (
-            self.rom,  # 0x0000 - 0x07ff
-            self.rom,  # 0x0800 - 0x0fff
-            self.rom,  # 0x1000 - 0x17ff
-            self.rom,  # 0x1800 - 0x1fff
-            self.video,  # 0x2000 - 0x27ff - 1K repeats 2 times
-            self.char,  # 0x2800 - 0x2fff - 1K repeats 2 times
-            self.ram,  # 0x3000 - 0x37ff - 1K repeats 4 times
-            self.ram,  # 0x3800 - 0x3fff
-            self.empty,  # 0x4000
-            self.empty,  # 0x4800
-            self.empty,  # 0x5000
-            self.empty,  # 0x5800
-            self.empty,  # 0x6000
-            self.empty,  # 0x6800
-            self.empty,  # 0x7000
-            self.empty,  # 0x7800
-            self.empty,  # 0x8000
-            self.empty,  # 0x8800
-            self.empty,  # 0x9000
-            self.empty,  # 0x9800
-            self.empty,  # 0xa000
-            self.empty,  # 0xa800
-            self.empty,  # 0xb000
-            self.empty,  # 0xb800
-            self.empty,  # 0xc000
-            self.empty,  # 0xc800
-            self.empty,  # 0xd000
-            self.empty,  # 0xd800
-            self.empty,  # 0xe000
-            self.empty,  # 0xe800
-            self.empty,  # 0xf000
-            self.empty,  # 0xf800
+        memory.memmap.__init__(
+            self,
+            (
+                self.rom,  # 0x0000 - 0x07ff
+                self.rom,  # 0x0800 - 0x0fff
+                self.rom,  # 0x1000 - 0x17ff
+                self.rom,  # 0x1800 - 0x1fff
+                self.video,  # 0x2000 - 0x27ff - 1K repeats 2 times
+                self.char,  # 0x2800 - 0x2fff - 1K repeats 2 times
+                self.ram,  # 0x3000 - 0x37ff - 1K repeats 4 times
+                self.ram,  # 0x3800 - 0x3fff
+                self.empty,  # 0x4000
+                self.empty,  # 0x4800
+                self.empty,  # 0x5000
+                self.empty,  # 0x5800
+                self.empty,  # 0x6000
+                self.empty,  # 0x6800
+                self.empty,  # 0x7000
+                self.empty,  # 0x7800
+                self.empty,  # 0x8000
+                self.empty,  # 0x8800
+                self.empty,  # 0x9000
+                self.empty,  # 0x9800
+                self.empty,  # 0xa000
+                self.empty,  # 0xa800
+                self.empty,  # 0xb000
+                self.empty,  # 0xb800
+                self.empty,  # 0xc000
+                self.empty,  # 0xc800
+                self.empty,  # 0xd000
+                self.empty,  # 0xd800
+                self.empty,  # 0xe000
+                self.empty,  # 0xe800
+                self.empty,  # 0xf000
+                self.empty,  # 0xf800
+            ),
         )
-        return memmap[adr >> 11]
-
-    def __getitem__(self, adr):
-        adr &= 0xFFFF
-        return self.select(adr)[adr]
-
-    def __setitem__(self, adr, val):
-        adr &= 0xFFFF
-        self.select(adr)[adr] = val
 
 
 # -----------------------------------------------------------------------------
@@ -297,24 +301,32 @@ class io:
 
 class jace:
 
-    def __init__(self, app):
+    def __init__(self, app, core=z80):
         self.app = app
         self.video = video()
         self.keyboard = keyboard()
         self.mem = memmap()
         self.io = io()
-        self.cpu = z80.cpu(self.mem, self.io)
+        self.cpu = core.cpu(self.mem, self.io)
         self.mon = monitor.monitor(self.cpu)
         self.menu_root = (
             ("..", "return to main menu", util.cr, self.parent_menu, None),
             ("char", "display the character memory", util.cr, self.cli_char, None),
+            ("break", "breakpoints", None, None, self.mon.menu_break),
+            ("calls", "call graph profiler", monitor._help_calls, self.mon.cli_calls, None),
             ("da", "disassemble memory", monitor._help_disassemble, self.mon.cli_disassemble, None),
             ("exit", "exit the application", util.cr, self.exit, None),
             ("help", "display general help", util.cr, app.general_help, None),
+            ("idle", "idle loop skipping", _help_idle, self.cli_idle, None),
             ("memory", "memory functions", None, None, self.mon.menu_memory),
+            ("profile", "opcode profiler", monitor._help_profile, self.mon.cli_profile, None),
             ("regs", "display cpu registers", util.cr, self.mon.cli_registers, None),
             ("run", "run the emulation", util.cr, self.cli_run, None),
+            ("sample", "pc sampling profiler", monitor._help_sample, self.mon.cli_sample, None),
             ("step", "single step the emulation", util.cr, self.cli_step, None),
+            ("trace", "execution trace", monitor._help_trace, self.mon.cli_trace, None),
+            ("turbo", "real-time or unthrottled emulation", _help_turbo, self.cli_turbo, None),
+            ("watch", "memory watchpoints", None, None, self.mon.menu_watch),
         )
 
         # create the hooks between video and memory
@@ -326,6 +338,19 @@ class jace:
         # create the hooks between io and keyboard
         self.io.keyboard = self.keyboard.rd
 
+        # the keyboard ports only change between frames: polling loops can be skipped
+        z80idle.enable(self.cpu, ports=True)
+        # the cpu core has superinstructions for the sequences the ace rom runs most
+        z80si.enable(self.cpu)
+
+        # frame events: interrupt, video refresh and input polling
+        self.sched = scheduler.scheduler(self.cpu)
+        self.sched.add(_IRQ_CLKS, self.irq, _IRQ_CLKS)
+        self.sched.add(_IRQ_CLKS, self.refresh, _IRQ_CLKS)
+        self.sched.add(_IRQ_CLKS, self.poll, _IRQ_CLKS)
+        # run at the real cpu clock rate, checked once per frame
+        self.pacer = scheduler.pacer(self.sched, _CPU_CLK, _IRQ_CLKS, report=self.speed)
+
         # setup the video window
         pygame.init()
         self.screen = pygame.display.set_mode((_screen_x, _screen_y))
@@ -342,32 +367,83 @@ class jace:
         for i in range(0x400):
             md.write(self.mem.char.rd(i))
 
+    def irq(self):
+        """frame interrupt event"""
+        # look up the method on each call: a profiler may replace it
+        self.cpu.interrupt()
+
+    def refresh(self):
+        """video refresh event"""
+        self.video.update(self.screen)
+
+    def poll(self):
+        """input polling event"""
+        self.keyboard.get()
+        if self.app.io.anykey():
+            self.sched.stop()
+
+    def speed(self, pacer):
+        """emulation speed report"""
+        pygame.display.set_caption("Jupiter ACE - %s" % pacer)
+
     def cli_run(self, app, args):
         """run the emulation"""
         app.put("\n\npress any key to halt\n")
-        cpu_clks = 0
-        video_clks = 0
-        irq = False
-        while True:
-            if app.io.anykey():
+        stop = self.mon.resume()
+        if stop is None:
+            self.pacer.sync()
+            self.mon.sampler.start()
+            try:
+                stop = self.sched.run()
+            finally:
+                self.mon.sampler.stop()
+        if stop == z80.STOP_ERROR:
+            app.put("exception: %s\n" % self.cpu.error)
+        elif stop == z80.STOP_BREAK:
+            app.put("breakpoint: %s\n" % self.current_instruction())
+            if self.cpu.cond_error is not None:
+                app.put("bad condition: %s\n" % self.mon.bad_condition())
+        elif stop == z80.STOP_WATCH:
+            app.put("watchpoint:\n%s\n" % self.mon.watch_hits())
+        if stop in (z80.STOP_ERROR, z80.STOP_BREAK, z80.STOP_WATCH) or self.cpu.halt:
+            self.mon.post_mortem(app)
+
+    def cli_idle(self, app, args):
+        """idle loop skipping"""
+        if util.wrong_argc(app, args, (0, 1)):
+            return
+        if len(args) == 1:
+            if args[0] not in ("on", "off"):
+                app.put(util.inv_arg)
                 return
             try:
-                pc = self.cpu._get_pc()
-                if (cpu_clks > 5000) or irq:
-                    cpu_clks = self.cpu.interrupt()
-                    irq = False
+                if args[0] == "on":
+                    z80idle.enable(self.cpu, ports=True)
                 else:
-                    cpu_clks += self.cpu.execute()
-            except z80.Error as e:
-                self.cpu._set_pc(pc)
-                app.put("exception: %s\n" % e)
+                    z80idle.disable(self.cpu)
+            except ValueError as e:
+                app.put("\n\n%s\n" % e)
+                return
+        idle = self.cpu.idle
+        if idle is None:
+            app.put("\n\nidle loop skipping is off\n")
+            return
+        s = []
+        s.append("loops skipped : %d" % idle.loops)
+        s.append("iterations    : %d" % idle.iterations)
+        s.append("clocks        : %d" % idle.skipped)
+        app.put("\n\n%s\n" % "\n".join(s))
+
+    def cli_turbo(self, app, args):
+        """real-time or unthrottled emulation"""
+        if util.wrong_argc(app, args, (0, 1)):
+            return
+        if len(args) == 1:
+            if args[0] not in ("on", "off"):
+                app.put(util.inv_arg)
                 return
-            if video_clks == 500:
-                self.video.update(self.screen)
-                video_clks = 0
-            else:
-                video_clks += 1
-            irq = self.keyboard.get()
+            self.pacer.set_turbo(args[0] == "on")
+        app.put("\n\nturbo %s, last run: %s\n" % (("off", "on")[self.pacer.turbo], self.pacer))
 
     def current_instruction(self):
         """return a string for the current instruction"""
@@ -10,11 +10,21 @@ import cli
 import util
 import jace
 import tec1
+import z80
+import z80fast
 
 # -----------------------------------------------------------------------------
 
 _version_str = "PyZ80: Python Z80 Platform Emulator 0.1"
 
+# cpu cores: generated with the z80gen profiles
+_cores = {
+    "accurate": z80,
+    "fast": z80fast,
+}
+
+_help_core = (("[accurate|fast]", "cpu core profile - default is accurate"),)
+
 # -----------------------------------------------------------------------------
 
 
@@ -22,8 +32,8 @@ class application:
 
     def __init__(self):
         self.menu_targets = (
-            ("jace", "Jupiter Ace", util.cr, self.target_jace, None),
-            ("tec1", "Talking Electronics TEC-1", util.cr, self.target_tec1, None),
+            ("jace", "Jupiter Ace", _help_core, self.target_jace, None),
+            ("tec1", "Talking Electronics TEC-1", _help_core, self.target_tec1, None),
         )
         self.menu_root = (
             ("exit", "exit the application", util.cr, self.exit, None),
@@ -59,13 +69,28 @@ class application:
         """display a version string"""
         app.put("\n\n%s\n" % _version_str)
 
+    def core_arg(self, app, args):
+        """return the cpu core selected by the arguments - or None"""
+        if util.wrong_argc(app, args, (0, 1)):
+            return None
+        if len(args) == 1 and args[0] not in _cores:
+            app.put(util.inv_arg)
+            return None
+        return _cores[(args or ["accurate"])[0]]
+
     def target_jace(self, app, args):
+        core = self.core_arg(app, args)
+        if core is None:
+            return
         app.put('\n\nemulating "Jupiter ACE"\n')
-        jace.jace(app)
+        jace.jace(app, core)
 
     def target_tec1(self, app, args):
+        core = self.core_arg(app, args)
+        if core is None:
+            return
         app.put('\n\nemulating "Talking Electronics TEC 1"\n')
-        tec1.tec1(app)
+        tec1.tec1(app, core)
 
     def general_help(self, app, args):
         app.cli.func_help(util.general)
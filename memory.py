@@ -35,6 +35,23 @@ class memory:
     def __setitem__(self, adr, val):
         pass
 
+    def window(self, adr, write=False):
+        """
+        Return (array, lo, hi, delta) if addresses lo <= a < hi (around adr) can
+        be read (or written) directly as array[a - delta], or None if accesses
+        must go through __getitem__/__setitem__.
+        """
+        return None
+
+    def _window(self, adr):
+        """direct access window for the device location at adr"""
+        lo = adr & ~self.mask
+        return (self.mem, lo, min(lo + self.mask + 1, 0x10000), lo)
+
+    def peek(self, adr):
+        """read the memory location at adr without any watchpoint or hook side effects"""
+        return self[adr]
+
     def load(self, adr, data):
         """load bytes into memory starting at a given address"""
         for i, val in enumerate(data):
@@ -61,6 +78,11 @@ class ram(memory):
             self.wr_notify(adr)
         self.mem[adr & self.mask] = val
 
+    def window(self, adr, write=False):
+        if write and self.wr_notify != self.null:
+            return None
+        return self._window(adr)
+
 
 class rom(memory):
     """Read Only Memory"""
@@ -68,6 +90,11 @@ class rom(memory):
     def __getitem__(self, adr):
         return self.mem[adr & self.mask]
 
+    def window(self, adr, write=False):
+        if write:
+            return None
+        return self._window(adr)
+
 
 class wom(memory):
     """Write Only Memory"""
@@ -88,4 +115,164 @@ class null(memory):
     pass
 
 
+# -----------------------------------------------------------------------------
+# Address Maps
+
+_PAGE_BITS = 11
+_PAGE_SIZE = 1 << _PAGE_BITS
+
+# watchpoint access flags
+WATCH_RD = 1
+WATCH_WR = 2
+
+
+class wr_hook:
+    """Forward writes to a memory device and then call hook functions"""
+
+    def __init__(self, dev, hooks):
+        self.dev = dev
+        self.hooks = hooks
+
+    def __getitem__(self, adr):
+        return self.dev[adr]
+
+    def __setitem__(self, adr, val):
+        self.dev[adr] = val
+        for hook in self.hooks:
+            hook(adr)
+
+    def window(self, adr, write=False):
+        if write:
+            return None
+        return self.dev.window(adr)
+
+
+class watch_hook:
+    """Forward accesses to a memory device and report the accesses to watched addresses"""
+
+    def __init__(self, dev, watches, fn):
+        """watches: 64K of access flags, fn(access, adr, old value, new value): called for each watched access"""
+        self.dev = dev
+        self.watches = watches
+        self.fn = fn
+
+    def __getitem__(self, adr):
+        val = self.dev[adr]
+        if self.watches[adr] & WATCH_RD:
+            self.fn(WATCH_RD, adr, val, val)
+        return val
+
+    def __setitem__(self, adr, val):
+        if self.watches[adr] & WATCH_WR:
+            old = self.dev[adr]
+            self.dev[adr] = val
+            self.fn(WATCH_WR, adr, old, val)
+        else:
+            self.dev[adr] = val
+
+    def window(self, adr, write=False):
+        # no direct access: every access is checked
+        return None
+
+
+class memmap:
+    """64K address space mapped onto memory devices with 2K granularity"""
+
+    def __init__(self, pages):
+        """pages is a sequence of 32 memory devices - one per 2K page"""
+        self.pages = tuple(pages)
+        self.wr_hooks = []
+        # watchpoint access flags for each address and the function called on a hit
+        self.watches = None
+        self.watch_fn = None
+        self.rd_pages = list(self.pages)
+        self.wr_pages = list(self.pages)
+
+    def select(self, adr):
+        """return the memory object selected by this address"""
+        return self.pages[(adr & 0xFFFF) >> _PAGE_BITS]
+
+    def __getitem__(self, adr):
+        adr &= 0xFFFF
+        return self.rd_pages[adr >> _PAGE_BITS][adr]
+
+    def __setitem__(self, adr, val):
+        adr &= 0xFFFF
+        self.wr_pages[adr >> _PAGE_BITS][adr] = val
+
+    def peek(self, adr):
+        """read from the memory device at adr, bypassing any watchpoint or hook"""
+        adr &= 0xFFFF
+        return self.pages[adr >> _PAGE_BITS][adr]
+
+    def window(self, adr, write=False):
+        """direct access window for adr, limited to its page"""
+        adr &= 0xFFFF
+        page = adr >> _PAGE_BITS
+        w = (self.rd_pages, self.wr_pages)[write][page].window(adr, write)
+        if w is None:
+            return None
+        (mem, lo, hi, delta) = w
+        return (mem, max(lo, page << _PAGE_BITS), min(hi, (page + 1) << _PAGE_BITS), delta)
+
+    def remap(self):
+        """rebuild the page tables - ram writes go through any hooks, watched pages through a watch"""
+        for i, dev in enumerate(self.pages):
+            rd = dev
+            wr = dev
+            if self.wr_hooks and isinstance(dev, ram):
+                wr = wr_hook(dev, tuple(self.wr_hooks))
+            if self.watches is not None and any(self.watches[i << _PAGE_BITS : (i + 1) << _PAGE_BITS]):
+                # the page has watched addresses: only these pages pay for the checks
+                rd = watch_hook(rd, self.watches, self.watch_fn)
+                wr = watch_hook(wr, self.watches, self.watch_fn)
+            self.rd_pages[i] = rd
+            self.wr_pages[i] = wr
+
+    def add_wr_hook(self, hook):
+        """call hook(adr) after every write to ram"""
+        self.wr_hooks.append(hook)
+        self.remap()
+
+    def remove_wr_hook(self, hook):
+        """remove a ram write hook"""
+        self.wr_hooks.remove(hook)
+        self.remap()
+
+    def watch(self, ranges, fn):
+        """
+        Set the watchpoints and call fn(access, adr, old value, new value) for each watched access.
+        ranges: list of (lo, hi, access) - addresses lo..hi (inclusive), access is WATCH_RD and/or WATCH_WR
+        The aliases of a watched address (other addresses of the same device location) are also watched,
+        except in unpopulated memory.
+        """
+        self.watches = None
+        self.watch_fn = None
+        if ranges:
+            self.watches = bytearray(0x10000)
+            self.watch_fn = fn
+            for lo, hi, access in ranges:
+                for adr in range(lo, hi + 1):
+                    aliases = (adr,)
+                    if self.select(adr).mask:
+                        aliases = self.aliases(adr)
+                    for x in aliases:
+                        self.watches[x] |= access
+        self.remap()
+
+    def aliases(self, adr):
+        """return the addresses that access the same device location as adr"""
+        adr &= 0xFFFF
+        dev = self.select(adr)
+        step = min(dev.mask + 1, _PAGE_SIZE)
+        offset = adr & (step - 1)
+        x = []
+        for i, page in enumerate(self.pages):
+            if page is dev:
+                for base in range(i << _PAGE_BITS, (i + 1) << _PAGE_BITS, step):
+                    if ((base + offset) & dev.mask) == (adr & dev.mask):
+                        x.append(base + offset)
+        return tuple(x)
+
+
 # -----------------------------------------------------------------------------
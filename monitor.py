@@ -5,6 +5,14 @@ Generic 8-bit/64K Memory Machine Language Monitor
 # -----------------------------------------------------------------------------
 
 import util
+import memory
+import z80
+import z80cg
+import z80cond
+import z80prof
+import z80sample
+import z80trace
+import z80tracefile
 
 # -----------------------------------------------------------------------------
 # help for cli leaf functions
@@ -38,6 +46,48 @@ _help_disassemble = (
     ("", "length (hex) - default is 0x10"),
 )
 
+_help_break_add = (
+    ("<adr> [if <expr>]", "address (hex)"),
+    ("", "stop only if the condition is true - Eg. a == 0x20 and mem[hl] > 3"),
+)
+
+_help_break_del = (("<adr>", "address (hex)"),)
+
+_help_watch_add = (
+    ("<adr> [len] [r|w|rw]", "address (hex)"),
+    ("", "length (hex) - default is 1"),
+    ("", "stop on reads, writes or both - default is w"),
+)
+
+_help_watch_del = (("<adr>", "start address (hex)"),)
+
+# watchpoint access argument
+_access = {"r": memory.WATCH_RD, "w": memory.WATCH_WR, "rw": memory.WATCH_RD | memory.WATCH_WR}
+
+_help_profile = (
+    ("[on|off|clear]", "start/stop the opcode profiler, clear the statistics"),
+    ("[report] [n]", "show the n instructions with the most host time - default"),
+    ("save <file>", "save the statistics - csv, or json for a .json file"),
+)
+
+_help_calls = (
+    ("[on|off|clear]", "start/stop the call graph profiler, clear the statistics"),
+    ("[report] [n]", "show the n routines with the most inclusive clocks - default"),
+    ("save <file>", "save the collapsed call stacks (flame graph input)"),
+)
+
+_help_trace = (
+    ("[on [n]|off|clear]", "start/stop tracing the last n instructions (default 4096)"),
+    ("[show] [k]", "show the last k instructions - default"),
+    ("file <filename>", "stream the trace to a compressed trace file (until trace off)"),
+)
+
+_help_sample = (
+    ("[on|off|clear]", "start/stop pc sampling during run, clear the samples"),
+    ("[report] [n]", "show the n most sampled addresses - default"),
+    ("routines [n]", "show the n most sampled routines"),
+)
+
 # -----------------------------------------------------------------------------
 
 
@@ -45,6 +95,13 @@ class monitor:
 
     def __init__(self, cpu):
         self.cpu = cpu
+        self.profiler = z80prof.profiler(cpu)
+        self.sampler = z80sample.sampler(cpu)
+        self.calls = z80cg.profiler(cpu)
+        # breakpoint bitmap, breakpoint conditions: address -> expression, watchpoints: (lo, hi, access)
+        self.breaks = bytearray(0x10000)
+        self.conditions = {}
+        self.watches = []
         self.menu_memory = (
             ("display", "dump memory to display", _help_memdisplay, self.cli_mem2display, None),
             (">file", "read from memory, write to file", _help_mem2file, self.cli_mem2file, None),
@@ -55,6 +112,16 @@ class monitor:
             ("wr08", "write 8 bits", _help_memwr, self.cli_wr08, None),
             ("wr16", "write 16 bits", _help_memwr, self.cli_wr16, None),
         )
+        self.menu_break = (
+            ("add", "add a breakpoint", _help_break_add, self.cli_break_add, None),
+            ("del", "delete a breakpoint", _help_break_del, self.cli_break_del, None),
+            ("list", "list the breakpoints", util.cr, self.cli_break_list, None),
+        )
+        self.menu_watch = (
+            ("add", "add a watchpoint", _help_watch_add, self.cli_watch_add, None),
+            ("del", "delete a watchpoint", _help_watch_del, self.cli_watch_del, None),
+            ("list", "list the watchpoints", util.cr, self.cli_watch_list, None),
+        )
 
     def mem2display(self, app, adr, length):
         """dump memory contents to the display"""
@@ -66,6 +133,185 @@ class monitor:
         for i in range(length):
             md.write(self.cpu.mem[adr + i])
 
+    def arm(self):
+        """use the checking run loop while there are breakpoints or watchpoints"""
+        cpu = self.cpu
+        cpu.watched = (None, [])[len(self.watches) > 0]
+        cpu.breaks = None
+        if self.watches or self.breaks.find(1) >= 0:
+            cpu.breaks = self.breaks
+
+    def breakpoints(self):
+        """return the list of breakpoint addresses"""
+        adrs = []
+        adr = self.breaks.find(1)
+        while adr >= 0:
+            adrs.append(adr)
+            adr = self.breaks.find(1, adr + 1)
+        return adrs
+
+    def break_add(self, adr, expr=None):
+        """add a breakpoint, with a condition expression (raises ValueError for a bad expression)"""
+        # a bad expression leaves the breakpoints as they are
+        cond = None
+        if expr is not None:
+            cond = z80cond.condition(expr)
+        self.cpu.conditions.pop(adr, None)
+        self.conditions.pop(adr, None)
+        if cond is not None:
+            self.cpu.conditions[adr] = cond
+            self.conditions[adr] = expr
+        self.breaks[adr] = 1
+        self.arm()
+
+    def break_del(self, adr):
+        """delete a breakpoint"""
+        self.breaks[adr] = 0
+        self.cpu.conditions.pop(adr, None)
+        self.conditions.pop(adr, None)
+        self.arm()
+
+    def watch_add(self, lo, hi, access):
+        """add a watchpoint for lo..hi (inclusive)"""
+        self.watches.append((lo, hi, access))
+        self.cpu.mem.watch(self.watches, self.cpu.watch)
+        self.arm()
+
+    def watch_del(self, lo):
+        """delete the watchpoints starting at lo"""
+        self.watches = [x for x in self.watches if x[0] != lo]
+        self.cpu.mem.watch(self.watches, self.cpu.watch)
+        self.arm()
+
+    def resume(self):
+        """
+        Prepare the cpu for a run: execute the instruction at a breakpoint, so the run continues past it.
+        Return STOP_WATCH if the instruction hit a watchpoint or STOP_ERROR if it is not implemented
+        (the run shouldn't start), else None.
+        """
+        cpu = self.cpu
+        if cpu.watched is not None:
+            cpu.watched = []
+        if cpu.breaks is not None and cpu.breaks[cpu.pc]:
+            # run the instruction through the run loop (so it is traced) with its breakpoint masked
+            pc = cpu.pc
+            cpu.breaks[pc] = 0
+            try:
+                stop = cpu.run(1)[1]
+            finally:
+                cpu.breaks[pc] = 1
+            if stop in (z80.STOP_WATCH, z80.STOP_ERROR):
+                return stop
+        return None
+
+    def bad_condition(self):
+        """return a report of the exception raised by the condition of the breakpoint at the pc"""
+        cpu = self.cpu
+        e = cpu.cond_error
+        return "%s (%s: %s)" % (self.conditions.get(cpu.pc, "?"), type(e).__name__, e)
+
+    def watch_hits(self):
+        """return a report of the watchpoint hits of the last run"""
+        s = []
+        for pc, access, adr, old, new in self.cpu.watched:
+            (operation, operands, n) = self.cpu.da(pc)
+            if access == memory.WATCH_RD:
+                hit = "read  %04x: %02x" % (adr, old)
+            else:
+                hit = "write %04x: %02x -> %02x" % (adr, old, new)
+            s.append("%04x %-5s %-12s %s" % (pc, operation, operands, hit))
+        return "\n".join(s)
+
+    def cli_break_add(self, app, args):
+        """add a breakpoint"""
+        if len(args) in (0, 2):
+            app.put(util.bad_argc)
+            return
+        if len(args) > 2 and args[1] != "if":
+            app.put(util.inv_arg)
+            return
+        adr = util.int_arg(app, args[0], (0, 0xFFFF), 16)
+        if adr == None:
+            return
+        expr = None
+        if len(args) > 2:
+            expr = " ".join(args[2:])
+        try:
+            self.break_add(adr, expr)
+        except ValueError as e:
+            app.put("\n\nbad condition: %s\n" % e)
+
+    def cli_break_del(self, app, args):
+        """delete a breakpoint"""
+        if util.wrong_argc(app, args, (1,)):
+            return
+        adr = util.int_arg(app, args[0], (0, 0xFFFF), 16)
+        if adr == None:
+            return
+        if adr not in self.breakpoints():
+            app.put("\n\nno breakpoint at %04x\n" % adr)
+            return
+        self.break_del(adr)
+
+    def cli_break_list(self, app, args):
+        """list the breakpoints"""
+        adrs = self.breakpoints()
+        if not adrs:
+            app.put("\n\nno breakpoints\n")
+            return
+        s = []
+        for adr in adrs:
+            (operation, operands, n) = self.cpu.da(adr)
+            cond = ""
+            if adr in self.conditions:
+                cond = "if %s" % self.conditions[adr]
+            s.append("%04x %-5s %-12s %s" % (adr, operation, operands, cond))
+        app.put("\n\n%s\n" % "\n".join(s))
+
+    def cli_watch_add(self, app, args):
+        """add a watchpoint"""
+        if util.wrong_argc(app, args, (1, 2, 3)):
+            return
+        if not isinstance(self.cpu.mem, memory.memmap):
+            app.put("\n\nno watchpoints for this memory\n")
+            return
+        adr = util.int_arg(app, args[0], (0, 0xFFFF), 16)
+        if adr == None:
+            return
+        length = 1
+        if len(args) >= 2:
+            length = util.int_arg(app, args[1], (1, 0x10000 - adr), 16)
+            if length == None:
+                return
+        access = memory.WATCH_WR
+        if len(args) == 3:
+            if args[2] not in _access:
+                app.put(util.inv_arg)
+                return
+            access = _access[args[2]]
+        self.watch_add(adr, adr + length - 1, access)
+
+    def cli_watch_del(self, app, args):
+        """delete a watchpoint"""
+        if util.wrong_argc(app, args, (1,)):
+            return
+        adr = util.int_arg(app, args[0], (0, 0xFFFF), 16)
+        if adr == None:
+            return
+        if adr not in [x[0] for x in self.watches]:
+            app.put("\n\nno watchpoint at %04x\n" % adr)
+            return
+        self.watch_del(adr)
+
+    def cli_watch_list(self, app, args):
+        """list the watchpoints"""
+        if not self.watches:
+            app.put("\n\nno watchpoints\n")
+            return
+        names = dict([(v, k) for k, v in _access.items()])
+        s = ["%04x-%04x %s" % (lo, hi, names[access]) for lo, hi, access in self.watches]
+        app.put("\n\n%s\n" % "\n".join(s))
+
     def cli_registers(self, app, args):
         """display cpu registers"""
         app.put("\n\n%s\n" % self.cpu)
@@ -93,6 +339,135 @@ class monitor:
             app.put("%04x %-12s %-5s %s\n" % (x, bytes, operation, operands))
             x += n
 
+    def cli_profile(self, app, args):
+        """opcode profiler"""
+        if util.wrong_argc(app, args, (0, 1, 2)):
+            return
+        cmd = (args or ["report"])[0]
+        if cmd in ("on", "off", "clear"):
+            if util.wrong_argc(app, args, (1,)):
+                return
+            getattr(self.profiler, cmd)()
+            app.put("\n\nprofiling is %s\n" % ("off", "on")[self.profiler.enabled()])
+        elif cmd == "save":
+            if util.wrong_argc(app, args, (2,)):
+                return
+            self.profiler.save(args[1])
+            app.put("\n\nsaved to %s\n" % args[1])
+        elif cmd == "report":
+            n = 20
+            if len(args) == 2:
+                n = util.int_arg(app, args[1], (1, 0xFFFF), 10)
+                if n == None:
+                    return
+            app.put("\n\n%s\n" % self.profiler.report(n))
+        else:
+            app.put(util.inv_arg)
+
+    def cli_calls(self, app, args):
+        """call graph profiler"""
+        if util.wrong_argc(app, args, (0, 1, 2)):
+            return
+        cmd = (args or ["report"])[0]
+        if cmd in ("on", "off", "clear"):
+            if util.wrong_argc(app, args, (1,)):
+                return
+            getattr(self.calls, cmd)()
+            app.put("\n\ncall graph profiling is %s\n" % ("off", "on")[self.calls.enabled()])
+        elif cmd == "save":
+            if util.wrong_argc(app, args, (2,)):
+                return
+            self.calls.save(args[1])
+            app.put("\n\nsaved to %s\n" % args[1])
+        elif cmd == "report":
+            n = 20
+            if len(args) == 2:
+                n = util.int_arg(app, args[1], (1, 0xFFFF), 10)
+                if n == None:
+                    return
+            app.put("\n\n%s\n" % self.calls.report(n))
+        else:
+            app.put(util.inv_arg)
+
+    def cli_trace(self, app, args):
+        """execution trace"""
+        if util.wrong_argc(app, args, (0, 1, 2)):
+            return
+        cmd = (args or ["show"])[0]
+        if cmd == "on":
+            n = z80trace._ENTRIES
+            if len(args) == 2:
+                n = util.int_arg(app, args[1], (1, 1 << 24), 10)
+                if n == None:
+                    return
+            self.trace_off(app)
+            z80trace.enable(self.cpu, n)
+            app.put("\n\ntracing the last %d instructions\n" % (self.cpu.trace.mask + 1))
+        elif cmd in ("off", "clear"):
+            if util.wrong_argc(app, args, (1,)):
+                return
+            if cmd == "off":
+                self.trace_off(app)
+            elif self.cpu.trace is not None:
+                self.cpu.trace.clear()
+            app.put("\n\ntracing is %s\n" % ("off", "on")[self.cpu.trace is not None])
+        elif cmd == "file":
+            if util.wrong_argc(app, args, (2,)):
+                return
+            try:
+                z80tracefile.writer(self.cpu, args[1])
+            except Exception as e:
+                app.put("\n\ntrace file error: %s\n" % e)
+                return
+            app.put("\n\nstreaming the trace to %s\n" % args[1])
+        elif cmd == "show":
+            k = 16
+            if len(args) == 2:
+                k = util.int_arg(app, args[1], (1, 1 << 24), 10)
+                if k == None:
+                    return
+            if self.cpu.trace is None:
+                app.put("\n\ntracing is off\n")
+            else:
+                app.put("\n\n%s\n" % self.cpu.trace.report(k))
+        else:
+            app.put(util.inv_arg)
+
+    def trace_off(self, app):
+        """stop tracing, report an error writing the trace file"""
+        try:
+            z80trace.disable(self.cpu)
+        except Exception as e:
+            app.put("\n\ntrace file error: %s\n" % e)
+
+    def post_mortem(self, app):
+        """show the last instructions of the trace (if tracing is on)"""
+        if self.cpu.trace is not None:
+            app.put("%s\n" % self.cpu.trace.report())
+
+    def cli_sample(self, app, args):
+        """pc sampling profiler"""
+        if util.wrong_argc(app, args, (0, 1, 2)):
+            return
+        cmd = (args or ["report"])[0]
+        if cmd in ("on", "off", "clear"):
+            if util.wrong_argc(app, args, (1,)):
+                return
+            getattr(self.sampler, cmd)()
+            app.put("\n\nsampling is %s\n" % ("off", "on")[self.sampler.enabled])
+        elif cmd in ("report", "routines"):
+            n = 20
+            if len(args) == 2:
+                n = util.int_arg(app, args[1], (1, 0xFFFF), 10)
+                if n == None:
+                    return
+            if cmd == "report":
+                app.put("\n\n%s\n" % self.sampler.report(n))
+            else:
+                app.put("\n\n%s\n" % self.sampler.report_routines(n))
+        else:
+            app.put(util.inv_arg)
+
     def cli_mem2display(self, app, args):
         """dump memory contents to the display"""
         if util.wrong_argc(app, args, (1, 2)):
@@ -0,0 +1,152 @@
+# -----------------------------------------------------------------------------
+"""
+Timed Event Scheduler
+
+Events are callbacks due at a deadline on the cpu T-state counter: frame
+interrupts, display refresh, input polling and other device events. The cpu
+runs uninterrupted until the next deadline, then the events that are due are
+called in deadline order (events due at the same time are called in the order
+they were scheduled).
+
+A pacer is a periodic event that keeps emulated time in step with wall clock
+time at the machine's cpu clock rate, and measures the emulation speed.
+"""
+# -----------------------------------------------------------------------------
+
+import time
+import heapq
+import z80
+
+# -----------------------------------------------------------------------------
+
+
+class scheduler:
+    """timed event scheduler"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # heap of [deadline, sequence number, callback, period]
+        self.events = []
+        self.seq = 0
+        self.stopped = False
+
+    def add(self, delay, fn, period=0):
+        """call fn() delay T-states from now, and then every period T-states if period > 0"""
+        event = [self.cpu.tstates + delay, self.seq, fn, period]
+        self.seq += 1
+        heapq.heappush(self.events, event)
+        return event
+
+    def cancel(self, event):
+        """cancel an event returned by add()"""
+        event[2] = None
+        event[3] = 0
+
+    def stop(self):
+        """make run() return after the current event"""
+        self.stopped = True
+
+    def due(self):
+        """call the events that are due"""
+        cpu = self.cpu
+        events = self.events
+        while events and events[0][0] <= cpu.tstates and not self.stopped:
+            event = heapq.heappop(events)
+            fn = event[2]
+            if event[3]:
+                event[0] += event[3]
+                event[1] = self.seq
+                self.seq += 1
+                heapq.heappush(events, event)
+            if fn is not None:
+                fn()
+
+    def run(self, tstates=None):
+        """
+        Run the cpu for tstates clock cycles (or until stopped) calling events as they fall due.
+        Return the stop reason for the cpu run loop.
+        """
+        cpu = self.cpu
+        end = None
+        if tstates is not None:
+            end = cpu.tstates + tstates
+        self.stopped = False
+        stop = z80.STOP_BUDGET
+        while not self.stopped:
+            deadline = end
+            if self.events and (end is None or self.events[0][0] < end):
+                deadline = self.events[0][0]
+            if deadline is None:
+                raise ValueError("no events and no run time")
+            if cpu.tstates < deadline:
+                stop = cpu.run(deadline - cpu.tstates)[1]
+                if stop in (z80.STOP_ERROR, z80.STOP_BREAK, z80.STOP_WATCH):
+                    return stop
+            self.due()
+            if end is not None and cpu.tstates >= end:
+                break
+        return stop
+
+
+# -----------------------------------------------------------------------------
+
+# pacing falls back to running as fast as possible when it is this far behind (seconds)
+_SLIP = 0.25
+
+# seconds between speed measurements
+_INTERVAL = 1.0
+
+
+class pacer:
+    """pace emulated time against wall clock time, or run unthrottled in turbo mode"""
+
+    def __init__(self, sched, clk, period, turbo=False, report=None, interval=_INTERVAL):
+        """clk: cpu clock rate (Hz), period: T-states between checks, report(pacer): called with new measurements"""
+        self.cpu = sched.cpu
+        self.clk = clk
+        self.turbo = turbo
+        self.report = report
+        self.interval = interval
+        # emulated MHz and instructions per second
+        self.mhz = 0.0
+        self.ips = 0.0
+        self.sync()
+        sched.add(period, self.tick, period)
+
+    def sync(self):
+        """restart pacing and measurement from now (e.g. after the emulation was paused)"""
+        self.t0 = self.cpu.tstates
+        self.wall0 = time.perf_counter()
+        self.mark = (self.wall0, self.cpu.tstates, self.cpu.instructions)
+
+    def set_turbo(self, turbo):
+        """turn turbo mode on or off"""
+        self.turbo = turbo
+        self.sync()
+
+    def tick(self):
+        """pacing event"""
+        cpu = self.cpu
+        now = time.perf_counter()
+        if not self.turbo:
+            ahead = ((cpu.tstates - self.t0) / self.clk) - (now - self.wall0)
+            if ahead > 0:
+                time.sleep(ahead)
+                now = time.perf_counter()
+            elif ahead < -_SLIP:
+                # the host can't keep up: don't try to catch up later
+                self.t0 = cpu.tstates
+                self.wall0 = now
+        (wall, tstates, instructions) = self.mark
+        if now - wall >= self.interval and now > wall:
+            self.mhz = (cpu.tstates - tstates) / (now - wall) / 1e6
+            self.ips = (cpu.instructions - instructions) / (now - wall)
+            self.mark = (now, cpu.tstates, cpu.instructions)
+            if self.report is not None:
+                self.report(self)
+
+    def __str__(self):
+        return "%.2f MHz %.2f MIPS%s" % (self.mhz, self.ips / 1e6, ("", " (turbo)")[self.turbo])
+
+
+# -----------------------------------------------------------------------------
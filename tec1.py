@@ -7,6 +7,7 @@ Talking Electronics Computer Emulator
 import memory
 import z80da
 import z80
+import scheduler
 import monitor
 import util
 import pygame
@@ -19,10 +20,19 @@ _screen_y = 50
 
 _border = (0, 0, 0)
 
+# cpu clocks run between display and keyboard updates
+_RUN_CLKS = 1000
+
+# nominal cpu clock rate, and cpu clocks between real-time pacing checks (~20ms)
+_CPU_CLK = 2000000
+_PACE_CLKS = _CPU_CLK // 50
+
+_help_turbo = (("[on|off]", "run unthrottled - default is to show the emulation speed"),)
+
 # -----------------------------------------------------------------------------
 
 
-class memmap:
+class memmap(memory.memmap):
     """memory devices and address map"""
 
     def __init__(self, romfile="./roms/tec1a.rom"):
@@ -30,53 +40,44 @@ class memmap:
         self.rom.load_file(0, romfile)
         self.ram = memory.ram(11)
         self.empty = memory.null()
-
-    def select(self, adr):
-        """return the memory object selected by this address"""
         # select with 2k granularity
-        memmap = (
-            self.rom,  # 0x0000 - 0x07ff
-            self.ram,  # 0x0800 - 0x0fff
-            self.empty,  # 0x1000
-            self.empty,  # 0x1800
-            self.empty,  # 0x2000
-            self.empty,  # 0x2800
-            self.empty,  # 0x3000
-            self.empty,  # 0x3800
-            self.empty,  # 0x4000
-            self.empty,  # 0x4800
-            self.empty,  # 0x5000
-            self.empty,  # 0x5800
-            self.empty,  # 0x6000
-            self.empty,  # 0x6800
-            self.empty,  # 0x7000
-            self.empty,  # 0x7800
-            self.empty,  # 0x8000
-            self.empty,  # 0x8800
-            self.empty,  # 0x9000
-            self.empty,  # 0x9800
-            self.empty,  # 0xa000
-            self.empty,  # 0xa800
-            self.empty,  # 0xb000
-            self.empty,  # 0xb800
-            self.empty,  # 0xc000
-            self.empty,  # 0xc800
-            self.empty,  # 0xd000
-            self.empty,  # 0xd800
-            self.empty,  # 0xe000
-            self.empty,  # 0xe800
-            self.empty,  # 0xf000
-            self.empty,  # 0xf800
+        memory.memmap.__init__(
+            self,
+            (
+                self.rom,  # 0x0000 - 0x07ff
+                self.ram,  # 0x0800 - 0x0fff
+                self.empty,  # 0x1000
+                self.empty,  # 0x1800
+                self.empty,  # 0x2000
+                self.empty,  # 0x2800
+                self.empty,  # 0x3000
+                self.empty,  # 0x3800
+                self.empty,  # 0x4000
+                self.empty,  # 0x4800
+                self.empty,  # 0x5000
+                self.empty,  # 0x5800
+                self.empty,  # 0x6000
+                self.empty,  # 0x6800
+                self.empty,  # 0x7000
+                self.empty,  # 0x7800
+                self.empty,  # 0x8000
+                self.empty,  # 0x8800
+                self.empty,  # 0x9000
+                self.empty,  # 0x9800
+                self.empty,  # 0xa000
+                self.empty,  # 0xa800
+                self.empty,  # 0xb000
+                self.empty,  # 0xb800
+                self.empty,  # 0xc000
+                self.empty,  # 0xc800
+                self.empty,  # 0xd000
+                self.empty,  # 0xd800
+                self.empty,  # 0xe000
+                self.empty,  # 0xe800
+                self.empty,  # 0xf000
+                self.empty,  # 0xf800
+            ),
         )
-        return memmap[adr >> 11]
-
-    def __getitem__(self, adr):
-        adr &= 0xFFFF
-        return self.select(adr)[adr]
-
-    def __setitem__(self, adr, val):
-        adr &= 0xFFFF
-        self.select(adr)[adr] = val
 
 
 # -----------------------------------------------------------------------------
@@ -159,23 +160,30 @@ class io:
 
 class tec1:
 
-    def __init__(self, app):
+    def __init__(self, app, core=z80):
         self.app = app
         self.display = display()
         self.keyboard = keyboard()
         self.mem = memmap()
         self.io = io(self.display, self.keyboard)
-        self.cpu = z80.cpu(self.mem, self.io)
+        self.cpu = core.cpu(self.mem, self.io)
         self.mon = monitor.monitor(self.cpu)
         self.menu_root = (
             ("..", "return to main menu", util.cr, self.parent_menu, None),
+            ("break", "breakpoints", None, None, self.mon.menu_break),
+            ("calls", "call graph profiler", monitor._help_calls, self.mon.cli_calls, None),
             ("da", "disassemble memory", monitor._help_disassemble, self.mon.cli_disassemble, None),
             ("exit", "exit the application", util.cr, self.exit, None),
             ("help", "display general help", util.cr, app.general_help, None),
             ("memory", "memory functions", None, None, self.mon.menu_memory),
+            ("profile", "opcode profiler", monitor._help_profile, self.mon.cli_profile, None),
             ("regs", "display cpu registers", util.cr, self.mon.cli_registers, None),
             ("run", "run the emulation", util.cr, self.cli_run, None),
+            ("sample", "pc sampling profiler", monitor._help_sample, self.mon.cli_sample, None),
             ("step", "single step the emulation", util.cr, self.cli_step, None),
+            ("trace", "execution trace", monitor._help_trace, self.mon.cli_trace, None),
+            ("turbo", "real-time or unthrottled emulation", _help_turbo, self.cli_turbo, None),
+            ("watch", "memory watchpoints", None, None, self.mon.menu_watch),
         )
 
         # setup the video window
@@ -184,33 +192,62 @@ class tec1:
         pygame.display.set_caption("Talking Electronics Computer TEC 1")
         self.display.refresh(self.screen)
 
+        # display refresh and keyboard polling
+        self.sched = scheduler.scheduler(self.cpu)
+        self.sched.add(_RUN_CLKS, self.poll, _RUN_CLKS)
+        self.pacer = scheduler.pacer(self.sched, _CPU_CLK, _PACE_CLKS, report=self.speed)
+        self.irq = 0
+
         app.cli.set_poll(pygame.event.pump)
         app.cli.set_root(self.menu_root)
         self.app.cli.set_prompt("\ntec1> ")
 
+    def poll(self):
+        """display refresh and keyboard polling event - a keypress interrupts the cpu"""
+        self.display.update(self.screen)
+        if self.app.io.anykey():
+            self.sched.stop()
+        if self.keyboard.get():
+            x = self.irq
+            self.irq += 1
+            return self.cpu.interrupt(x)
+
+    def speed(self, pacer):
+        """emulation speed report"""
+        pygame.display.set_caption("Talking Electronics Computer TEC 1 - %s" % pacer)
+
     def cli_run(self, app, args):
         """run the emulation"""
         app.put("\n\npress any key to halt\n")
-        irq = False
-        x = 0
-        while True:
-            if app.io.anykey():
-                return
+        stop = self.mon.resume()
+        if stop is None:
+            self.pacer.sync()
+            self.mon.sampler.start()
             try:
-                pc = self.cpu._get_pc()
-                if irq:
-                    self.cpu.interrupt(x)
-                    irq = False
-                    x += 1
-                else:
-                    self.cpu.execute()
-            except z80.Error as e:
-                self.cpu._set_pc(pc)
-                app.put("exception: %s\n" % e)
+                stop = self.sched.run()
+            finally:
+                self.mon.sampler.stop()
+        if stop == z80.STOP_ERROR:
+            app.put("exception: %s\n" % self.cpu.error)
+        elif stop == z80.STOP_BREAK:
+            app.put("breakpoint: %s\n" % self.current_instruction())
+            if self.cpu.cond_error is not None:
+                app.put("bad condition: %s\n" % self.mon.bad_condition())
+        elif stop == z80.STOP_WATCH:
+            app.put("watchpoint:\n%s\n" % self.mon.watch_hits())
+        if stop in (z80.STOP_ERROR, z80.STOP_BREAK, z80.STOP_WATCH) or self.cpu.halt:
+            self.mon.post_mortem(app)
+
+    def cli_turbo(self, app, args):
+        """real-time or unthrottled emulation"""
+        if util.wrong_argc(app, args, (0, 1)):
+            return
+        if len(args) == 1:
+            if args[0] not in ("on", "off"):
+                app.put(util.inv_arg)
                 return
-            print(x)
-            self.display.update(self.screen)
-            irq = self.keyboard.get()
+            self.pacer.set_turbo(args[0] == "on")
+        app.put("\n\nturbo %s, last run: %s\n" % (("off", "on")[self.pacer.turbo], self.pacer))
 
     def current_instruction(self):
         """return a string for the current instruction"""
@@ -1,13 +1,36 @@
 # -----------------------------------------------------------------------------
 
+import os
+import sys
+import csv
+import json
+import signal
+import time
+import tempfile
 import unittest
 
 # -----------------------------------------------------------------------------
 
 import memory
 import jace
+import monitor
 import z80da
 import z80
+import z80fast
+import z80gen
+import z80core
+import z80pd
+import z80bt
+import z80idle
+import z80si
+import z80prof
+import z80cg
+import z80cond
+import z80sample
+import z80trace
+import z80tracefile
+import scheduler
+import bench
 
 # -----------------------------------------------------------------------------
 
@@ -130,6 +153,921 @@ class z80_regs_test(unittest.TestCase):
         self.assertEqual(cpu.l, 0xEF)
 
 
+# -----------------------------------------------------------------------------
+
+
+class z80_run_test(unittest.TestCase):
+
+    def setUp(self):
+        # ld b,3; djnz $; halt
+        self.mem = memory.ram(8)
+        self.mem.load(0, (0x06, 0x03, 0x10, 0xFE, 0x76))
+        self.cpu = z80.cpu(self.mem, None)
+
+    def test_run(self):
+        self.assertEqual(self.cpu.run(10), (20, z80.STOP_BUDGET))
+        self.assertEqual(self.cpu.run(1000), (25, z80.STOP_HALT))
+        self.assertEqual(self.cpu.pc, 4)
+        self.assertEqual(self.cpu.halt, 1)
+
+    def test_halted(self):
+        self.assertEqual(self.cpu.run(1000), (45, z80.STOP_HALT))
+        self.assertEqual(self.cpu.r, 5)
+        # a halted cpu spends the budget in one call
+        self.assertEqual(self.cpu.run(1001), (1004, z80.STOP_HALT))
+        self.assertEqual(self.cpu.run_until(4, 8), (8, z80.STOP_HALT))
+        self.assertEqual((self.cpu.pc, self.cpu.r), (4, (5 + 251 + 2) & 0x7F))
+
+    def test_tstates(self):
+        self.cpu.run(10)
+        self.cpu.run_until(4, 1000)
+        self.cpu.execute()
+        self.cpu.run(100)
+        self.assertEqual(self.cpu.tstates, 20 + 21 + 4 + 100)
+
+    def test_instructions(self):
+        self.cpu.run(1000)
+        self.assertEqual(self.cpu.instructions, 5)
+        # halts spent in one call are counted one by one
+        self.cpu.run(1001)
+        self.assertEqual(self.cpu.instructions, 5 + 251)
+
+    def test_state(self):
+        self.cpu.run(10)
+        state = self.cpu.get_state()
+        self.cpu.run(1000)
+        self.assertEqual(self.cpu.halt, 1)
+        halted = self.cpu.get_state()
+        self.cpu.set_state(state)
+        self.assertEqual((self.cpu.pc, self.cpu.b, self.cpu.halt), (2, 2, 0))
+        self.cpu.run(1000)
+        self.assertEqual(self.cpu.get_state(), halted)
+
+    def test_run_until(self):
+        self.assertEqual(self.cpu.run_until(4, 1000), (41, z80.STOP_ADDRESS))
+        self.assertEqual(self.cpu.b, 0)
+
+    def test_error(self):
+        # jr is not implemented with a dd prefix
+        self.mem.load(0x10, (0xDD, 0x18, 0x00))
+        self.cpu.pc = 0x10
+        self.assertEqual(self.cpu.run(1000), (0, z80.STOP_ERROR))
+        self.assertEqual(self.cpu.pc, 0x10)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_predecode_test(unittest.TestCase):
+
+    def test_self_modifying(self):
+        # ld a,5; inc a; ld (0x3401),a; halt
+        # 0x3401 is a mirror of the ld immediate at 0x3001
+        mem = jace.memmap("./roms/ace.rom")
+        mem.ram.load(0, (0x3E, 0x05, 0x3C, 0x32, 0x01, 0x34, 0x76))
+        cpu = z80.cpu(mem, None)
+        cache = z80pd.enable(cpu)
+        for a in (6, 7, 8):
+            cpu.pc = 0x3000
+            cpu.halt = 0
+            self.assertEqual(cpu.run(1000), (28, z80.STOP_HALT))
+            self.assertEqual(cpu.a, a)
+        self.assertEqual(cache.lookups, 12)
+        self.assertEqual(cache.misses, 6)
+        z80pd.disable(cpu)
+        self.assertEqual(mem.wr_hooks, [])
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_translate_test(unittest.TestCase):
+
+    def test_self_modifying(self):
+        # ld a,5; inc a; ld (0x3401),a; inc a; halt
+        # 0x3401 is a mirror of the ld immediate at 0x3001
+        mem = jace.memmap("./roms/ace.rom")
+        mem.ram.load(0, (0x3E, 0x05, 0x3C, 0x32, 0x01, 0x34, 0x3C, 0x76))
+        cpu = z80.cpu(mem, None)
+        cache = z80bt.enable(cpu, threshold=0)
+        for a in (7, 8, 9):
+            cpu.pc = 0x3000
+            cpu.halt = 0
+            # the block exits after the store, the rest is a new block
+            self.assertEqual(cpu.run(1000), (32, z80.STOP_HALT))
+            self.assertEqual(cpu.a, a)
+            self.assertEqual(cpu.r, 5 * (a - 6))
+        self.assertEqual(cache.executed, 6)
+        self.assertEqual(cache.translations, 4)
+        self.assertEqual(cache.invalidations, 3)
+        z80bt.disable(cpu)
+        self.assertEqual(mem.wr_hooks, [])
+
+    def test_budget(self):
+        # ld b,3; djnz $; halt
+        mem = memory.ram(16)
+        mem.load(0, (0x06, 0x03, 0x10, 0xFE, 0x76))
+        cpu = z80.cpu(memory.memmap([mem] * 32), None)
+        cache = z80bt.enable(cpu, threshold=0)
+        # the block is not started once the budget is spent
+        self.assertEqual(cpu.run(1), (7, z80.STOP_BUDGET))
+        self.assertEqual(cpu.pc, 2)
+        self.assertEqual(cache.executed, 0)
+        # the djnz loop runs within a single block call
+        self.assertEqual(cpu.run(100), (13 + 13 + 8 + 4, z80.STOP_HALT))
+        self.assertEqual(cache.executed, 2)
+        # a loop stops at the budget
+        cpu.pc = 0
+        cpu.halt = 0
+        self.assertEqual(cpu.run(7 + 13 + 1), (7 + 13 + 13, z80.STOP_BUDGET))
+        self.assertEqual((cpu.pc, cpu.b), (2, 1))
+
+    def test_threshold(self):
+        # jr $ - translated after 300 interpreted iterations
+        mem = memory.ram(16)
+        mem.load(0, (0x18, 0xFE))
+        cpu = z80.cpu(memory.memmap([mem] * 32), None)
+        cache = z80bt.enable(cpu, threshold=300)
+        self.assertEqual(cpu.run(12 * 400)[1], z80.STOP_BUDGET)
+        self.assertEqual(cache.counts[0], 300)
+        self.assertEqual(cache.translations, 1)
+        z80bt.disable(cpu)
+        self.assertRaises(ValueError, z80bt.enable, cpu, threshold=0x10000)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_lazy_flags_test(unittest.TestCase):
+
+    def test_lazy(self):
+        # ld a,0x7f; add a,1; push af; cp 0x80; jr nz,$+2; sbc a,0x10;
+        # ret m; ex af,af'; neg; daa; jp c,0x14; inc a; halt
+        code = (0x3E, 0x7F, 0xC6, 0x01, 0xF5, 0xFE, 0x80, 0x20, 0x00, 0xDE, 0x10,
+                0xF8, 0x08, 0xED, 0x44, 0x27, 0xDA, 0x14, 0x00, 0x3C, 0x76)
+        lazy = bench.load_core("z80_lazy", lazy=True)
+        self.assertTrue(lazy.cpu.gen_options["lazy"])
+        cpus = []
+        for core in (z80, lazy):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpus.append(core.cpu(mem, None))
+        for i in range(13):
+            self.assertEqual(cpus[0].execute(), cpus[1].execute())
+            self.assertEqual(cpus[0].pc, cpus[1].pc)
+        self.assertEqual([cpu.halt for cpu in cpus], [1, 1])
+        self.assertEqual(str(cpus[0]), str(cpus[1]))
+        self.assertEqual(cpus[0].mem.mem, cpus[1].mem.mem)
+
+    def test_state(self):
+        # xor a; add a,0xff (lazy flags); halt
+        lazy = bench.load_core("z80_lazy", lazy=True)
+        mem = memory.ram(16)
+        mem.load(0, (0xAF, 0xC6, 0xFF, 0x76))
+        cpu = lazy.cpu(mem, None)
+        cpu.f = 0x00
+        state = cpu.get_state()
+        cpu.execute()
+        cpu.execute()
+        self.assertNotEqual(cpu.lazy, None)
+        cpu.set_state(state)
+        self.assertEqual((cpu.f, cpu.pc), (0x00, 0))
+        cpu.execute()
+        cpu.execute()
+        self.assertEqual(cpu.f, 0xA8)
+        cpu.set_state(state)
+        self.assertEqual(cpu.get_state(), state)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_profile_test(unittest.TestCase):
+
+    def test_fast(self):
+        # ld hl,0x4000; ld de,0x5000; ld bc,0x10; loop: ldi; add a,(hl); rla; ex af,af'
+        # ld a,b; or c; jp z,done; ex af,af'; jp loop; done: ld a,r; halt
+        code = (0x21, 0x00, 0x40, 0x11, 0x00, 0x50, 0x01, 0x10, 0x00, 0xED, 0xA0, 0x86, 0x17, 0x08,
+                0x78, 0xB1, 0xCA, 0x17, 0x00, 0x08, 0xC3, 0x09, 0x00, 0xED, 0x5F, 0x76)
+        fast = bench.load_core("z80_fast", **z80gen.profiles["fast"])
+        self.assertFalse(fast.cpu.gen_options["refresh"])
+        cpus = []
+        for core in (z80, fast):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            mem.load(0x4000, range(0x10))
+            cpus.append(core.cpu(mem, None))
+            self.assertEqual(cpus[-1].run(10000), (1041, z80.STOP_HALT))
+        # r is up to date when run() returns, but ld a,r read it at the start of the run
+        self.assertEqual([cpu.r for cpu in cpus], [cpus[0].instructions & 0x7F] * 2)
+        self.assertEqual([cpu.a for cpu in cpus], [(cpus[0].instructions - 1) & 0x7F, 0])
+        # the undocumented flag bits are not computed
+        self.assertEqual(cpus[0].alt_af & 0xFFD7, cpus[1].alt_af)
+        self.assertEqual(cpus[0].mem.mem, cpus[1].mem.mem)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_superinstruction_test(unittest.TestCase):
+
+    def test_fused(self):
+        # ld hl,0x100; loop: ld e,(hl); inc hl; ld d,(hl); inc hl; ld a,r; djnz loop; halt
+        code = (0x21, 0x00, 0x01, 0x5E, 0x23, 0x56, 0x23, 0xED, 0x5F, 0x10, 0xF8, 0x76)
+        mem = memory.ram(16)
+        mem.load(0, code)
+        cpu = z80.cpu(mem, None)
+        rec = z80si.record(cpu)
+        cpu.run(1000)
+        rec.close()
+        fname = os.path.join(tempfile.mkdtemp(), "test.seq")
+        rec.save(fname)
+        sequences = z80gen.read_profile(fname, 4)
+        self.assertEqual(sequences[0], (b"\x5e", b"\x23", b"\x56"))
+        core = bench.load_core("z80_fused", sequences=sequences)
+        cpus = []
+        for fused in (False, True):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            mem.load(0x100, range(256))
+            cpus.append(core.cpu(mem, None))
+            if fused:
+                z80si.enable(cpus[-1])
+        # the same instruction boundaries for any budget
+        for budget in (1, 7, 10, 11, 16, 29, 1000, 100000):
+            self.assertEqual(cpus[0].run(budget), cpus[1].run(budget))
+            self.assertEqual(cpus[0].get_state(), cpus[1].get_state())
+        self.assertEqual([cpu.halt for cpu in cpus], [1, 1])
+        self.assertEqual(cpus[0].instructions, cpus[1].instructions)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80core_test(unittest.TestCase):
+
+    def test_cache(self):
+        cache = tempfile.mkdtemp()
+        core = z80core.load("z80_cached", cache=cache)
+        self.assertEqual(core.__name__, "z80_cached")
+        files = os.listdir(cache)
+        mtime = os.path.getmtime(os.path.join(cache, files[1 - files.index("__pycache__")]))
+        # a cache hit loads the same build
+        core = z80core.load("z80_cached", cache=cache)
+        self.assertEqual(os.listdir(cache), files)
+        self.assertEqual(os.path.getmtime(core.__file__), mtime)
+        self.assertEqual(core.cpu(memory.ram(8), None).run(8), (8, z80.STOP_BUDGET))
+        # new options replace the stale build
+        core = z80core.load("z80_cached", cache=cache, lazy=True)
+        self.assertTrue(core.cpu.gen_options["lazy"])
+        self.assertEqual(len(os.listdir(cache)), 2)
+        self.assertEqual(len(os.listdir(os.path.join(cache, "__pycache__"))), 1)
+        self.assertNotEqual(z80core.key({}), z80core.key({}, "roms/ace.seq"))
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_alu_test(unittest.TestCase):
+
+    def run_code(self, code):
+        mem = memory.ram(8)
+        mem.load(0, code + (0x76,))
+        cpu = z80.cpu(mem, None)
+        cpu.run(1000)
+        return (cpu.a, cpu.f)
+
+    def test_add(self):
+        # ld a,0x7f; add a,1
+        self.assertEqual(self.run_code((0x3E, 0x7F, 0xC6, 0x01)), (0x80, 0x94))
+
+    def test_sbc(self):
+        # ld a,0; scf; sbc a,0
+        self.assertEqual(self.run_code((0x3E, 0x00, 0x37, 0xDE, 0x00)), (0xFF, 0xBB))
+
+    def test_daa(self):
+        # ld a,0x99; add a,1; daa
+        self.assertEqual(self.run_code((0x3E, 0x99, 0xC6, 0x01, 0x27)), (0x00, 0x55))
+        # ld a,0x15; sub 0x06; daa
+        self.assertEqual(self.run_code((0x3E, 0x15, 0xD6, 0x06, 0x27)), (0x09, 0x0E))
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_block_test(unittest.TestCase):
+
+    class io:
+        def __init__(self):
+            self.log = []
+
+        def rd(self, adr):
+            self.log.append(adr)
+            return adr & 0xFF
+
+        def wr(self, adr, val):
+            self.log.append((adr, val))
+
+    def setUp(self):
+        self.mem = memory.ram(16)
+        self.cpu = z80.cpu(self.mem, self.io())
+        self.cpu.pc = 0
+
+    def test_ldir(self):
+        # ldir; halt - an overlapping copy repeats the source pattern
+        self.mem.load(0, (0xED, 0xB0, 0x76))
+        self.mem.load(0x100, (0xAA, 0x55))
+        cpu = self.cpu
+        cpu._set_hl(0x100)
+        cpu._set_de(0x102)
+        cpu._set_bc(6)
+        self.assertEqual(cpu.run(1000), ((5 * 21) + 16 + 4, z80.STOP_HALT))
+        self.assertEqual(list(self.mem.mem[0x100:0x109]), [0xAA, 0x55] * 4 + [0])
+        self.assertEqual((cpu._get_hl(), cpu._get_de(), cpu._get_bc(), cpu.r), (0x106, 0x108, 0, 7))
+        self.assertEqual(cpu.f & z80._VF, 0)
+
+    def test_budget(self):
+        # ldir stops on the same iteration as when it is stepped
+        self.mem.load(0, (0xED, 0xB0, 0x76))
+        cpu = self.cpu
+        cpu._set_bc(6)
+        self.assertEqual(cpu.run(22), (42, z80.STOP_BUDGET))
+        self.assertEqual((cpu.pc, cpu._get_bc(), cpu.r), (0, 4, 2))
+        self.assertEqual(cpu.f & z80._VF, z80._VF)
+
+    def test_cpir(self):
+        # cpir; halt - stops on a match
+        self.mem.load(0, (0xED, 0xB1, 0x76))
+        self.mem.load(0x100, (1, 2, 3, 4))
+        cpu = self.cpu
+        cpu.a = 3
+        cpu._set_hl(0x100)
+        cpu._set_bc(10)
+        self.assertEqual(cpu.run(1000), (21 + 21 + 16 + 4, z80.STOP_HALT))
+        self.assertEqual((cpu._get_hl(), cpu._get_bc()), (0x103, 7))
+        self.assertEqual(cpu.f & (z80._ZF | z80._VF | z80._NF), z80._ZF | z80._VF | z80._NF)
+
+    def test_otir(self):
+        # otir; inir; halt
+        self.mem.load(0, (0xED, 0xB3, 0xED, 0xB2, 0x76))
+        self.mem.load(0x100, (1, 2, 3))
+        cpu = self.cpu
+        cpu._set_hl(0x100)
+        cpu._set_bc(0x0310)
+        self.assertEqual(cpu.run(50), (21 + 21 + 16, z80.STOP_BUDGET))
+        self.assertEqual(cpu.io.log, [(0x0210, 1), (0x0110, 2), (0x0010, 3)])
+        self.assertEqual((cpu.pc, cpu._get_hl(), cpu.f & z80._ZF), (2, 0x103, z80._ZF))
+        cpu.b = 2
+        self.assertEqual(cpu.run(1000), (21 + 16 + 4, z80.STOP_HALT))
+        self.assertEqual(cpu.io.log[3:], [0x0210, 0x0110])
+        self.assertEqual(list(self.mem.mem[0x103:0x105]), [0x10, 0x10])
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_idle_test(unittest.TestCase):
+
+    def run_both(self, code, tstates):
+        """run code with and without idle loop skipping, return the detector"""
+        x = []
+        for skip in (False, True):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = z80.cpu(mem, None)
+            if skip:
+                idle = z80idle.enable(cpu)
+            x.append((cpu.run(tstates), str(cpu)))
+        self.assertEqual(x[0], x[1])
+        return idle
+
+    def test_poll(self):
+        # ld hl,0x100; bit 0,(hl); jr z,$-2
+        idle = self.run_both((0x21, 0x00, 0x01, 0xCB, 0x46, 0x28, 0xFC), 1000)
+        self.assertEqual((idle.loops, idle.iterations, idle.skipped), (1, 39, 39 * 24))
+
+    def test_djnz(self):
+        # ld b,10; djnz $; halt
+        idle = self.run_both((0x06, 0x0A, 0x10, 0xFE, 0x76), 1000)
+        self.assertEqual((idle.loops, idle.iterations, idle.skipped), (1, 9, (9 * 13) - 5))
+
+    def test_writes(self):
+        # ld hl,0x100; inc (hl); jr nz,$-1 - writes memory, not skipped
+        idle = self.run_both((0x21, 0x00, 0x01, 0x34, 0x20, 0xFD), 1000)
+        self.assertEqual(idle.loops, 0)
+        z80idle.disable(idle.cpu)
+        self.assertEqual(idle.cpu.opcodes, z80.cpu.opcodes)
+
+    def test_profiled(self):
+        # idle loop skipping can't be turned on or off while a profiler has replaced the opcode table
+        cpu = z80.cpu(memory.ram(16), None)
+        idle = z80idle.enable(cpu)
+        prof = z80prof.profiler(cpu)
+        prof.on()
+        profiled = cpu.opcodes
+        self.assertRaises(ValueError, z80idle.disable, cpu)
+        self.assertIs(cpu.idle, idle)
+        self.assertIs(cpu.opcodes, profiled)
+        prof.off()
+        self.assertIs(cpu.opcodes, idle.opcodes)
+        z80idle.disable(cpu)
+        self.assertNotIn("opcodes", cpu.__dict__)
+        prof.on()
+        self.assertRaises(ValueError, z80idle.enable, cpu)
+        self.assertEqual(cpu.idle, None)
+        prof.off()
+        self.assertRaises(ValueError, z80idle.enable, cpu, limit=255)
+
+
+# -----------------------------------------------------------------------------
+
+
+class scheduler_test(unittest.TestCase):
+
+    def setUp(self):
+        # nops
+        self.cpu = z80.cpu(memory.ram(16), None)
+        self.sched = scheduler.scheduler(self.cpu)
+        self.log = []
+
+    def event(self, name):
+        return lambda: self.log.append((name, self.cpu.tstates))
+
+    def irq(self):
+        self.log.append(("irq", self.cpu.tstates))
+        self.cpu.interrupt()
+
+    def test_order(self):
+        self.cpu.iff1 = 1
+        self.cpu.im = 1
+        self.sched.add(10, self.event("a"))
+        b = self.sched.add(8, self.event("b"), 8)
+        self.sched.add(16, self.irq)
+        self.assertEqual(self.sched.run(30), z80.STOP_BUDGET)
+        # the irq was scheduled for 16 before b, and takes 11 clock cycles
+        self.assertEqual(self.log, [("b", 8), ("a", 12), ("irq", 16), ("b", 27), ("b", 27)])
+        self.sched.cancel(b)
+        self.sched.run(100)
+        self.assertEqual(len(self.log), 5)
+        self.assertEqual(self.cpu.tstates, 131)
+
+    def test_stop(self):
+        self.sched.add(100, self.sched.stop, 100)
+        self.sched.add(100, self.event("a"), 100)
+        self.assertEqual(self.sched.run(), z80.STOP_BUDGET)
+        self.assertEqual((self.cpu.tstates, self.log), (100, []))
+        self.sched.run()
+        self.assertEqual((self.cpu.tstates, self.log), (200, [("a", 100)]))
+
+    def test_pacer(self):
+        # 20000 clock cycles at 1MHz take 20ms of wall clock time
+        reports = []
+        pacer = scheduler.pacer(self.sched, 1000000, 5000, report=reports.append, interval=0)
+        t = time.perf_counter()
+        self.sched.run(20000)
+        self.assertGreaterEqual(time.perf_counter() - t, 0.019)
+        self.assertEqual(len(reports), 4)
+        self.assertLess(pacer.mhz, 1.5)
+        self.assertEqual(self.cpu.instructions, 5000)
+        # turbo mode doesn't wait
+        pacer.set_turbo(True)
+        t = time.perf_counter()
+        self.sched.run(100000)
+        self.assertLess(time.perf_counter() - t, 0.1)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80prof_test(unittest.TestCase):
+
+    def test_profile(self):
+        # ld b,3; loop: bit 0,a; ld (ix+1),a; djnz loop; halt
+        code = (0x06, 0x03, 0xCB, 0x47, 0xDD, 0x77, 0x01, 0x10, 0xF9, 0x76)
+        mem = memory.ram(16)
+        mem.load(0, code)
+        cpu = z80.cpu(mem, None)
+        p = z80prof.profiler(cpu)
+        p.on()
+        self.assertTrue(p.enabled())
+        cpu.run(1000)
+        p.off()
+        self.assertFalse(p.enabled())
+        self.assertIs(cpu.opcodes, type(cpu).opcodes)
+        self.assertIs(cpu.opcodes_cb, type(cpu).opcodes_cb)
+        entries = dict([(x["opcode"], (x["instruction"], x["count"], x["tstates"])) for x in p.entries()])
+        self.assertEqual(entries["06"], ("ld b,00", 1, 7))
+        # prefix clock cycles are included
+        self.assertEqual(entries["cb 47"], ("bit 0,a", 3, 24))
+        self.assertEqual(entries["dd 77"], ("ld (ix+00),a", 3, 57))
+        self.assertEqual(entries["10"][1:], (3, 13 + 13 + 8))
+        self.assertEqual(sum([x[2] for x in entries.values()]), cpu.tstates)
+        # the instance tables of other instrumentation are restored
+        z80idle.enable(cpu)
+        idle = cpu.opcodes
+        p.on()
+        p.off()
+        self.assertIs(cpu.opcodes, idle)
+        z80idle.disable(cpu)
+        d = tempfile.mkdtemp()
+        p.save(os.path.join(d, "prof.json"))
+        p.save(os.path.join(d, "prof.csv"))
+        self.assertEqual(json.load(open(os.path.join(d, "prof.json"))), p.entries())
+        rows = list(csv.DictReader(open(os.path.join(d, "prof.csv"))))
+        self.assertEqual([x["opcode"] for x in rows], [x["opcode"] for x in p.entries()])
+        p.clear()
+        self.assertEqual(p.entries(), [])
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80sample_test(unittest.TestCase):
+
+    def test_sample(self):
+        # ld sp,0100; call 0010; halt; 0010: ld b,0; loop: djnz loop; ret
+        mem = memory.ram(16)
+        mem.load(0, (0x31, 0x00, 0x01, 0xCD, 0x10, 0x00, 0x76))
+        mem.load(0x10, (0x06, 0x00, 0x10, 0xFE, 0xC9))
+        cpu = z80.cpu(mem, None)
+        s = z80sample.sampler(cpu)
+        djnz = cpu.opcodes[0x10]
+
+        def sampled(cpu):
+            # a sample taken in the middle of the instruction
+            s.sample(signal.SIGPROF, sys._getframe())
+            return djnz(cpu)
+
+        cpu.opcodes = cpu.opcodes[:0x10] + (sampled,) + cpu.opcodes[0x11:]
+        self.assertEqual(cpu.run(10000)[1], z80.STOP_HALT)
+        self.assertEqual(s.addresses(), [(0x12, 256)])
+        self.assertEqual(list(s.samples), [(0x12, 0x06)])
+        self.assertEqual(s.caller(0x06), 0x10)
+        self.assertEqual(s.routines(), [(0x10, 0x12, 256)])
+        self.assertTrue("djnz  0012" in s.report())
+        # the timer only runs between start and stop, when the sampler is on
+        del cpu.opcodes
+        s.clear()
+        handler = signal.getsignal(signal.SIGPROF)
+        s.start()
+        self.assertEqual(signal.getsignal(signal.SIGPROF), handler)
+        s.on()
+        s.start()
+        t = time.process_time()
+        while not s.samples and time.process_time() - t < 5.0:
+            cpu.reset()
+            cpu.run(10000)
+        s.off()
+        self.assertEqual(signal.getsignal(signal.SIGPROF), handler)
+        self.assertTrue(s.total() > 0)
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80cg_test(unittest.TestCase):
+
+    def test_calls(self):
+        # ld sp,0100; call 0010; call 0010; halt; halt
+        # 0010: call 0020; ret
+        # 0020: nop; ret
+        # 0038: ei; ret
+        mem = memory.ram(16)
+        mem.load(0, (0x31, 0x00, 0x01, 0xCD, 0x10, 0x00, 0xCD, 0x10, 0x00, 0x76, 0x76))
+        mem.load(0x10, (0xCD, 0x20, 0x00, 0xC9))
+        mem.load(0x20, (0x00, 0xC9))
+        mem.load(0x38, (0xFB, 0xC9))
+        cpu = z80.cpu(mem, None)
+        p = z80cg.profiler(cpu)
+        p.on()
+        self.assertEqual(cpu.run(1000), (130, z80.STOP_HALT))
+        cpu.im = 1
+        cpu.iff1 = 1
+        cpu.interrupt()
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_HALT)
+        p.off()
+        self.assertEqual([x in cpu.__dict__ for x in ("opcodes", "interrupt", "_halted", "_repeat")], [False] * 4)
+        self.assertEqual(p.now, cpu.tstates)
+        self.assertEqual(p.routines(), [(0x10, 2, 82, 54), (0x20, 2, 28, 28), (0x38, 1, 14, 14)])
+        fname = os.path.join(tempfile.mkdtemp(), "calls.folded")
+        p.save(fname)
+        self.assertEqual(open(fname).read(), "root 63\nroot;0010 54\nroot;0010;0020 28\nroot;0038 14\n")
+        self.assertTrue(p.report().startswith("entry"))
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80_break_test(unittest.TestCase):
+
+    def test_break(self):
+        # ld b,3; loop: inc a; djnz loop; ld bc,2; ldir; halt
+        code = (0x06, 0x03, 0x3C, 0x10, 0xFD, 0x01, 0x02, 0x00, 0xED, 0xB0, 0x76)
+        for core in (z80, z80fast):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = core.cpu(mem, None)
+            cpu.breaks = bytearray(0x10000)
+            cpu.breaks[0x02] = 1
+            cpu.breaks[0x08] = 1
+            # stop before the instruction at the breakpoint
+            self.assertEqual(cpu.run(1000), (7, z80.STOP_BREAK))
+            self.assertEqual((cpu.pc, cpu.a), (0x02, 0xFF))
+            cpu.execute()
+            self.assertEqual(cpu.run(1000), (13, z80.STOP_BREAK))
+            self.assertEqual((cpu.pc, cpu.a, cpu.b), (0x02, 0x00, 2))
+            cpu.breaks[0x02] = 0
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_BREAK)
+            self.assertEqual((cpu.pc, cpu.a, cpu.b), (0x08, 0x02, 0))
+            # a repeating instruction at a breakpoint stops after each iteration
+            cpu.execute()
+            self.assertEqual(cpu.run(1000), (0, z80.STOP_BREAK))
+            self.assertEqual((cpu.pc, cpu.c), (0x08, 1))
+            cpu.execute()
+            cpu.breaks = None
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_HALT)
+            self.assertEqual(cpu.pc, 0x0A)
+
+    def test_resume_error(self):
+        # inc a; reti (unimplemented) at a breakpoint
+        mem = memory.ram(16)
+        mem.load(0, (0x3C, 0xED, 0x4D))
+        cpu = z80.cpu(mem, None)
+        mon = monitor.monitor(cpu)
+        mon.break_add(1)
+        self.assertEqual(mon.resume(), None)
+        self.assertEqual(cpu.run(1000), (4, z80.STOP_BREAK))
+        self.assertEqual(mon.resume(), z80.STOP_ERROR)
+        self.assertEqual(cpu.pc, 1)
+        self.assertTrue("unimplemented" in str(cpu.error))
+
+    def test_condition(self):
+        # ld hl,0100; loop: inc a; jr loop
+        mem = memory.ram(16)
+        mem.load(0, (0x21, 0x00, 0x01, 0x3C, 0x18, 0xFD))
+        mem.load(0x100, (7,))
+        cpu = z80.cpu(mem, None)
+        cpu.a = 0
+        cpu.breaks = bytearray(0x10000)
+        cpu.breaks[3] = 1
+        cpu.conditions[3] = z80cond.condition("a == 0x20 and mem[hl] > 3")
+        self.assertEqual(cpu.run(100000), (10 + (0x20 * 16), z80.STOP_BREAK))
+        self.assertEqual((cpu.pc, cpu.a), (3, 0x20))
+        f = z80cond.condition("(hl + 1) & 0xFF == 1 and not iff1")
+        self.assertTrue(f(cpu, mem))
+        for expr in ("a ==", "x == 1", "a.f", "__import__('os')", "cpu", "a[1]", "a == 'x'", "a if b else c"):
+            self.assertRaises(ValueError, z80cond.condition, expr)
+        # a condition that raises an exception stops the cpu
+        for core in (z80, z80fast):
+            mem = memory.ram(16)
+            mem.load(0, (0x06, 0x00, 0x3C, 0x18, 0xFD))
+            cpu = core.cpu(mem, None)
+            mon = monitor.monitor(cpu)
+            mon.break_add(2, "a // b == 1")
+            self.assertEqual(cpu.run(1000), (7, z80.STOP_BREAK))
+            self.assertEqual((cpu.pc, cpu.tstates), (2, 7))
+            self.assertIsInstance(cpu.cond_error, ZeroDivisionError)
+            self.assertTrue(mon.bad_condition().startswith("a // b == 1 (ZeroDivisionError"))
+            mon.break_add(2, "a << (b - 1) == 1")
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_BREAK)
+            self.assertIsInstance(cpu.cond_error, ValueError)
+            mon.break_add(2, "a == 0x80")
+            self.assertEqual(mon.resume(), None)
+            self.assertEqual(cpu.run(100)[1], z80.STOP_BUDGET)
+            self.assertEqual(cpu.cond_error, None)
+        # re-adding a breakpoint with a bad condition keeps the old one
+        mon = monitor.monitor(cpu)
+        mon.break_add(2, "a == 1")
+        self.assertRaises(ValueError, mon.break_add, 2, "a ==")
+        self.assertEqual(mon.conditions, {2: "a == 1"})
+        self.assertIn(2, cpu.conditions)
+        self.assertRaises(ValueError, mon.break_add, 4, "a ==")
+        self.assertEqual(mon.breakpoints(), [2])
+
+
+# -----------------------------------------------------------------------------
+
+
+class z80trace_test(unittest.TestCase):
+
+    def test_trace(self):
+        # ld b,3; loop: inc a; djnz loop; ld bc,2; ldir; halt
+        code = (0x06, 0x03, 0x3C, 0x10, 0xFD, 0x01, 0x02, 0x00, 0xED, 0xB0, 0x76)
+        for core in (z80, z80fast):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = core.cpu(mem, None)
+            t = z80trace.enable(cpu, 5)
+            self.assertEqual(t.mask, 7)
+            self.assertEqual(cpu.run(1000), (104, z80.STOP_HALT))
+            # the ldir iterations are a single entry
+            self.assertEqual(t.count, 10)
+            x = t.entries(16)
+            self.assertEqual(len(x), 8)
+            self.assertEqual(x[0], (11, 0x03, 0x0201FD10, 0x0051, 0x03FF, 0xFFFF, 0xFFFF, 0xFFFF))
+            self.assertEqual(x[-2], (63, 0x08, 0x0076B0ED, 0x0201, 0x0002, 0xFFFF, 0xFFFF, 0xFFFF))
+            self.assertEqual(x[-1], (100, 0x0A, 0x76, 0x0209, 0x0000, 0x0001, 0x0001, 0xFFFF))
+            s = t.report(2).split("\n")
+            self.assertEqual(len(s), 3)
+            self.assertEqual(s[1].split()[:5], ["63", "0008", "ed", "b0", "ldir"])
+            t.clear()
+            self.assertEqual(t.entries(16), [])
+            z80trace.disable(cpu)
+            self.assertEqual(cpu.trace, None)
+
+    def test_error(self):
+        # inc a; reti (unimplemented)
+        mem = memory.ram(16)
+        mem.load(0, (0x3C, 0xED, 0x4D))
+        cpu = z80.cpu(mem, None)
+        z80trace.enable(cpu)
+        self.assertEqual(cpu.run(1000), (4, z80.STOP_ERROR))
+        # the failing instruction is the last entry
+        self.assertEqual(cpu.trace.entries(16)[-1][:4], (4, 0x01, 0x4DED, 0x0051))
+
+    def test_resume(self):
+        # ld b,3; loop: inc a; djnz loop; halt - the instruction at a breakpoint is traced on resume
+        mem = memory.ram(16)
+        mem.load(0, (0x06, 0x03, 0x3C, 0x10, 0xFD, 0x76))
+        cpu = z80.cpu(mem, None)
+        d = tempfile.mkdtemp()
+        fname = os.path.join(d, "test.trc")
+        w = z80tracefile.writer(cpu, fname, chunk=4)
+        mon = monitor.monitor(cpu)
+        mon.break_add(2)
+        stops = 0
+        while mon.resume() is None and cpu.run(1000)[1] == z80.STOP_BREAK:
+            stops += 1
+        self.assertEqual((stops, cpu.halt), (3, 1))
+        self.assertEqual(cpu.trace.count, 8)
+        w.close()
+        r = z80tracefile.reader(fname)
+        self.assertEqual(list(r.hits(2)), [1, 3, 5])
+        self.assertEqual(r[7][:2], (cpu.tstates - 4, 0x05))
+        r.close()
+        os.remove(fname)
+        os.rmdir(d)
+
+    def test_monitor(self):
+        # trace file errors are reported by the monitor
+        out = []
+        app = type("app", (), {"put": lambda self, s: out.append(s)})()
+        mem = memory.ram(16)
+        mem.load(0, (0x3C, 0x18, 0xFD))
+        cpu = z80.cpu(mem, None)
+        mon = monitor.monitor(cpu)
+        mon.cli_trace(app, ["on"])
+        cpu.run(1000)
+        d = tempfile.mkdtemp()
+        mon.cli_trace(app, ["file", os.path.join(d, "missing", "test.trc")])
+        self.assertTrue("trace file error" in out[-1])
+        self.assertEqual((cpu.trace.mask, cpu.trace.writer), (z80trace._ENTRIES - 1, None))
+        # the recorded entries are kept in the larger buffer
+        last = cpu.trace.entries(16)
+        fname = os.path.join(d, "test.trc")
+        mon.cli_trace(app, ["file", fname])
+        self.assertEqual(cpu.trace.mask, z80tracefile._CHUNK - 1)
+        self.assertEqual(cpu.trace.entries(16), last)
+        cpu.run(1000)
+        # an error writing the file is reported by trace off
+        cpu.trace.writer.f.close()
+        mon.cli_trace(app, ["off"])
+        self.assertTrue("trace file error" in out[-2])
+        self.assertTrue("tracing is off" in out[-1])
+        self.assertEqual(cpu.trace, None)
+        os.remove(fname)
+        os.rmdir(d)
+
+    def test_file(self):
+        # ld b,3; loop: inc a; djnz loop; ld bc,2; ldir; halt
+        code = (0x06, 0x03, 0x3C, 0x10, 0xFD, 0x01, 0x02, 0x00, 0xED, 0xB0, 0x76)
+        d = tempfile.mkdtemp()
+        fname = os.path.join(d, "test.trc")
+        for method in ("zlib", "lzma"):
+            mem = memory.ram(16)
+            mem.load(0, code)
+            cpu = z80.cpu(mem, None)
+            w = z80tracefile.writer(cpu, fname, chunk=3, method=method)
+            cpu.breaks = bytearray(0x10000)
+            cpu.breaks[0x05] = 1
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_BREAK)
+            cpu.breaks = None
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_HALT)
+            w.close()
+            self.assertEqual(cpu.trace.writer, None)
+            r = z80tracefile.reader(fname)
+            self.assertEqual(len(r), 10)
+            # a stop doesn't end a chunk, the remainder is written by close
+            self.assertEqual(r.first, [0, 3, 6, 9])
+            self.assertEqual(r.entries(0, 16), cpu.trace.entries(16))
+            self.assertEqual(r[-1], (100, 0x0A, 0x76, 0x0209, 0x0000, 0x0001, 0x0001, 0xFFFF))
+            self.assertEqual(list(r.hits(0x02)), [1, 3, 5])
+            self.assertEqual(list(r.hits(0x04)), [])
+            self.assertEqual(r.report(8, 16).split("\n")[1].split()[:5], ["63", "0008", "ed", "b0", "ldir"])
+            self.assertRaises(IndexError, r.__getitem__, 10)
+            r.close()
+        # an incomplete chunk at the end is ignored
+        f = open(fname, "rb")
+        data = f.read()
+        f.close()
+        f = open(fname, "wb")
+        f.write(data[:-1])
+        f.close()
+        r = z80tracefile.reader(fname)
+        self.assertEqual(len(r), 9)
+        r.close()
+        os.remove(fname)
+        os.rmdir(d)
+
+
+# -----------------------------------------------------------------------------
+
+
+class watchpoint_test(unittest.TestCase):
+
+    def test_watch(self):
+        # 3c00: ld hl,3c80; ld (hl),5; inc (hl); ld a,(hl); halt
+        mem = jace.memmap()
+        for i, x in enumerate((0x21, 0x80, 0x3C, 0x36, 0x05, 0x34, 0x7E, 0x76)):
+            mem[0x3C00 + i] = x
+        cpu = z80.cpu(mem, None)
+        cpu.pc = 0x3C00
+        mon = monitor.monitor(cpu)
+        # 3080 is an alias of 3c80 (1K of ram repeats 4 times)
+        mon.watch_add(0x3080, 0x3080, memory.WATCH_WR)
+        self.assertIs(mem.rd_pages[0], mem.rom)
+        self.assertIsInstance(mem.wr_pages[7], memory.watch_hook)
+        self.assertEqual(mon.resume(), None)
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_WATCH)
+        self.assertEqual(cpu.watched, [(0x3C03, memory.WATCH_WR, 0x3C80, 0x00, 0x05)])
+        self.assertEqual(cpu.pc, 0x3C05)
+        self.assertEqual(mon.resume(), None)
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_WATCH)
+        self.assertEqual(cpu.watched, [(0x3C05, memory.WATCH_WR, 0x3C80, 0x05, 0x06)])
+        self.assertTrue("write 3c80: 05 -> 06" in mon.watch_hits())
+        mon.watch_del(0x3080)
+        mon.watch_add(0x3C80, 0x3C80, memory.WATCH_RD)
+        mon.resume()
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_WATCH)
+        self.assertEqual(cpu.watched, [(0x3C06, memory.WATCH_RD, 0x3C80, 0x06, 0x06)])
+        mon.watch_del(0x3C80)
+        self.assertEqual((cpu.breaks, cpu.watched), (None, None))
+        self.assertIs(mem.wr_pages[7], mem.ram)
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_HALT)
+        self.assertEqual(cpu.a, 0x06)
+
+    def test_sampled(self):
+        # the sampler's memory reads don't hit the watchpoints
+        mem = jace.memmap()
+        cpu = z80.cpu(mem, None)
+        cpu.sp = 0x3C80
+        mem[0x3C80] = 0x06
+        mon = monitor.monitor(cpu)
+        mon.watch_add(0x3C00, 0x3CFF, memory.WATCH_RD)
+        self.assertEqual(mon.resume(), None)
+        s = z80sample.sampler(cpu)
+        s.sample(signal.SIGPROF, None)
+        self.assertEqual(list(s.samples), [(0, 0x06)])
+        s.entries()
+        s.caller(0x3C83)
+        s.report()
+        self.assertEqual((cpu.watched, cpu.stop), ([], 0))
+        self.assertEqual(mem.peek(0x3C80), 0x06)
+
+    def test_condition(self):
+        # 3c00: nop; nop; halt - a condition's memory read doesn't hit the read watchpoint
+        mem = jace.memmap()
+        for i, x in enumerate((0x00, 0x00, 0x76)):
+            mem[0x3C00 + i] = x
+        mem[0x3C80] = 0x55
+        cpu = z80.cpu(mem, None)
+        cpu.pc = 0x3C00
+        mon = monitor.monitor(cpu)
+        mon.watch_add(0x3C80, 0x3C80, memory.WATCH_RD)
+        mon.break_add(0x3C01, "mem[0x3c80] == 0x55")
+        self.assertEqual(mon.resume(), None)
+        self.assertEqual(cpu.run(1000)[1], z80.STOP_BREAK)
+        self.assertEqual((cpu.pc, cpu.watched), (0x3C01, []))
+
+    def test_traced(self):
+        # tracing doesn't hit a read watchpoint past the end of the code
+        for traced in (False, True):
+            mem = jace.memmap()
+            for i, x in enumerate((0x00, 0x00, 0x76)):
+                mem[0x3C00 + i] = x
+            cpu = z80.cpu(mem, None)
+            cpu.pc = 0x3C00
+            if traced:
+                z80trace.enable(cpu)
+            mon = monitor.monitor(cpu)
+            mon.watch_add(0x3C03, 0x3C03, memory.WATCH_RD)
+            self.assertEqual(mon.resume(), None)
+            self.assertEqual(cpu.run(1000)[1], z80.STOP_HALT)
+            self.assertEqual(cpu.watched, [])
+        # the watched page has no direct window, the opcode bytes are read past the halt
+        self.assertEqual([x[1:3] for x in cpu.trace.entries(16)], [(0x3C00, 0x760000), (0x3C01, 0x7600), (0x3C02, 0x76)])
+
+
 # -----------------------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 CPU Emulation
+
+Importing this module loads the cpu core generated with the accurate z80gen
+profile and the superinstructions for the Jupiter ACE rom. The core is
+regenerated when z80gen.py or z80th.py change (see z80core.py).
+"""
+# -----------------------------------------------------------------------------
+
+import sys
+import z80core
+
+sys.modules[__name__] = z80core.load(__name__, seq="roms/ace.seq")
+
+# -----------------------------------------------------------------------------
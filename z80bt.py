@@ -0,0 +1,235 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Block Translator
+
+Translates a straight-line run of instructions, from a start address up to
+and including the next instruction that may change the flow of control, into
+a single Python function. The function executes the whole run, advances the
+r register and the pc, and returns the number of clock cycles taken.
+
+A block ends with:
+ * an instruction that modifies the pc (jumps, calls, returns, halt, block
+   instructions) or reads/writes the r register
+ * the maximum block length
+ * an unimplemented instruction or a repeated prefix (not part of the block)
+
+A block that branches back to its own start (a delay or polling loop) keeps
+looping inside the block function while the remaining clock cycle budget
+allows. The run loop only starts a block if all of its instructions would
+have been started by the interpreter, so run() stops on the same instruction
+boundaries with or without translation.
+
+Blocks are translated once their start address has been reached a few times,
+and are cached by start address. A ram write to the bytes of a translated
+block invalidates the block. If the write is made by the block that is running
+the block exits after the writing instruction, so self-modifying code sees its
+own changes.
+"""
+# -----------------------------------------------------------------------------
+
+import re
+import array
+import memory
+import z80pd
+
+# -----------------------------------------------------------------------------
+
+# maximum number of instructions in a block
+_MAX_LENGTH = 32
+
+# number of times a block start is interpreted before it is translated
+_THRESHOLD = 8
+
+_return = re.compile(r"^(\s*)return (\d+)$")
+_store = re.compile(r"^\s*mem\[.*\] = ")
+_terminal = re.compile(r"self\.pc|self\.r\b|self\._enter_halt")
+
+# branches that can loop back to the start of a block
+_loops = ("jr", "jp", "djnz")
+
+# -----------------------------------------------------------------------------
+
+
+def _straight(text):
+    """return True if the instruction code falls through to the next instruction"""
+    lines = text.splitlines()
+    n = len([l for l in lines if "return" in l])
+    return n == 1 and _return.match(lines[-1]) and not _terminal.search(text)
+
+
+def _unsafe(text):
+    """return True if the instruction code raises an error"""
+    return "raise " in text or "assert " in text
+
+
+def _interpret(cpu, limit):
+    """execute the instruction at the pc without translating it"""
+    return cpu._execute()
+
+
+# -----------------------------------------------------------------------------
+
+
+class cache:
+    """translated block cache"""
+
+    def __init__(self, cpu, length=_MAX_LENGTH, threshold=_THRESHOLD):
+        self.cpu = cpu
+        self.mem = cpu.mem
+        self.length = length
+        if not 0 <= threshold <= 0xFFFF:
+            raise ValueError("threshold %d is not in 0..65535" % threshold)
+        self.threshold = threshold
+        # start address -> number of times it has been interpreted
+        self.counts = array.array("H", [0]) * 0x10000
+        # start address -> (block function, clock cycles before the last instruction)
+        self.blocks = [None] * 0x10000
+        # address -> start addresses of the blocks using it
+        self.users = [None] * 0x10000
+        # addresses (and their aliases) holding the bytes of a translated block
+        self.covered = bytearray(0x10000)
+        # instruction label -> (code, number of immediate bytes)
+        self.code = {}
+        # set by a write to a translated block, cleared by the block exit
+        self.modified = 0
+        self.globals = dict(type(cpu).execute.__globals__)
+        self.globals["_cache"] = self
+        self.executed = 0
+        self.translations = 0
+        self.invalidations = 0
+        self.mem.add_wr_hook(self.wr)
+
+    def close(self):
+        """detach the cache from the memory map"""
+        self.mem.remove_wr_hook(self.wr)
+
+    def flush(self):
+        """invalidate all blocks"""
+        self.blocks[:] = [None] * 0x10000
+        self.users[:] = [None] * 0x10000
+        self.covered[:] = bytes(0x10000)
+
+    def wr(self, adr):
+        """ram write hook - invalidate the blocks using adr"""
+        if self.covered[adr]:
+            blocks = self.blocks
+            for a in self.mem.aliases(adr):
+                self.covered[a] = 0
+                users = self.users[a]
+                if users is not None:
+                    for start in users:
+                        if blocks[start] is not None:
+                            blocks[start] = None
+                            self.invalidations += 1
+                    self.users[a] = None
+            self.modified = 1
+
+    def leave(self, adr, clks, remaining):
+        """return the code to leave a block early"""
+        lines = ["self.pc = 0x%04x" % adr, "_cache.modified = 0"]
+        if remaining:
+            lines.append("self.r = (self.r - %d) & 0x7f" % remaining)
+            lines.append("self.instructions -= %d" % remaining)
+        lines.append("return %s" % clks)
+        return lines
+
+    def translate(self, start):
+        """translate the block at start and return its cache entry"""
+        if self.counts[start] < self.threshold:
+            # not hot yet: interpret the first instruction
+            self.counts[start] += 1
+            return (_interpret, 0)
+        self.translations += 1
+        cpu = self.cpu
+        mem = self.mem
+        # (address, instruction bytes, code, clock cycles added by prefixes)
+        run = []
+        adr = start
+        while len(run) < self.length:
+            x = z80pd.fetch(cpu, adr, self.code)
+            if x is None or _unsafe(x[1]):
+                break
+            run.append((adr, x[0], x[1], x[2]))
+            adr = (adr + len(x[0])) & 0xFFFF
+            if not _straight(x[1]):
+                break
+        if not run:
+            # repeated prefix or unimplemented instruction: use the interpreter
+            entry = (_interpret, 0)
+            self.blocks[start] = entry
+            return entry
+        # a block that branches back to its start loops within the block function
+        (operation, operands, n) = cpu.da(run[-1][0])
+        loop = operation in _loops and operands.split(",")[-1] == "%04x" % start
+        total = ("%d", "clks + %d")[loop]
+        body = ["self.r = (self.r + %d) & 0x7f" % len(run), "self.instructions += %d" % len(run)]
+        clks = 0
+        for i, (adr, ins, text, extra) in enumerate(run):
+            lines = [l for l in text.splitlines() if l != "mem = self.mem"]
+            nxt = (adr + len(ins)) & 0xFFFF
+            last = clks
+            if not _straight(text):
+                # a control flow instruction: the pc is set as if it was executed alone
+                body.append("self.pc = 0x%04x" % nxt)
+                for l in lines:
+                    m = _return.match(l)
+                    if m is None:
+                        body.append(l)
+                        continue
+                    ws = m.group(1)
+                    if loop:
+                        body.append("%sclks += %d" % (ws, int(m.group(2)) + extra + clks))
+                        body.append("%sif self.pc != 0x%04x or clks + %d >= limit:" % (ws, start, last))
+                        body.append("%s    return clks" % ws)
+                        body.append("%scontinue" % ws)
+                    else:
+                        body.append("%sreturn %d" % (ws, int(m.group(2)) + extra + clks))
+                break
+            clks += int(_return.match(lines[-1]).group(2)) + extra
+            body.extend(lines[:-1])
+            if i == len(run) - 1:
+                body.extend(["self.pc = 0x%04x" % nxt, "return %d" % clks])
+            elif [l for l in lines if _store.match(l)]:
+                body.append("if _cache.modified:")
+                body.extend(["    %s" % l for l in self.leave(nxt, total % clks, len(run) - i - 1)])
+        if loop:
+            body = ["clks = 0", "while True:"] + ["    %s" % l for l in body]
+        body.insert(0, "mem = self.mem")
+        name = "_bt_%04x" % start
+        src = "def %s(self, limit):\n%s" % (name, "".join(["    %s\n" % l for l in body]))
+        ns = {}
+        exec(compile(src, "<z80bt %04x>" % start, "exec"), self.globals, ns)
+        entry = (ns[name], last)
+        self.blocks[start] = entry
+        # mark the ram locations that would invalidate this block
+        n = sum([len(x[1]) for x in run])
+        for i in range(n):
+            a = (start + i) & 0xFFFF
+            if isinstance(mem.select(a), memory.ram):
+                for x in mem.aliases(a):
+                    self.covered[x] = 1
+                    if self.users[x] is None:
+                        self.users[x] = [start]
+                    elif start not in self.users[x]:
+                        self.users[x].append(start)
+        return entry
+
+
+# -----------------------------------------------------------------------------
+
+
+def enable(cpu, length=_MAX_LENGTH, threshold=_THRESHOLD):
+    """attach a translated block cache to the cpu"""
+    if cpu.translator is None:
+        cpu.translator = cache(cpu, length, threshold)
+    return cpu.translator
+
+
+def disable(cpu):
+    """detach the translated block cache from the cpu"""
+    if cpu.translator is not None:
+        cpu.translator.close()
+        cpu.translator = None
+
+
+# -----------------------------------------------------------------------------
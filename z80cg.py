@@ -0,0 +1,227 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Call Graph Profiler
+
+Follows the emulated call stack and attributes clock cycles to routines. While
+the profiler is on, the cpu's opcode table is replaced by a table of wrapped
+handlers: every handler counts its clock cycles, and the call, rst and ret
+handlers also push and pop the profiler's call stack (reti and retn are not
+implemented by the cpu core). The interrupt method is wrapped as well, an
+accepted interrupt is a call to its vector.
+
+A routine is identified by its entry address (the call target). Each call
+stack frame records the stack pointer of its return address: a return pops
+the frames at or below the stack pointer it returns from, so routines that
+return through a modified stack (or never return) don't leave stale frames.
+The clock cycles of a call are credited to the caller, those of the return to
+the routine that returns.
+
+Reports give the number of calls, the inclusive clock cycles (the routine and
+everything it called, counted once for recursive calls) and the exclusive
+clock cycles of each routine. The collapsed stack file ("root;0038;013a 1234"
+lines of exclusive clock cycles) is the input format of flamegraph.pl and
+similar tools.
+
+Only the interpreter uses the opcode table, the predecode cache and the block
+translator are not profiled, and superinstruction dispatch skips the wrapped
+handlers.
+"""
+# -----------------------------------------------------------------------------
+
+import collections
+
+# -----------------------------------------------------------------------------
+
+# call nn, call cc,nn, rst n
+_calls = (0xCD, 0xC4, 0xCC, 0xD4, 0xDC, 0xE4, 0xEC, 0xF4, 0xFC, 0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF)
+
+# ret, ret cc
+_rets = (0xC9, 0xC0, 0xC8, 0xD0, 0xD8, 0xE0, 0xE8, 0xF0, 0xF8)
+
+# cpu methods that account for clock cycles outside the opcode handlers
+_methods = ("interrupt", "_halted", "_repeat")
+
+# call stack frame
+_ENTRY = 0
+_SP = 1
+_START = 2
+_CHILDREN = 3
+_PATH = 4
+
+# -----------------------------------------------------------------------------
+
+
+class profiler:
+    """call graph profiler"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # instance attributes replaced while profiling (None: the class attribute)
+        self.saved = None
+        # the original cpu methods
+        self.methods = {}
+        self.clear()
+
+    def clear(self):
+        """clear the statistics"""
+        # clock cycles counted since the profiler was cleared
+        self.now = 0
+        # routine entry -> [calls, inclusive, exclusive clock cycles]
+        self.stats = {}
+        # collapsed call stack -> exclusive clock cycles
+        self.stacks = collections.Counter()
+        # call stack frames: [entry, sp, start, clock cycles of the children, path]
+        self.frames = [[None, 0x10000, 0, 0, "root"]]
+
+    def enter(self, entry, sp):
+        """push a frame for a call to entry with the return address at sp"""
+        self.leave(sp, self.now)
+        parent = self.frames[-1]
+        self.frames.append([entry, sp, self.now, 0, "%s;%04x" % (parent[_PATH], entry)])
+
+    def leave(self, sp, now):
+        """pop the frames with a return address at or below sp"""
+        frames = self.frames
+        while len(frames) > 1 and frames[-1][_SP] <= sp:
+            close(frames, now, self.stats, self.stacks)
+
+    def wrap(self, fn, code):
+        """return the opcode handler wrapped to count clock cycles and follow the call stack"""
+
+        if code in _calls:
+
+            def call(cpu):
+                sp = cpu.sp
+                c = fn(cpu)
+                self.now += c
+                if cpu.sp != sp:
+                    self.enter(cpu.pc, cpu.sp)
+                return c
+
+            return call
+
+        if code in _rets:
+
+            def ret(cpu):
+                sp = cpu.sp
+                c = fn(cpu)
+                self.now += c
+                if cpu.sp != sp:
+                    self.leave(sp, self.now)
+                return c
+
+            return ret
+
+        def counted(cpu):
+            c = fn(cpu)
+            self.now += c
+            return c
+
+        return counted
+
+    def interrupt(self, x=0):
+        """cpu.interrupt() wrapper"""
+        cpu = self.cpu
+        c = self.methods["interrupt"](x)
+        self.now += c
+        if c:
+            self.enter(cpu.pc, cpu.sp)
+        return c
+
+    def _halted(self, tstates):
+        """cpu._halted() wrapper"""
+        c = self.methods["_halted"](tstates)
+        self.now += c
+        return c
+
+    def _repeat(self, left, stop=None):
+        """cpu._repeat() wrapper"""
+        # instructions executed by the idle loop detector are counted by their handlers
+        now = self.now
+        c = self.methods["_repeat"](left, stop)
+        self.now = now + c
+        return c
+
+    def on(self):
+        """replace the opcode table and the cpu methods with profiled versions"""
+        if self.saved is not None:
+            return
+        cpu = self.cpu
+        self.saved = {}
+        for name in ("opcodes",) + _methods:
+            self.saved[name] = cpu.__dict__.get(name)
+        for name in _methods:
+            self.methods[name] = getattr(cpu, name)
+            setattr(cpu, name, getattr(self, name))
+        cpu.opcodes = tuple([self.wrap(fn, code) for code, fn in enumerate(cpu.opcodes)])
+
+    def off(self):
+        """restore the original opcode table and cpu methods"""
+        if self.saved is None:
+            return
+        for name in ("opcodes",) + _methods:
+            if self.saved[name] is None:
+                delattr(self.cpu, name)
+            else:
+                setattr(self.cpu, name, self.saved[name])
+        self.saved = None
+
+    def enabled(self):
+        """return True if the profiler is on"""
+        return self.saved is not None
+
+    def results(self):
+        """return (routine statistics, collapsed stacks) with the open frames closed now"""
+        stats = dict([(entry, list(x)) for entry, x in self.stats.items()])
+        stacks = collections.Counter(self.stacks)
+        frames = [list(f) for f in self.frames]
+        while frames:
+            close(frames, self.now, stats, stacks)
+        return (stats, stacks)
+
+    def routines(self):
+        """return a list of (entry, calls, inclusive, exclusive), by decreasing inclusive clock cycles"""
+        (stats, stacks) = self.results()
+        routines = [(entry, calls, incl, excl) for entry, (calls, incl, excl) in stats.items() if entry is not None]
+        routines.sort(key=lambda x: x[2], reverse=True)
+        return routines
+
+    def report(self, n=20):
+        """return a report of the n routines with the most inclusive clock cycles"""
+        total = self.now or 1
+        s = ["%-5s %8s %12s %7s %12s %7s" % ("entry", "calls", "inclusive", "%", "exclusive", "%")]
+        for entry, calls, incl, excl in self.routines()[:n]:
+            s.append("%04x  %8d %12d %7.2f %12d %7.2f" % (entry, calls, incl, (100.0 * incl) / total, excl, (100.0 * excl) / total))
+        s.append("%d clock cycles, call depth %d" % (self.now, len(self.frames) - 1))
+        return "\n".join(s)
+
+    def save(self, fname):
+        """write the collapsed call stacks (exclusive clock cycles) to a file"""
+        (stats, stacks) = self.results()
+        f = open(fname, "w")
+        for path, clks in sorted(stacks.items()):
+            if clks:
+                f.write("%s %d\n" % (path, clks))
+        f.close()
+
+
+# -----------------------------------------------------------------------------
+
+
+def close(frames, now, stats, stacks):
+    """pop the top call stack frame and account for its clock cycles"""
+    (entry, sp, start, children, path) = frames.pop()
+    inclusive = now - start
+    exclusive = inclusive - children
+    x = stats.setdefault(entry, [0, 0, 0])
+    x[0] += 1
+    x[2] += exclusive
+    # only the outermost call of a recursive routine counts towards its inclusive clock cycles
+    if entry not in [f[_ENTRY] for f in frames]:
+        x[1] += inclusive
+    stacks[path] += exclusive
+    if frames:
+        frames[-1][_CHILDREN] += inclusive
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,97 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Breakpoint Conditions
+
+A condition is a Python expression over the cpu registers and memory, e.g.
+
+    a == 0x20 and mem[hl] > 3
+
+It is parsed once and checked: only integer constants, the register names
+below, mem[...] and arithmetic, bitwise, comparison and boolean operators are
+allowed. The register names are rewritten to cpu attribute reads (register
+pairs to the combined 16 bit value), mem[...] to mem.peek(...) so the
+watchpoints don't see the reads, and the expression is compiled to a
+function f(cpu, mem), so a breakpoint hit is a single function call.
+"""
+# -----------------------------------------------------------------------------
+
+import ast
+
+# -----------------------------------------------------------------------------
+
+# registers that are cpu attributes
+_regs = (
+    "a", "f", "b", "c", "d", "e", "h", "l", "i", "r", "im", "iff1", "iff2",
+    "ix", "iy", "sp", "pc", "alt_af", "alt_bc", "alt_de", "alt_hl",
+)
+
+# register pairs: (high, low)
+_pairs = {"af": ("a", "f"), "bc": ("b", "c"), "de": ("d", "e"), "hl": ("h", "l")}
+
+# allowed syntax
+_nodes = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.Invert, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.BitAnd, ast.BitOr, ast.BitXor,
+    ast.LShift, ast.RShift, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.Constant, ast.Name, ast.Subscript, ast.Load,
+)
+
+# -----------------------------------------------------------------------------
+
+
+def _reg(name):
+    """return the ast for reading a cpu register attribute"""
+    return ast.Attribute(value=ast.Name(id="cpu", ctx=ast.Load()), attr=name, ctx=ast.Load())
+
+
+class _rewrite(ast.NodeTransformer):
+    """rewrite register names to cpu attribute reads and memory reads to peeks"""
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        peek = ast.Attribute(value=node.value, attr="peek", ctx=ast.Load())
+        return ast.copy_location(ast.Call(func=peek, args=[node.slice], keywords=[]), node)
+
+    def visit_Name(self, node):
+        if node.id in _pairs:
+            (hi, lo) = _pairs[node.id]
+            x = ast.BinOp(left=ast.BinOp(left=_reg(hi), op=ast.LShift(), right=ast.Constant(8)), op=ast.BitOr(), right=_reg(lo))
+        elif node.id in _regs:
+            x = _reg(node.id)
+        else:
+            return node
+        return ast.copy_location(x, node)
+
+
+def check(tree):
+    """raise ValueError if the expression tree uses anything but the allowed syntax"""
+    for node in ast.walk(tree):
+        if not isinstance(node, _nodes):
+            raise ValueError("%s is not allowed" % type(node).__name__)
+        if isinstance(node, ast.Constant) and type(node.value) is not int:
+            raise ValueError("%r is not an integer" % node.value)
+        if isinstance(node, ast.Name) and node.id not in _regs + tuple(_pairs) + ("mem",):
+            raise ValueError("unknown name %s" % node.id)
+        if isinstance(node, ast.Subscript) and not (isinstance(node.value, ast.Name) and node.value.id == "mem"):
+            raise ValueError("only mem can be indexed")
+
+
+def condition(expr):
+    """return a function f(cpu, mem) that evaluates the condition expression"""
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError("syntax error: %s" % e.msg)
+    check(tree)
+    tree = _rewrite().visit(tree)
+    fn = ast.Expression(
+        body=ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[ast.arg(arg="cpu"), ast.arg(arg="mem")], kwonlyargs=[], kw_defaults=[], defaults=[]),
+            body=tree.body,
+        )
+    )
+    ast.fix_missing_locations(fn)
+    return eval(compile(fn, "<condition %s>" % expr, "eval"), {"__builtins__": {}})
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,96 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 CPU Core Build Cache
+
+A cpu core module is the template (z80th.py) followed by the opcode emulation
+code generated by z80gen.py. load() returns a core module for a set of
+generator options. The generated source and its byte code are cached, keyed
+by a hash of the generator options and the contents of the files the
+generator reads. A core is only regenerated and byte-compiled when the hash
+changes, so edits to the generator or the template always take effect and an
+unchanged core loads from the cache.
+"""
+# -----------------------------------------------------------------------------
+
+import os
+import hashlib
+import tempfile
+import py_compile
+import importlib.util
+import z80gen
+
+# -----------------------------------------------------------------------------
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+
+# the source files read by the generator
+_inputs = ("z80gen.py", "z80th.py", "z80da.py", "memory.py")
+
+# default cache directory
+_CACHE = os.path.join(_dir, "__pycache__", "z80core")
+
+# -----------------------------------------------------------------------------
+
+
+def key(options, seq=None):
+    """return the cache key for the generator options and the sequence profile"""
+    h = hashlib.sha256(repr(sorted(options.items())).encode())
+    for fname in _inputs + ((seq,), ())[seq is None]:
+        h.update(open(os.path.join(_dir, fname), "rb").read())
+    return h.hexdigest()[:16]
+
+
+def build(fname, options):
+    """generate the core module source and byte code"""
+    (fd, bh) = tempfile.mkstemp(suffix=".py", dir=os.path.dirname(fname))
+    os.close(fd)
+    try:
+        z80gen.generate(bh, **options)
+        body = open(bh).read()
+        f = open(bh, "w")
+        f.write(open(os.path.join(_dir, "z80th.py")).read())
+        f.write(body)
+        f.close()
+        # write the byte code first: the source only appears once the build is complete
+        py_compile.compile(bh, cfile=importlib.util.cache_from_source(fname), dfile=fname, doraise=True)
+        os.replace(bh, fname)
+    finally:
+        if os.path.exists(bh):
+            os.remove(bh)
+
+
+def remove(fname):
+    """remove a cached core module"""
+    os.remove(fname)
+    pyc = importlib.util.cache_from_source(fname)
+    if os.path.exists(pyc):
+        os.remove(pyc)
+
+
+def load(name, profile="accurate", seq=None, n=z80gen._SEQUENCES, cache=_CACHE, **options):
+    """
+    Return the cpu core module for a z80gen profile and options.
+    seq: sequence profile file (relative to this directory), the top n sequences are fused
+    """
+    options = dict(z80gen.profiles[profile], **options)
+    if seq is not None:
+        options["n"] = n
+    k = key(options, seq)
+    fname = os.path.join(cache, "%s_%s.py" % (name, k))
+    if not os.path.exists(fname):
+        os.makedirs(cache, exist_ok=True)
+        if seq is not None:
+            options["sequences"] = z80gen.read_profile(os.path.join(_dir, seq), options.pop("n"))
+        build(fname, options)
+        # remove the stale builds of this core
+        base = os.path.basename(fname)
+        for x in os.listdir(cache):
+            if x.startswith("%s_" % name) and len(x) == len(base) and x != base:
+                remove(os.path.join(cache, x))
+    spec = importlib.util.spec_from_file_location(name, fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# -----------------------------------------------------------------------------
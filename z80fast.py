@@ -0,0 +1,15 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 CPU Emulation - fast profile
+
+Importing this module loads the cpu core generated with the fast z80gen
+profile and the superinstructions for the Jupiter ACE rom (see z80core.py).
+"""
+# -----------------------------------------------------------------------------
+
+import sys
+import z80core
+
+sys.modules[__name__] = z80core.load(__name__, profile="fast", seq="roms/ace.seq")
+
+# -----------------------------------------------------------------------------
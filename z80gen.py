@@ -4,6 +4,9 @@ Z80 Opcode Emulation Generator
 """
 # -----------------------------------------------------------------------------
 
+import os
+import io
+import re
 import sys
 import getopt
 import z80da
@@ -62,6 +65,18 @@ class output:
         self.lhs -= n * _indent
 
 
+class output_buffer(output):
+    """class for handling string buffer output with auto indenting"""
+
+    def __init__(self):
+        self.ofile = io.StringIO()
+        self.lhs = 0
+        self.col = 0
+
+    def getvalue(self):
+        return self.ofile.getvalue()
+
+
 # -----------------------------------------------------------------------------
 
 _r = ("b", "c", "d", "e", "h", "l", "(hl)", "a")
@@ -255,6 +270,7 @@ def emit_ldxx(out, op):
     out.put("    self.f |= _VF\n")
     if op in ("ldir", "lddr"):
         out.put("    self._dec_pc(2)\n")
+        out.put("    self.stop = 1\n")
         out.put("    return 17\n")
     out.put("return 12\n")
 
@@ -277,15 +293,60 @@ def emit_cpxx(out, op):
     out.put("    self.f |= _XF\n")
     out.put("self._set_hl(s %s 1)\n" % dirn)
     out.put("self._set_bc(n)\n")
-    if op in ("cpi", "cpd"):
-        out.put("if n:\n")
-        out.put("    self.f |= _VF\n")
-        out.put("return 12\n")
-    else:
-        out.put("if n and (self.f & _ZF == 0):\n")
+    out.put("if n:\n")
+    out.put("    self.f |= _VF\n")
+    if op in ("cpir", "cpdr"):
+        out.put("    if not (self.f & _ZF):\n")
+        out.put("        self._dec_pc(2)\n")
+        out.put("        self.stop = 1\n")
+        out.put("        return 17\n")
+    out.put("return 12\n")
+
+
+def emit_io_flags(out):
+    """flags for ini, ind, outi, outd: val is the byte transferred"""
+    out.put("self.f = self.f_sz[self.b]\n")
+    out.put("if val & _SF:\n")
+    out.put("    self.f |= _NF\n")
+    out.put("if t & 0x100:\n")
+    out.put("    self.f |= (_HF | _CF)\n")
+    out.put("self.f |= (self.f_szp[(t & 0x07) ^ self.b] & _PF)\n")
+
+
+def emit_inxx(out, op):
+    """ini, inir, ind, indr"""
+    dirn = ("-", "+")[op in ("ini", "inir")]
+    out.put("val = self.io.rd(self._get_bc())\n")
+    out.put("self.b = (self.b - 1) & 0xFF\n")
+    out.put("s = self._get_hl()\n")
+    out.put("self.mem[s] = val\n")
+    out.put("self._set_hl(s %s 1)\n" % dirn)
+    out.put("t = ((self.c %s 1) & 0xFF) + val\n" % dirn)
+    emit_io_flags(out)
+    if op in ("inir", "indr"):
+        out.put("if self.b:\n")
+        out.put("    self._dec_pc(2)\n")
+        out.put("    self.stop = 1\n")
+        out.put("    return 17\n")
+    out.put("return 12\n")
+
+
+def emit_outxx(out, op):
+    """outi, otir, outd, otdr"""
+    dirn = ("-", "+")[op in ("outi", "otir")]
+    out.put("s = self._get_hl()\n")
+    out.put("val = self.mem[s]\n")
+    out.put("self.b = (self.b - 1) & 0xFF\n")
+    out.put("self.io.wr(self._get_bc(), val)\n")
+    out.put("self._set_hl(s %s 1)\n" % dirn)
+    out.put("t = self.l + val\n")
+    emit_io_flags(out)
+    if op in ("otir", "otdr"):
+        out.put("if self.b:\n")
         out.put("    self._dec_pc(2)\n")
+        out.put("    self.stop = 1\n")
         out.put("    return 17\n")
-        out.put("return 12\n")
+    out.put("return 12\n")
 
 
 def emit_bli(out, op):
@@ -294,25 +355,11 @@ def emit_bli(out, op):
         return emit_ldxx(out, op)
     if op in ("cpi", "cpir", "cpd", "cpdr"):
         return emit_cpxx(out, op)
-
-    if op == "ini":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "ind":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "inir":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "indr":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "outi":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "outd":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "otir":
-        out.put("assert False, 'unimplemented instruction'\n")
-    elif op == "otdr":
-        out.put("assert False, 'unimplemented instruction'\n")
-    else:
-        assert False
+    if op in ("ini", "inir", "ind", "indr"):
+        return emit_inxx(out, op)
+    if op in ("outi", "otir", "outd", "otdr"):
+        return emit_outxx(out, op)
+    assert False
 
 
 def emit_ex_mem_sp_r(out, r):
@@ -501,36 +548,9 @@ def emit_halt(out):
 
 def emit_daa(out):
     """daa"""
-    out.put("cf = bool(self.f & _CF)\n")
-    out.put("nf = bool(self.f & _NF)\n")
-    out.put("hf = bool(self.f & _HF)\n")
-    out.put("lo = self.a & 0x0f\n")
-    out.put("hi = self.a >> 4\n")
-    out.put("if cf:\n")
-    out.put("    diff = (0x66, 0x60)[(lo <= 9) and (not hf)]\n")
-    out.put("else:\n")
-    out.put("    if lo >= 10:\n")
-    out.put("        diff = (0x66, 0x06)[hi <= 8]\n")
-    out.put("    else:\n")
-    out.put("        if hi >= 10:\n")
-    out.put("            diff = (0x60, 0x66)[hf]\n")
-    out.put("        else:\n")
-    out.put("            diff = (0x00, 0x06)[hf]\n")
-    out.put("if nf:\n")
-    out.put("    self.a = (self.a - diff) & 0xff\n")
-    out.put("else:\n")
-    out.put("    self.a = (self.a + diff) & 0xff\n")
-    out.put("self.f = self.f_szp[self.a] | (self.f & _NF)\n")
-    out.put("if cf:\n")
-    out.put("    self.f |= _CF\n")
-    out.put("if (lo <= 9) and (hi >= 10):\n")
-    out.put("    self.f |= _CF\n")
-    out.put("if (lo > 9) and (hi >= 9):\n")
-    out.put("    self.f |= _CF\n")
-    out.put("if nf and hf and (lo <= 5):\n")
-    out.put("    self.f |= _HF\n")
-    out.put("if (not nf) and (lo >= 10):\n")
-    out.put("    self.f |= _HF\n")
+    out.put("v = self.daa_af[(((self.f & (_CF | _NF)) | ((self.f & _HF) >> 2)) << 8) | self.a]\n")
+    out.put("self.a = v >> 8\n")
+    out.put("self.f = v & 0xff\n")
     out.put("return 4\n")
 
 
@@ -1425,10 +1445,10 @@ def emit_triple_quote(out, comment):
 
 
 def emit_opcode_table(out, idic, prefix, links, preamble):
-    """emit a function table for each opcode with this prefix"""
-    out.indent(2)
+    """emit a class level function table for each opcode with this prefix"""
+    out.indent(1)
     label = "_%s" % "".join(["%02x" % byte for byte in prefix])
-    out.put("self.opcodes%s = (\n" % (label, "")[len(label) == 1])
+    out.put("opcodes%s = (\n" % (label, "")[len(label) == 1])
     out.indent(1)
 
     for opcode in range(0x100):
@@ -1443,36 +1463,517 @@ def emit_opcode_table(out, idic, prefix, links, preamble):
         label = "".join(["%02x" % byte for byte in code])
 
         if opcode in links:
-            out.put("self._execute_%s," % label)
+            out.put("_execute_%s," % label)
             out.pad(36)
             out.put("# 0x%02x execute %s prefix\n" % (opcode, label))
         else:
             # add the inst/label to the dictionary if it is unique
             if not inst in idic:
                 idic[inst] = (label, code, preamble)
-            out.put("self._ins_%s," % idic[inst][0])
+            out.put("_ins_%s," % idic[inst][0])
             out.pad(36)
             out.put("# 0x%02x %s\n" % (opcode, inst))
 
     out.outdent(1)
     out.put(")\n")
+    out.outdent(1)
+
+
+# -----------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------
+# Inlining
+#
+# The emit functions generate code in terms of the cpu helper methods.
+# The inlining pass rewrites the code for an instruction so that it does not
+# call the helpers. Immediate operands are read relative to a local copy of
+# the pc (which is advanced once, at the top of the function) and self.mem is
+# cached in a local.
+
+_pairs = {"af": ("a", "f"), "bc": ("b", "c"), "de": ("d", "e"), "hl": ("h", "l")}
+
+
+def call_args(s, i):
+    """s[i] is "(" - return (index after the matching ")", argument string)"""
+    depth = 0
+    for j in range(i, len(s)):
+        if s[j] == "(":
+            depth += 1
+        elif s[j] == ")":
+            depth -= 1
+            if depth == 0:
+                return (j + 1, s[i + 1 : j])
+    assert False, "unbalanced parentheses"
+
+
+def split_args(args):
+    """split an argument string at the top level commas"""
+    depth = 0
+    for i, c in enumerate(args):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            return (args[:i].strip(), args[i + 1 :].strip())
+    return (args.strip(),)
+
+
+def expand_call(s, name, fn):
+    """replace all calls to name in s with the expression returned by fn(args)"""
+    i = s.find(name + "(")
+    while i >= 0:
+        (j, args) = call_args(s, i + len(name))
+        x = fn(args)
+        s = s[:i] + x + s[j:]
+        i = s.find(name + "(", i + len(x))
+    return s
+
+
+def simple(x):
+    """return True if x can be evaluated more than once at no cost"""
+    return x.replace(".", "").replace("_", "").isalnum()
+
+
+def inline_fetch(lines, imm=None):
+    """
+    Replace immediate operand fetches with reads relative to a local pc.
+    If the immediate bytes are given in imm, replace the fetches with constants.
+    """
+    out = []
+    k = 0
+    for l in lines:
+        assert (l.count("self._get_n()") + l.count("self._get_nn()")) <= 1
+        if "self._get_nn()" in l:
+            if imm is None:
+                x = "((mem[pc + %d] << 8) | mem[pc + %d])" % (k + 1, k)
+                x = x.replace("pc + 0]", "pc]")
+            else:
+                x = "0x%04x" % ((imm[k + 1] << 8) | imm[k])
+            l = l.replace("self._get_nn()", x)
+            k += 2
+        elif "self._get_n()" in l:
+            if imm is None:
+                x = ("mem[pc + %d]" % k).replace("pc + 0]", "pc]")
+            else:
+                x = "0x%02x" % imm[k]
+            l = l.replace("self._get_n()", x)
+            k += 1
+        out.append(l)
+    if k and imm is None:
+        out[0:0] = ["pc = self.pc", "self.pc = (pc + %d) & 0xffff" % k]
+    return out
+
+
+def inline_statement(l):
+    """return a list of lines replacing a helper call statement"""
+    stripped = l.lstrip()
+    ws = l[: len(l) - len(stripped)]
+    lines = [stripped]
+    for rp, (hi, lo) in _pairs.items():
+        name = "self._set_%s(" % rp
+        if stripped.startswith(name):
+            val = call_args(stripped, len(name) - 1)[1]
+            lines = []
+            if not simple(val):
+                lines.append("rp = %s" % val)
+                val = "rp"
+            lines.append("self.%s = (%s >> 8) & 0xff" % (hi, val))
+            lines.append("self.%s = %s & 0xff" % (lo, val))
+    if stripped.startswith("self._push("):
+        val = call_args(stripped, len("self._push"))[1]
+        lines = [
+            "sp = self.sp",
+            "mem[sp - 1] = %s >> 8" % val,
+            "mem[sp - 2] = %s & 0xff" % val,
+            "self.sp = (sp - 2) & 0xffff",
+        ]
+    elif stripped.endswith(" = self._pop()"):
+        lines = [
+            "sp = self.sp",
+            "%s = (mem[sp + 1] << 8) | mem[sp]" % stripped[: -len(" = self._pop()")],
+            "self.sp = (sp + 2) & 0xffff",
+        ]
+    elif stripped.startswith("self._poke("):
+        (adr, val) = split_args(call_args(stripped, len("self._poke"))[1])
+        lines = [
+            "mem[%s + 1] = %s >> 8" % (adr, val),
+            "mem[%s] = %s & 0xff" % (adr, val),
+        ]
+    elif stripped.startswith("self._inc_pc("):
+        val = call_args(stripped, len("self._inc_pc"))[1]
+        lines = ["self.pc = (self.pc + %s) & 0xffff" % val]
+    elif stripped.startswith("self._dec_pc("):
+        val = call_args(stripped, len("self._dec_pc"))[1]
+        lines = ["self.pc = (self.pc - %s) & 0xffff" % val]
+    return [ws + x for x in lines]
+
+
+def inline_expression(l):
+    """replace helper call expressions with inline code"""
+    for rp, (hi, lo) in _pairs.items():
+        l = l.replace("self._get_%s()" % rp, "((self.%s << 8) | self.%s)" % (hi, lo))
+    l = expand_call(l, "self._peek", lambda x: "((mem[%s + 1] << 8) | mem[%s])" % (x, x))
+    l = expand_call(l, "_signed", lambda x: "((%s ^ 0x80) - 0x80)" % x)
+    return l
+
+
+def inline(code, imm=None):
+    """return the code for an instruction with the cpu helper calls inlined"""
+    lines = inline_fetch(code.splitlines(), imm)
+    lines = [x for l in lines for x in inline_statement(l)]
+    lines = [inline_expression(l) for l in lines]
+    lines = [l.replace("self.mem[", "mem[") for l in lines]
+    if [l for l in lines if "mem[" in l]:
+        lines.insert(0, "mem = self.mem")
+    return "".join(["%s\n" % l for l in lines])
+
+
+# -----------------------------------------------------------------------------
+# ALU tables
+#
+# The flags for the 8 bit add, adc, sub, sbc and cp operations are read from
+# tables indexed by (carry << 16) | (a << 8) | operand instead of being
+# computed by the cpu._add_flags and cpu._sub_flags helpers.
+
+_alu_flags = {
+    "self._add_flags(result, val)": "self.f_add",
+    "self._sub_flags(result, val)": "self.f_sub",
+}
+
+
+def alu_tables(code):
+    """return the code for an instruction with the add and sub flags read from tables"""
+    lines = code.splitlines()
+    for i, l in enumerate(lines):
+        stripped = l.lstrip()
+        if stripped in _alu_flags:
+            ws = l[: len(l) - len(stripped)]
+            index = "(self.a << 8) | val"
+            if lines[i - 1].endswith(" (self.f & _CF)"):
+                index = "((self.f & _CF) << 16) | %s" % index
+            lines[i] = "%sself.f = %s[%s]" % (ws, _alu_flags[stripped], index)
+    # cp does not use the result
+    if len([l for l in lines if "result" in l]) == 1:
+        lines = [l for l in lines if "result" not in l]
+    return "".join(["%s\n" % l for l in lines])
+
+
+# -----------------------------------------------------------------------------
+# Lazy flags
+#
+# The 8 bit add and sub operations (add, adc, sub, sbc, cp, neg) record their
+# operands in self.lazy instead of computing the flags. The flags are stored
+# in self._f and the f property evaluates any pending flags when it is read.
+# The instruction code uses self._f directly: tests of the zero, carry and
+# sign flags are made on the pending result, other code that reads the flags
+# evaluates them first and code that overwrites them discards the pending
+# operation.
+
+_f = re.compile(r"self\.f\b")
+_f_test = re.compile(r"self\.f & (_ZF|_CF|_SF)(?=[):])")
+_lazy_ops = (("self._add_flags(", 1), ("self._sub_flags(", 2))
+_lazy_tests = {
+    "_ZF": "not (lazy[2] & 0xff)",
+    "_CF": "(lazy[2] >> 8) & 1",
+    "_SF": "lazy[2] & 0x80",
+}
+
+
+def lazy_test(m):
+    """return a flag test made on the pending operation if there is one"""
+    return "(%s if lazy else self._f & %s)" % (_lazy_tests[m.group(1)], m.group(1))
+
+
+def lazy_flags(code):
+    """return the code for an instruction with lazy flag evaluation"""
+    lines = []
+    for l in code.splitlines():
+        for name, op in _lazy_ops:
+            if l.lstrip().startswith(name):
+                (res, val) = split_args(call_args(l, l.index(name) + len(name) - 1)[1])
+                l = "%sself.lazy = (%d, self.a, %s, %s)" % (l[: l.index(name)], op, res, val)
+        lines.append(l)
+    writes = [l for l in lines if l.startswith("self.f = ") and not _f.search(l[len("self.f = ") :])]
+    reads = [l for l in lines if _f.search(l) and l not in writes]
+    prologue = []
+    if reads and not [l for l in reads if _f.search(_f_test.sub("", l))]:
+        # the flags are only tested
+        prologue = ["lazy = self.lazy"]
+        lines = [_f_test.sub(lazy_test, l) for l in lines]
+    elif reads:
+        prologue = ["if self.lazy:", "    self._lazy_flags()"]
+    elif writes:
+        prologue = ["self.lazy = None"]
+    lines = prologue + [_f.sub("self._f", l) for l in lines]
+    return "".join(["%s\n" % l for l in lines])
+
+
+def emit_lazy_flags(out):
+    """emit the f property and the lazy flag evaluation"""
+    out.indent(1)
+    out.put("def _lazy_flags(self):\n")
+    out.indent(1)
+    out.put('"""evaluate the flags for the pending add or sub operation"""\n')
+    out.put("(op, a, res, val) = self.lazy\n")
+    out.put("self.lazy = None\n")
+    out.put("f = self.f_sz[res & 0xff] | ((res >> 8) & _CF) | ((a ^ res ^ val) & _HF)\n")
+    out.put("if op == 1:\n")
+    out.put("    f |= ((val ^ a ^ 0x80) & (val ^ res) & 0x80) >> 5\n")
+    out.put("else:\n")
+    out.put("    f |= _NF | (((val ^ a) & (a ^ res) & 0x80) >> 5)\n")
+    out.put("self._f = f\n")
+    out.outdent(1)
+    out.put("\n")
+    out.put("def _get_f(self):\n")
+    out.indent(1)
+    out.put("if self.lazy:\n")
+    out.put("    self._lazy_flags()\n")
+    out.put("return self._f\n")
+    out.outdent(1)
+    out.put("\n")
+    out.put("def _set_f(self, val):\n")
+    out.indent(1)
+    out.put("self.lazy = None\n")
+    out.put("self._f = val\n")
+    out.outdent(1)
+    out.put("\n")
+    out.put("f = property(_get_f, _set_f)\n")
+    out.outdent(1)
+
+
+# -----------------------------------------------------------------------------
+# Undocumented flags
+#
+# Without undocumented flag emulation the block, rotate, cpl, scf and ccf
+# instructions don't compute the X and Y flag bits (bits 3 and 5 of f), they
+# are left clear. The flags set from the lookup tables are not affected.
+
+_xy_if = ("self.f |= _YF", "self.f |= _XF", "res -= 1")
+_xy_term = re.compile(r" \| \((self\.)?\w+ & \(_YF \| _XF\)\)")
+
+
+def documented_flags(code):
+    """return the code for an instruction without the undocumented flag computations"""
+    lines = code.splitlines()
+    out = []
+    i = 0
+    while i < len(lines):
+        l = lines[i]
+        if l.lstrip().startswith("if ") and i + 1 < len(lines) and lines[i + 1].strip() in _xy_if:
+            i += 2
+            continue
+        i += 1
+        if l.strip() == "self.f |= (self.a & (_YF | _XF))":
+            continue
+        l = l.replace("(self.a & (_YF | _XF | _CF))", "(self.a & _CF)")
+        out.append(_xy_term.sub("", l))
+    return "".join(["%s\n" % l for l in out])
+
+
+# -----------------------------------------------------------------------------
+# Memory refresh
+#
+# Without per instruction memory refresh the interpreter run loops don't
+# increment r for each instruction, r is advanced by the number of
+# instructions executed when the run loop returns. The run loops from the
+# template (z80th.py) are emitted again with that change: the generated code
+# follows the template in the cpu class body, so they replace the originals.
+
+_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "z80th.py")
+_run_loops = ("_run", "_run_until", "_run_break", "_run_trace")
+_refresh = "self.r = (self.r + 1) & 0x7F\n"
+_count = "self.instructions += n\n"
+
+
+def emit_run_loops(out):
+    """emit the template run loops with r advanced once per run"""
+    text = open(_template).read()
+    for name in _run_loops:
+        m = re.search(r"^    def %s\(.*?(?=^    def )" % name, text, re.M | re.S)
+        code = m.group(0)
+        assert code.count(_refresh) == 1 and code.count(_count) == 1
+        code = re.sub(r" *%s" % re.escape(_refresh), "", code)
+        ws = code[code.index(_count) - 12 : code.index(_count)]
+        code = code.replace(_count, "%s%sself.r = (self.r + n) & 0x7F\n" % (_count, ws))
+        out.put(code)
+
+
+# -----------------------------------------------------------------------------
+# Profiles
+#
+# A profile is a named set of generator options:
+# accurate: the full emulation (the default)
+# fast: no undocumented flags and no per instruction memory refresh
+# (lazy flags are slower than the alu flag tables, so fast doesn't use them)
+
+profiles = {
+    "accurate": {},
+    "fast": {"undocumented": False, "refresh": False},
+}
+
+
+# -----------------------------------------------------------------------------
+# Superinstructions
+#
+# A sequence profile counts the instruction sequences executed by a workload,
+# one sequence per line: the count, then the opcode bytes of each instruction
+# (prefix and opcode, without the operands) in hex, e.g. "1864 2f e6 57".
+# The most executed sequences that can be fused are emitted as a single
+# handler. The handler is entered with the pc after the first opcode byte
+# (as the interpreter calls the opcode table), executes the whole sequence
+# with the same results as executing it one instruction at a time, and returns
+# the total number of clock cycles. It advances r and the instruction count
+# for all but the first instruction (the run loop accounts for that one).
+#
+# Only unprefixed, cb and ed instructions are fused. The instructions before
+# the last one must fall through to the next instruction and must not write
+# memory (so they can't modify the following instructions) or use r. The
+# last instruction can be anything except an unimplemented instruction.
+#
+# The superinstructions table lists (instruction opcode bytes, handler, clock
+# cycles before the last instruction starts). z80si.py installs dispatchers
+# that call a handler when the bytes at the pc match.
+
+# clock cycles added by a prefix
+_prefix_clks = {0xCB: 4, 0xED: 4}
+
+_si_return = re.compile(r"^return (\d+)$")
+_si_terminal = re.compile(r"self\.pc|_pc\(|self\.stop|_enter_halt|self\.r\b|raise |self\._push\(|self\._poke\(|mem\[.*\] = ")
+
+
+def read_profile(fname, n):
+    """return the n most executed sequences from a sequence profile that can be fused"""
+    counts = []
+    for l in open(fname):
+        x = l.split()
+        if len(x) > 2:
+            counts.append((int(x[0]), tuple([bytes.fromhex(op) for op in x[1:]])))
+    # prefer the sequences that save the most run loop iterations
+    counts.sort(key=lambda x: x[0] * (len(x[1]) - 1), reverse=True)
+    return [seq for _, seq in counts if fusable(seq)][:n]
+
+
+def fusable(seq):
+    """return True if the instruction sequence can be fused"""
+    for i, op in enumerate(seq):
+        if op[0] in (0xDD, 0xFD) or len(op) != (1, 2)[op[0] in _prefix_clks]:
+            return False
+        text = instruction_code(list(op))
+        if "raise " in text:
+            return False
+        if i < len(seq) - 1:
+            lines = text.splitlines()
+            if _si_terminal.search(text) or [l for l in lines[:-1] if "return" in l] or not _si_return.match(lines[-1]):
+                return False
+    return True
+
+
+def si_name(seq):
+    """return the handler name for an instruction sequence"""
+    return "_si_%s" % "_".join([op.hex() for op in seq])
+
+
+def emit_superinstruction(out, seq, inlined=True, lazy=False, undocumented=True):
+    """emit a fused handler for an instruction sequence, return the clock cycles before the last instruction"""
+    body = ["self.r = (self.r + %d) & 0x7F" % (len(seq) - 1), "self.instructions += %d" % (len(seq) - 1)]
+    clks = 0
+    for i, op in enumerate(seq):
+        # skip the opcode bytes that weren't fetched by the run loop
+        skip = (len(op), len(op) - 1)[i == 0]
+        if skip:
+            body.append("self.pc = (self.pc + %d) & 0xFFFF" % skip)
+        lines = rewrite(instruction_code(list(op)), None, inlined, lazy, undocumented).splitlines()
+        if "mem = self.mem" in body:
+            lines = [l for l in lines if l != "mem = self.mem"]
+        extra = _prefix_clks.get(op[0], 0)
+        if i < len(seq) - 1:
+            clks += int(_si_return.match(lines[-1]).group(1)) + extra
+            body.extend(lines[:-1])
+            continue
+        last = clks
+        for l in lines:
+            m = re.match(r"^(\s*)return (\d+)$", l)
+            if m:
+                l = "%sreturn %d" % (m.group(1), int(m.group(2)) + extra + clks)
+            body.append(l)
+    out.indent(1)
+    out.put("def %s(self): # %s\n" % (si_name(seq), " ".join([op.hex() for op in seq])))
+    out.indent(1)
+    out.put("".join(["%s\n" % l for l in body]))
     out.outdent(2)
+    return last
+
+
+def emit_superinstructions(out, sequences, inlined=True, lazy=False, undocumented=True):
+    """emit the fused handlers and the superinstructions table"""
+    table = []
+    for seq in sequences:
+        last = emit_superinstruction(out, seq, inlined, lazy, undocumented)
+        table.append("(%r, %s, %d)," % (tuple([op.hex() for op in seq]), si_name(seq), last))
+    out.indent(1)
+    out.put("superinstructions = (\n")
+    out.indent(1)
+    out.put("".join(["%s\n" % l for l in table]))
+    out.outdent(1)
+    out.put(")\n")
+    out.outdent(1)
 
 
 # -----------------------------------------------------------------------------
 
 
-def emit_instruction_function(out, instruction, x):
+def rewrite(code, imm=None, inlined=True, lazy=False, undocumented=True):
+    """apply the rewriting passes for the generator options to the code for an instruction"""
+    if not undocumented:
+        code = documented_flags(code)
+    if not lazy:
+        code = alu_tables(code)
+    if inlined or imm is not None:
+        code = inline(code, imm)
+    if lazy:
+        code = lazy_flags(code)
+    return code
+
+
+# -----------------------------------------------------------------------------
+
+
+def emit_instruction_function(out, instruction, x, inlined=True, lazy=False, undocumented=True):
     """emit the functon header and code for an instruction"""
     (label, code, preamble) = x
     out.indent(1)
     out.put("def _ins_%s%s # %s\n" % (label, preamble, instruction))
     out.indent(1)
     # emit_triple_quote(out, instruction)
-    emit_instruction_code(out, code)
+    body = output_buffer()
+    emit_instruction_code(body, code)
+    out.put(rewrite(body.getvalue(), None, inlined, lazy, undocumented))
     out.outdent(2)
 
 
+# -----------------------------------------------------------------------------
+# Run time code generation
+#
+# The predecode cache (z80pd.py) uses these functions and rewrite(code, imm)
+# to compile the code for an instruction with its immediate operands resolved
+# to constants. That code assumes the pc has already been advanced past the
+# instruction.
+
+
+def instruction_code(code):
+    """return the (not inlined) code for the instruction with opcode bytes code"""
+    out = output_buffer()
+    emit_instruction_code(out, list(code))
+    return out.getvalue()
+
+
+def immediate_bytes(text):
+    """return the number of immediate operand bytes fetched by instruction code"""
+    return text.count("self._get_n()") + (2 * text.count("self._get_nn()"))
+
+
 # -----------------------------------------------------------------------------
 # flag lookup tables
 
@@ -1496,15 +1997,74 @@ def pop(x):
     return p
 
 
+def add_flags(sz, a, val, c):
+    """return the flags for a + val + c, as set by cpu._add_flags"""
+    res = a + val + c
+    f = sz[res & 0xFF] | ((res >> 8) & _CF) | ((a ^ res ^ val) & _HF)
+    return f | (((val ^ a ^ 0x80) & (val ^ res) & 0x80) >> 5)
+
+
+def sub_flags(sz, a, val, c):
+    """return the flags for a - val - c, as set by cpu._sub_flags"""
+    res = a - val - c
+    f = sz[res & 0xFF] | ((res >> 8) & _CF) | _NF | ((a ^ res ^ val) & _HF)
+    return f | (((val ^ a) & (a ^ res) & 0x80) >> 5)
+
+
+def daa(szp, a, f):
+    """return (a << 8) | f after a daa instruction"""
+    cf = bool(f & _CF)
+    nf = bool(f & _NF)
+    hf = bool(f & _HF)
+    lo = a & 0x0F
+    hi = a >> 4
+    if cf:
+        diff = (0x66, 0x60)[(lo <= 9) and (not hf)]
+    else:
+        if lo >= 10:
+            diff = (0x66, 0x06)[hi <= 8]
+        else:
+            if hi >= 10:
+                diff = (0x60, 0x66)[hf]
+            else:
+                diff = (0x00, 0x06)[hf]
+    if nf:
+        a = (a - diff) & 0xFF
+    else:
+        a = (a + diff) & 0xFF
+    f = szp[a] | (f & _NF)
+    if cf:
+        f |= _CF
+    if (lo <= 9) and (hi >= 10):
+        f |= _CF
+    if (lo > 9) and (hi >= 9):
+        f |= _CF
+    if nf and hf and (lo <= 5):
+        f |= _HF
+    if (not nf) and (lo >= 10):
+        f |= _HF
+    return (a << 8) | f
+
+
+def emit_bytes(out, name, data):
+    """emit a large table as a bytes literal"""
+    out.put("%s = (\n" % name)
+    out.indent(1)
+    for i in range(0, len(data), 64):
+        out.put("b'%s'\n" % "".join(["\\x%02x" % x for x in data[i : i + 64]]))
+    out.outdent(1)
+    out.put(")\n")
+
+
 def emit_table(out, name, data):
-    out.put("self.%s = (\n" % name)
+    out.put("%s = bytes((\n" % name)
     out.indent(1)
     for x in range(16):
         for y in range(16):
             out.put("0x%02x, " % data[(x * 16) + y])
         out.put("\n")
     out.outdent(1)
-    out.put(")\n")
+    out.put("))\n")
 
 
 def emit_flag_tables(out):
@@ -1543,38 +2103,72 @@ def emit_flag_tables(out):
         if (i & 0x0F) == 0x0F:
             SZHV_dec[i] |= _HF
 
-    out.indent(2)
+    out.indent(1)
     emit_table(out, "f_sz", SZ)
     emit_table(out, "f_szp", SZP)
     emit_table(out, "f_szhv_inc", SZHV_inc)
     emit_table(out, "f_szhv_dec", SZHV_dec)
-    out.outdent(2)
+    # daa: index is (((h << 2) | (n << 1) | c) << 8) | a, value is (a << 8) | f
+    out.put("daa_af = (\n")
+    out.indent(1)
+    for i in range(0, 0x800, 8):
+        f = ((i >> 8) & (_CF | _NF)) | (((i >> 8) << 2) & _HF)
+        out.put("%s\n" % " ".join(["0x%04x," % daa(SZP, x & 0xFF, f) for x in range(i, i + 8)]))
+    out.outdent(1)
+    out.put(")\n")
+    # add/adc and sub/sbc/cp: index is (c << 16) | (a << 8) | val
+    n = range(0x20000)
+    emit_bytes(out, "f_add", bytes([add_flags(SZ, (i >> 8) & 0xFF, i & 0xFF, i >> 16) for i in n]))
+    emit_bytes(out, "f_sub", bytes([sub_flags(SZ, (i >> 8) & 0xFF, i & 0xFF, i >> 16) for i in n]))
+    out.outdent(1)
 
 
 # -----------------------------------------------------------------------------
 
 
-def generate(ofname):
-    """generate the opcode emulation file"""
+def generate(ofname, inlined=True, lazy=False, undocumented=True, refresh=True, sequences=()):
+    """generate the opcode emulation file, sequences: instruction sequences to fuse"""
     out = output(ofname)
+    # record the generator options for run time code generation
+    options = {"inlined": inlined, "lazy": lazy, "undocumented": undocumented, "refresh": refresh}
+    out.indent(1)
+    out.put("gen_options = %r\n" % options)
+    out.outdent(1)
     # generate flag tables
     emit_flag_tables(out)
+    if lazy:
+        emit_lazy_flags(out)
+    if not refresh:
+        emit_run_loops(out)
+    # collect the unique instructions for each opcode table
     idic = {}
-    # generate the opcode tables
+    tables = output_buffer()
     for prefix, links, preamble in _prefixes:
-        emit_opcode_table(out, idic, prefix, links, preamble)
+        emit_opcode_table(tables, idic, prefix, links, preamble)
     # generate the instruction functions
     for k, v in idic.items():
-        emit_instruction_function(out, k, v)
+        emit_instruction_function(out, k, v, inlined, lazy, undocumented)
+    emit_superinstructions(out, sequences, inlined, lazy, undocumented)
+    # generate the opcode tables - these reference the instruction functions
+    out.put(tables.getvalue())
     out.close()
 
 
 # -----------------------------------------------------------------------------
 
 
+# default number of sequences to fuse
+_SEQUENCES = 16
+
+
 def usage():
     print("usage:")
-    print("%s -o [OUTPUT]" % sys.argv[0])
+    print("%s [-n] [-l] [-p PROFILE] [-s SEQUENCES] [-k N] -o [OUTPUT]" % sys.argv[0])
+    print("-n : do not inline the cpu helper functions")
+    print("-l : lazy flag evaluation for 8 bit add and sub operations")
+    print("-p : generator profile: %s" % " ".join(sorted(profiles)))
+    print("-s : fuse the most executed instruction sequences in a sequence profile")
+    print("-k : number of sequences to fuse (default %d)" % _SEQUENCES)
     sys.exit(2)
 
 
@@ -1583,16 +2177,33 @@ def usage():
 
 def main():
     ofname = "z80bh.py"
+    options = {}
+    sfname = None
+    n = _SEQUENCES
     try:
-        optlist, arglist = getopt.gnu_getopt(sys.argv[1:], "o:")
+        optlist, arglist = getopt.gnu_getopt(sys.argv[1:], "lnp:s:k:o:")
     except getopt.GetoptError:
         usage()
     for opt in optlist:
         if opt[0] == "-o":
             ofname = opt[1]
+        elif opt[0] == "-n":
+            options["inlined"] = False
+        elif opt[0] == "-l":
+            options["lazy"] = True
+        elif opt[0] == "-p":
+            if opt[1] not in profiles:
+                usage()
+            options = dict(profiles[opt[1]], **options)
+        elif opt[0] == "-s":
+            sfname = opt[1]
+        elif opt[0] == "-k":
+            n = int(opt[1])
     if len(arglist) != 0:
         usage()
-    generate(ofname)
+    if sfname is not None:
+        options["sequences"] = read_profile(sfname, n)
+    generate(ofname, **options)
 
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,230 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Idle Loop Detector
+
+Finds short loops that only read registers, memory (and optionally ports) and
+branch back to their start, e.g. a loop waiting for the interrupt routine to
+change a memory location:
+
+    059b bit 5,(hl)
+    059d jr z,059b
+
+Nothing that such a loop reads can change until the run loop returns to its
+caller (interrupts and device events are handled between run() calls). So once
+an iteration leaves the registers unchanged, every later iteration does the
+same and the detector skips them: the clock cycles and r register increments
+of the whole iterations that would start within the run budget are credited
+in one step. The partial iteration at the end of the budget is executed as
+usual, so the state at the next event matches a stepped run.
+
+The detector also counts off "djnz $" delay loops in one step.
+
+The backward jr/jp/djnz instructions of the cpu's opcode table are wrapped,
+so detection works with the interpreter run loops (run and run_until). It is
+not used by the predecode cache or the block translator. The profilers wrap
+the detector's table and put it back when they are turned off, so the
+detector can't be attached or detached while a profiler is on.
+"""
+# -----------------------------------------------------------------------------
+
+import operator
+
+# -----------------------------------------------------------------------------
+
+# maximum number of bytes in a loop, including the branch
+_SPAN = 16
+
+# number of failed checks before a loop is ignored
+_LIMIT = 8
+
+# branch opcodes that can close a loop
+_branches = (0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0xC2, 0xC3, 0xCA, 0xD2, 0xDA, 0xE2, 0xEA, 0xF2, 0xFA)
+
+# operations that only read memory and change registers/flags
+_reads = (
+    "adc", "add", "and", "bit", "ccf", "cp", "cpl", "daa", "dec", "ex", "exx", "inc", "ld", "neg",
+    "nop", "or", "res", "rl", "rla", "rlc", "rlca", "rr", "rra", "rrc", "rrca", "sbc", "scf",
+    "set", "sla", "sll", "sra", "srl", "sub", "xor",
+)
+
+# operations that write their first operand
+_updates = ("dec", "inc", "ld", "rl", "rlc", "rr", "rrc", "sla", "sll", "sra", "srl")
+
+# registers saved to detect a loop iteration that changes nothing
+_regs = (
+    "a", "f", "b", "c", "d", "e", "h", "l", "alt_af", "alt_bc", "alt_de", "alt_hl",
+    "ix", "iy", "sp", "i", "im", "iff1", "iff2",
+)
+_get_regs = operator.attrgetter(*_regs)
+
+# loop kinds
+_POLL = 1
+_DJNZ = 2
+_IGNORE = 255
+
+# -----------------------------------------------------------------------------
+
+
+class detector:
+    """idle loop detector"""
+
+    def __init__(self, cpu, ports=False, span=_SPAN, limit=_LIMIT):
+        if not 0 <= limit < _IGNORE:
+            raise ValueError("limit %d is not in 0..%d" % (limit, _IGNORE - 1))
+        if "opcodes" in cpu.__dict__:
+            raise ValueError("the opcode table is replaced (turn the profilers off first)")
+        self.cpu = cpu
+        self.ports = ports
+        self.span = span
+        self.limit = limit
+        # branch address -> number of failed checks (_IGNORE: not a loop we can skip)
+        self.fails = bytearray(0x10000)
+        # branch address of the last backward branch
+        self.branch = None
+        self.loops = 0
+        self.iterations = 0
+        self.skipped = 0
+        self.opcodes = tuple([self.wrap(fn, code) for code, fn in enumerate(type(cpu).opcodes)])
+        cpu.opcodes = self.opcodes
+
+    def close(self):
+        """restore the cpu opcode table"""
+        if self.cpu.__dict__.get("opcodes") is not self.opcodes:
+            # a profiler would put the detector's table back when it is turned off
+            raise ValueError("the opcode table is replaced (turn the profilers off first)")
+        del self.cpu.opcodes
+
+    def wrap(self, fn, code):
+        """return the opcode handler, wrapped if it can close a loop"""
+        if code not in _branches:
+            return fn
+        fails = self.fails
+        limit = self.limit
+        span = self.span
+
+        def branch(cpu):
+            pc = cpu.pc
+            clks = fn(cpu)
+            if 0 < pc - cpu.pc <= span:
+                adr = (pc - 1) & 0xFFFF
+                if fails[adr] < limit:
+                    self.branch = adr
+                    cpu.stop = 1
+            return clks
+
+        return branch
+
+    def readonly(self, adr):
+        """return True if the instruction at adr only reads memory (and ports)"""
+        (operation, operands, n) = self.cpu.da(adr)
+        args = operands.split(",")
+        if operation == "in" and self.ports:
+            return True
+        if operation not in _reads or "r" in args or "(sp)" in args:
+            return False
+        if operation in _updates:
+            return not args[0].startswith("(")
+        if operation in ("set", "res"):
+            return not args[1].startswith("(")
+        return True
+
+    def kind(self, start, branch):
+        """return the kind of loop from start to the branch"""
+        mem = self.cpu.mem
+        if start == branch:
+            return (_IGNORE, _DJNZ)[mem[branch] == 0x10]
+        if mem[branch] == 0x10:
+            # a djnz loop changes b on every iteration
+            return _IGNORE
+        adr = start
+        while adr < branch:
+            if not self.readonly(adr):
+                return _IGNORE
+            adr += self.cpu.da(adr)[2]
+        return (_IGNORE, _POLL)[adr == branch]
+
+    def skip(self, left, stop=None):
+        """
+        Skip the iterations of the loop at the pc that start within left clock cycles.
+        stop is an address that must not be skipped over.
+        Return the number of clock cycles taken.
+        """
+        cpu = self.cpu
+        start = cpu.pc
+        branch = self.branch
+        self.branch = None
+        if branch is None or not start <= branch < start + self.span:
+            return 0
+        if stop is not None and start <= stop <= branch:
+            return 0
+        kind = self.kind(start, branch)
+        if kind == _IGNORE:
+            self.fails[branch] = _IGNORE
+            return 0
+        if kind == _DJNZ:
+            # djnz $: 13 clock cycles for each iteration, 8 for the last one
+            total = cpu.b or 0x100
+            k = min(total, (left + 12) // 13)
+            cpu.b = (cpu.b - k) & 0xFF
+            cpu.r = (cpu.r + k) & 0x7F
+            cpu.instructions += k
+            self.loops += 1
+            self.iterations += k
+            self.skipped += 13 * k
+            if k == total:
+                cpu.pc = (start + 2) & 0xFFFF
+                self.skipped -= 5
+                return (13 * k) - 5
+            return 13 * k
+        # run one iteration and check that it changed nothing
+        state = _get_regs(cpu)
+        clks = 0
+        n = 0
+        while clks < left:
+            clks += cpu._execute()
+            n += 1
+            if not start <= cpu.pc <= branch:
+                break
+            if cpu.pc == start:
+                break
+        cpu.stop = 0
+        self.branch = None
+        if cpu.pc != start or clks >= left:
+            return clks
+        if _get_regs(cpu) != state:
+            self.fails[branch] += 1
+            return clks
+        self.fails[branch] = 0
+        # the whole iterations that start within the budget
+        c = clks
+        k = (left - c - 1) // c
+        if k > 0:
+            cpu.r = (cpu.r + (k * n)) & 0x7F
+            cpu.instructions += k * n
+            self.loops += 1
+            self.iterations += k
+            self.skipped += k * c
+        return c + (k * c)
+
+
+# -----------------------------------------------------------------------------
+
+
+def enable(cpu, ports=False, span=_SPAN, limit=_LIMIT):
+    """
+    Attach an idle loop detector to the cpu, ports: loops may read ports.
+    Raise ValueError if a profiler has replaced the cpu's opcode table.
+    """
+    if cpu.idle is None:
+        cpu.idle = detector(cpu, ports, span, limit)
+    return cpu.idle
+
+
+def disable(cpu):
+    """detach the idle loop detector from the cpu (raises ValueError while a profiler is on)"""
+    if cpu.idle is not None:
+        cpu.idle.close()
+        cpu.idle = None
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,191 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Predecoded Instruction Cache
+
+Maps an address to a handler for the instruction at that address, compiled
+with its prefixes decoded and its immediate operands resolved to constants.
+Handlers are shared by all the addresses holding the same instruction bytes.
+Entries for rom are never invalidated. Entries for ram are invalidated by
+writes through the memory map.
+"""
+# -----------------------------------------------------------------------------
+
+import re
+import memory
+import z80gen
+
+# -----------------------------------------------------------------------------
+# prefix function: (opcode table, clock cycles added by the prefix)
+
+_prefixes = {
+    "_execute_cb": ("opcodes_cb", 4),
+    "_execute_dd": ("opcodes_dd", 4),
+    "_execute_ed": ("opcodes_ed", 4),
+    "_execute_fd": ("opcodes_fd", 4),
+}
+
+_index_prefixes = {
+    "_execute_ddcb": ("opcodes_ddcb00", 8),
+    "_execute_fdcb": ("opcodes_fdcb00", 8),
+}
+
+_return = re.compile(r"^(\s*)return (\d+)$")
+
+# -----------------------------------------------------------------------------
+
+
+def _interpret(cpu):
+    """execute the instruction at the pc without predecoding it"""
+    pc = cpu.pc
+    cpu.pc = (pc + 1) & 0xFFFF
+    return cpu.opcodes[cpu.mem[pc]](cpu)
+
+
+# -----------------------------------------------------------------------------
+
+
+def fetch(cpu, adr, code):
+    """
+    Decode the instruction at adr.
+    Return (instruction bytes, inlined code, clock cycles added by prefixes),
+    or None for repeated prefixes.
+    code caches the (not inlined) code for each instruction label.
+    """
+    mem = cpu.mem
+    cls = type(cpu)
+    ins = [mem[adr]]
+    fn = cls.opcodes[ins[0]]
+    extra = 0
+    d = None
+    while fn.__name__ in _prefixes:
+        (table, clks) = _prefixes[fn.__name__]
+        ins.append(mem[adr + len(ins)])
+        fn = getattr(cls, table)[ins[-1]]
+        extra += clks
+    if fn.__name__ in _index_prefixes:
+        (table, clks) = _index_prefixes[fn.__name__]
+        d = mem[adr + len(ins)]
+        ins.extend((d, mem[adr + len(ins) + 1]))
+        fn = getattr(cls, table)[ins[-1]]
+        extra += clks
+    if not fn.__name__.startswith("_ins_"):
+        return None
+    label = fn.__name__[len("_ins_") :]
+    if label not in code:
+        text = z80gen.instruction_code([int(label[i : i + 2], 16) for i in range(0, len(label), 2)])
+        code[label] = (text, z80gen.immediate_bytes(text))
+    (text, n) = code[label]
+    imm = [mem[adr + len(ins) + i] for i in range(n)]
+    opts = cls.gen_options
+    text = z80gen.rewrite(text, imm, lazy=opts.get("lazy", False), undocumented=opts.get("undocumented", True))
+    if d is not None:
+        text = "d = %d\n%s" % (d - ((d & 0x80) << 1), text)
+    return (tuple(ins + imm), text, extra)
+
+
+# -----------------------------------------------------------------------------
+
+
+class cache:
+    """predecoded instruction cache"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.mem = cpu.mem
+        # address -> (handler, instruction length)
+        self.entries = [None] * 0x10000
+        # addresses (and their aliases) holding the bytes of a cached instruction
+        self.covered = bytearray(0x10000)
+        # instruction bytes -> handler
+        self.handlers = {}
+        # instruction label -> (code, number of immediate bytes)
+        self.code = {}
+        self.globals = type(cpu).execute.__globals__
+        self.lookups = 0
+        self.misses = 0
+        self.mem.add_wr_hook(self.wr)
+
+    def close(self):
+        """detach the cache from the memory map"""
+        self.mem.remove_wr_hook(self.wr)
+
+    def flush(self):
+        """invalidate all cache entries"""
+        self.entries[:] = [None] * 0x10000
+        self.covered[:] = bytes(0x10000)
+
+    def wr(self, adr):
+        """ram write hook - invalidate the entries for instructions using adr"""
+        if self.covered[adr]:
+            entries = self.entries
+            for a in self.mem.aliases(adr):
+                self.covered[a] = 0
+                # instructions are at most 4 bytes long
+                entries[a] = None
+                entries[a - 1] = None
+                entries[a - 2] = None
+                entries[a - 3] = None
+
+    def compile(self, name, text, extra):
+        """compile instruction code into a handler function"""
+        lines = []
+        for l in text.splitlines():
+            m = _return.match(l)
+            if m:
+                l = "%sreturn %d" % (m.group(1), int(m.group(2)) + extra)
+            lines.append("    %s\n" % l)
+        src = "def %s(self):\n%s" % (name, "".join(lines))
+        ns = {}
+        exec(compile(src, "<z80pd>", "exec"), self.globals, ns)
+        return ns[name]
+
+    def decode(self, adr):
+        """decode the instruction at adr and return its cache entry"""
+        self.misses += 1
+        mem = self.mem
+        x = fetch(self.cpu, adr, self.code)
+        if x is None:
+            # repeated prefixes
+            entry = (_interpret, 0)
+            self.entries[adr] = entry
+            return entry
+        (key, text, extra) = x
+        handler = self.handlers.get(key, None)
+        if handler is None:
+            handler = self.compile("_pd_%s" % "".join(["%02x" % x for x in key]), text, extra)
+            self.handlers[key] = handler
+        entry = (handler, len(key))
+        self.entries[adr] = entry
+        # mark the ram locations that would invalidate this entry
+        for i in range(len(key)):
+            a = (adr + i) & 0xFFFF
+            if isinstance(mem.select(a), memory.ram):
+                for x in mem.aliases(a):
+                    self.covered[x] = 1
+        return entry
+
+    def hit_rate(self):
+        """return the fraction of lookups that hit the cache"""
+        if self.lookups == 0:
+            return 0.0
+        return 1.0 - (float(self.misses) / self.lookups)
+
+
+# -----------------------------------------------------------------------------
+
+
+def enable(cpu):
+    """attach a predecoded instruction cache to the cpu"""
+    if cpu.predecode is None:
+        cpu.predecode = cache(cpu)
+    return cpu.predecode
+
+
+def disable(cpu):
+    """detach the predecoded instruction cache from the cpu"""
+    if cpu.predecode is not None:
+        cpu.predecode.close()
+        cpu.predecode = None
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,167 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Opcode Profiler
+
+While the profiler is on, the cpu's seven opcode tables are replaced by
+tables of wrapped handlers that count the executions, clock cycles and host
+time (ns) of each instruction. Turning it off restores the original tables,
+so the normal path is untouched.
+
+The prefix handlers (cb, dd, ed, fd, ddcb, fdcb) are not wrapped: an
+instruction's clock cycles include its prefixes, and its host time is the
+time spent in its handler. Only the interpreter uses the opcode tables, the
+predecode cache and the block translator run compiled code and are not
+profiled.
+"""
+# -----------------------------------------------------------------------------
+
+import csv
+import json
+import time
+import memory
+import z80da
+
+# -----------------------------------------------------------------------------
+
+# opcode table: (prefix bytes, clock cycles added by the prefixes)
+_tables = {
+    "opcodes": ((), 0),
+    "opcodes_cb": ((0xCB,), 4),
+    "opcodes_dd": ((0xDD,), 4),
+    "opcodes_ed": ((0xED,), 4),
+    "opcodes_fd": ((0xFD,), 4),
+    "opcodes_ddcb00": ((0xDD, 0xCB), 12),
+    "opcodes_fdcb00": ((0xFD, 0xCB), 12),
+}
+
+# handlers that dispatch to another opcode table
+_prefixes = ("_execute_cb", "_execute_dd", "_execute_ed", "_execute_fd", "_execute_ddcb", "_execute_fdcb")
+
+_fields = ("opcode", "instruction", "count", "tstates", "ns")
+
+# -----------------------------------------------------------------------------
+
+
+def _instruction(prefix, code):
+    """return the instruction for the opcode bytes"""
+    mem = memory.ram(4)
+    if len(prefix) == 2:
+        # ddcb/fdcb: the displacement comes before the opcode
+        mem.load(0, prefix + (0, code))
+    else:
+        mem.load(0, prefix + (code, 0, 0))
+    (operation, operands, n) = z80da.disassemble(mem, 0)
+    return ("%s %s" % (operation, operands)).strip()
+
+
+class profiler:
+    """per opcode execution profiler"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # table name -> (counts, clock cycles, ns) lists indexed by opcode
+        self.stats = {}
+        # table name -> instance table replaced while profiling (None: the class table)
+        self.saved = None
+        self.clear()
+
+    def clear(self):
+        """clear the statistics"""
+        for name in _tables:
+            self.stats[name] = ([0] * 256, [0] * 256, [0] * 256)
+
+    def wrap(self, fn, code, name):
+        """return the handler wrapped to record its statistics"""
+        if fn.__name__ in _prefixes:
+            return fn
+        (counts, clks, ns) = self.stats[name]
+        extra = _tables[name][1]
+        now = time.perf_counter_ns
+
+        if name.endswith("cb00"):
+
+            def profiled(cpu, d):
+                t = now()
+                c = fn(cpu, d)
+                ns[code] += now() - t
+                counts[code] += 1
+                clks[code] += c + extra
+                return c
+
+        else:
+
+            def profiled(cpu):
+                t = now()
+                c = fn(cpu)
+                ns[code] += now() - t
+                counts[code] += 1
+                clks[code] += c + extra
+                return c
+
+        return profiled
+
+    def on(self):
+        """replace the opcode tables with profiled tables"""
+        if self.saved is not None:
+            return
+        cpu = self.cpu
+        self.saved = {}
+        for name in _tables:
+            self.saved[name] = cpu.__dict__.get(name)
+            table = getattr(cpu, name)
+            setattr(cpu, name, tuple([self.wrap(fn, code, name) for code, fn in enumerate(table)]))
+
+    def off(self):
+        """restore the original opcode tables"""
+        if self.saved is None:
+            return
+        for name, table in self.saved.items():
+            if table is None:
+                delattr(self.cpu, name)
+            else:
+                setattr(self.cpu, name, table)
+        self.saved = None
+
+    def enabled(self):
+        """return True if the profiler is on"""
+        return self.saved is not None
+
+    def entries(self):
+        """return a list of the executed instructions, by decreasing host time"""
+        entries = []
+        for name, (prefix, extra) in _tables.items():
+            (counts, clks, ns) = self.stats[name]
+            for code in range(256):
+                if counts[code]:
+                    opcode = " ".join(["%02x" % x for x in prefix + (code,)])
+                    entries.append(dict(zip(_fields, (opcode, _instruction(prefix, code), counts[code], clks[code], ns[code]))))
+        entries.sort(key=lambda x: x["ns"], reverse=True)
+        return entries
+
+    def report(self, n=20):
+        """return a report of the n instructions with the most host time"""
+        entries = self.entries()
+        total = sum([x["ns"] for x in entries]) or 1
+        s = ["%-11s %-18s %10s %12s %10s %8s %6s" % ("opcode", "instruction", "count", "tstates", "host ms", "ns/exec", "%")]
+        for x in entries[:n]:
+            s.append(
+                "%-11s %-18s %10d %12d %10.2f %8.0f %6.2f"
+                % (x["opcode"], x["instruction"], x["count"], x["tstates"], x["ns"] / 1e6, x["ns"] / x["count"], (100.0 * x["ns"]) / total)
+            )
+        s.append("%d instructions, %d executed, %.2f host ms" % (len(entries), sum([x["count"] for x in entries]), total / 1e6))
+        return "\n".join(s)
+
+    def save(self, fname):
+        """save the statistics to a .json or .csv file"""
+        entries = self.entries()
+        f = open(fname, "w", newline="")
+        if fname.endswith(".json"):
+            json.dump(entries, f, indent=1)
+        else:
+            w = csv.DictWriter(f, _fields)
+            w.writeheader()
+            w.writerows(entries)
+        f.close()
+
+
+# -----------------------------------------------------------------------------
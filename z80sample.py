@@ -0,0 +1,184 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 PC Sampling Profiler
+
+While the emulation runs, an interval timer (signal.setitimer) interrupts it
+at a fixed host cpu time interval and the signal handler records the pc and
+the 16 bit word at the top of the Z80 stack. Nothing is added to the
+instruction dispatch path, so the sampled machine runs at full speed.
+
+The signal handler runs between Python byte codes, usually in the middle of an
+opcode handler, when the pc register has already moved past the opcode. The
+address of the instruction being executed is taken from the pc variable of
+the run loop in the interrupted Python frames instead.
+
+The sampler reads memory with peek(), so the watchpoints don't see its reads.
+
+The samples give a histogram of the pc, which is resolved to instructions and
+to routines. The routine entry points are the targets of the call and rst
+instructions in memory, and the targets found from the stack: if the word at
+the top of the stack is a return address (it follows a call or rst) the call
+target is the entry of the sampled routine. Every pc sample is credited to
+the nearest entry point below it. Bytes of data that look like a call only
+split a routine in two.
+
+With the block translator the pc is sampled at block boundaries.
+"""
+# -----------------------------------------------------------------------------
+
+import signal
+import bisect
+import collections
+import z80da
+
+# -----------------------------------------------------------------------------
+
+# seconds of host cpu time between samples
+_INTERVAL = 0.002
+
+# cpu methods with the address of the current instruction in a pc variable
+_loops = ("_execute", "_run", "_run_until", "_run_break", "_run_trace", "_run_predecoded", "_run_translated")
+
+# call nn, call cc,nn
+_calls = (0xCD, 0xC4, 0xCC, 0xD4, 0xDC, 0xE4, 0xEC, 0xF4, 0xFC)
+
+# rst n
+_rsts = (0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF)
+
+# -----------------------------------------------------------------------------
+
+
+class _unwatched:
+    """memory reads without watchpoint side effects, for the disassembler"""
+
+    def __init__(self, mem):
+        self.peek = mem.peek
+
+    def __getitem__(self, adr):
+        return self.peek(adr)
+
+
+class sampler:
+    """pc sampling profiler"""
+
+    def __init__(self, cpu, interval=_INTERVAL):
+        self.cpu = cpu
+        self.interval = interval
+        # (pc, top of stack) -> number of samples
+        self.samples = collections.Counter()
+        self.enabled = False
+        # signal handler replaced while sampling
+        self.saved = None
+
+    def clear(self):
+        """clear the samples"""
+        self.samples.clear()
+
+    def on(self):
+        """sample the emulation when it runs"""
+        self.enabled = True
+
+    def off(self):
+        """stop sampling"""
+        self.stop()
+        self.enabled = False
+
+    def sample(self, signum, frame):
+        """signal handler: record the pc and the top of the stack"""
+        cpu = self.cpu
+        pc = cpu.pc
+        while frame is not None:
+            if frame.f_code.co_name in _loops:
+                pc = frame.f_locals.get("pc", pc)
+                break
+            frame = frame.f_back
+        # read the stack without the side effects of the watchpoints
+        peek = cpu.mem.peek
+        sp = cpu.sp
+        self.samples[(pc, peek(sp) | (peek((sp + 1) & 0xFFFF) << 8))] += 1
+
+    def start(self):
+        """start the sampling timer (if the sampler is on)"""
+        if self.enabled and self.saved is None:
+            self.saved = signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """stop the sampling timer"""
+        if self.saved is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.saved)
+            self.saved = None
+
+    def total(self):
+        """return the number of samples"""
+        return sum(self.samples.values())
+
+    def addresses(self):
+        """return a list of (pc, samples), by decreasing samples"""
+        pcs = collections.Counter()
+        for (pc, top), n in self.samples.items():
+            pcs[pc] += n
+        return pcs.most_common()
+
+    def caller(self, adr):
+        """return the routine called by the call or rst before a return address (or None)"""
+        peek = self.cpu.mem.peek
+        if peek((adr - 3) & 0xFFFF) in _calls:
+            return peek((adr - 2) & 0xFFFF) | (peek((adr - 1) & 0xFFFF) << 8)
+        if peek((adr - 1) & 0xFFFF) in _rsts:
+            return peek((adr - 1) & 0xFFFF) & 0x38
+        return None
+
+    def entries(self):
+        """return the sorted list of routine entry points"""
+        peek = self.cpu.mem.peek
+        entries = set([op & 0x38 for op in _rsts])
+        for adr in range(0x10000 - 2):
+            if peek(adr) in _calls:
+                entries.add(peek(adr + 1) | (peek(adr + 2) << 8))
+        for pc, top in self.samples:
+            entry = self.caller(top)
+            if entry is not None and entry <= pc:
+                entries.add(entry)
+        return sorted(entries)
+
+    def routines(self):
+        """return a list of (entry, last sampled pc, samples), by decreasing samples"""
+        entries = self.entries()
+        routines = {}
+        for pc, n in self.addresses():
+            i = bisect.bisect_right(entries, pc) - 1
+            # pcs below the first entry point are their own routine
+            entry = (pc, entries[i])[i >= 0]
+            (last, count) = routines.get(entry, (pc, 0))
+            routines[entry] = (max(last, pc), count + n)
+        routines = [(entry, last, count) for entry, (last, count) in routines.items()]
+        routines.sort(key=lambda x: x[2], reverse=True)
+        return routines
+
+    def instruction(self, adr):
+        """return the disassembled instruction at adr"""
+        (operation, operands, n) = z80da.disassemble(_unwatched(self.cpu.mem), adr)
+        return "%-5s %s" % (operation, operands)
+
+    def report(self, n=20):
+        """return a report of the n most sampled addresses"""
+        total = self.total() or 1
+        s = ["%-4s  %-18s %8s %6s" % ("adr", "instruction", "samples", "%")]
+        for pc, count in self.addresses()[:n]:
+            s.append("%04x  %-18s %8d %6.2f" % (pc, self.instruction(pc), count, (100.0 * count) / total))
+        s.append("%d samples" % self.total())
+        return "\n".join(s)
+
+    def report_routines(self, n=20):
+        """return a report of the n most sampled routines"""
+        total = self.total() or 1
+        s = ["%-9s  %-18s %8s %6s" % ("routine", "entry", "samples", "%")]
+        for entry, last, count in self.routines()[:n]:
+            s.append("%04x-%04x  %-18s %8d %6.2f" % (entry, last, self.instruction(entry), count, (100.0 * count) / total))
+        s.append("%d samples" % self.total())
+        return "\n".join(s)
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,174 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Superinstructions
+
+z80gen can fuse the most executed instruction sequences of a workload into
+single handlers (see the superinstructions table of the cpu class). This
+module collects the sequence profile that z80gen reads, and dispatches to the
+fused handlers at run time.
+
+Dispatch replaces the opcode table entry for the first byte of each sequence
+with a function that checks the following bytes at the pc and calls the fused
+handler if they match (or the original handler if they don't). The fused
+table is only used by the interpreter run loop, and only while there is room
+in the run budget for the longest sequence: the rest of the budget is run
+with the normal table, so run() stops on the same instruction boundaries as
+it does without superinstructions. run_until() and single steps don't use
+superinstructions.
+
+Sequences that use an opcode whose handler has been replaced (e.g. a branch
+wrapped by the idle loop detector) are not dispatched.
+"""
+# -----------------------------------------------------------------------------
+
+import collections
+import z80gen
+import z80
+
+# -----------------------------------------------------------------------------
+
+# maximum number of instructions in a collected sequence
+_LENGTH = 3
+
+# -----------------------------------------------------------------------------
+
+
+class recorder:
+    """instruction sequence profile collector"""
+
+    def __init__(self, cpu, length=_LENGTH):
+        self.cpu = cpu
+        self.length = length
+        # instruction sequence (tuple of opcode bytes) -> count
+        self.counts = collections.Counter()
+        self.last = ()
+        self.saved = cpu.__dict__.get("opcodes")
+        cpu.opcodes = tuple([self.wrap(fn, code) for code, fn in enumerate(cpu.opcodes)])
+
+    def close(self):
+        """restore the cpu opcode table"""
+        if self.saved is None:
+            del self.cpu.opcodes
+        else:
+            self.cpu.opcodes = self.saved
+
+    def wrap(self, fn, code):
+        """return the opcode handler wrapped to record the instruction"""
+        mem = self.cpu.mem
+        prefixed = code in (0xCB, 0xDD, 0xED, 0xFD)
+
+        def record(cpu):
+            op = bytes((code,))
+            if prefixed:
+                op = bytes((code, mem[cpu.pc]))
+            last = self.last[1 - self.length :] + (op,)
+            for i in range(len(last) - 1):
+                self.counts[last[i:]] += 1
+            self.last = last
+            return fn(cpu)
+
+        return record
+
+    def save(self, fname):
+        """write the sequence profile to a file"""
+        f = open(fname, "w")
+        for seq, count in self.counts.most_common():
+            f.write("%d %s\n" % (count, " ".join([op.hex() for op in seq])))
+        f.close()
+
+
+def record(cpu, length=_LENGTH):
+    """start collecting a sequence profile for the cpu"""
+    return recorder(cpu, length)
+
+
+# -----------------------------------------------------------------------------
+
+
+class dispatcher:
+    """superinstruction dispatcher"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.code = {}
+        # (base opcode table, fused opcode table, clock cycles reserved at the end of the budget)
+        self.tables = (None, None, 0)
+
+    def build(self, base):
+        """return the fused opcode table for the base opcode table"""
+        cls = type(self.cpu)
+        candidates = {}
+        margin = 0
+        for ops, fn, last in cls.superinstructions:
+            ops = [bytes.fromhex(op) for op in ops]
+            if [op for op in ops if base[op[0]] is not cls.opcodes[op[0]]]:
+                continue
+            candidates.setdefault(ops[0][0], []).append((ops, fn))
+            margin = max(margin, last)
+        table = list(base)
+        for code, seqs in candidates.items():
+            table[code] = self.compile(code, base[code], seqs)
+        return (base, tuple(table), margin)
+
+    def operands(self, op):
+        """return the number of immediate operand bytes of an instruction"""
+        if op not in self.code:
+            self.code[op] = z80gen.immediate_bytes(z80gen.instruction_code(list(op)))
+        return self.code[op]
+
+    def compile(self, code, fn, seqs):
+        """return a dispatch function for the sequences starting with the opcode"""
+        ns = {"base": fn}
+        lines = ["mem = self.mem", "pc = self.pc"]
+        # try the longest sequences first
+        for i, (ops, handler) in enumerate(sorted(seqs, key=lambda x: -len(x[0]))):
+            tests = []
+            # offsets are relative to the pc after the first opcode byte
+            adr = -1
+            for op in ops:
+                for k, x in enumerate(op):
+                    if adr + k >= 0:
+                        tests.append("mem[(pc + %d) & 0xFFFF] == 0x%02x" % (adr + k, x))
+                adr += len(op) + self.operands(op)
+            ns["si%d" % i] = handler
+            lines.append("if %s:" % " and ".join(tests).replace("(pc + 0) & 0xFFFF", "pc"))
+            lines.append("    return si%d(self)" % i)
+        lines.append("return base(self)")
+        src = "def _si_dispatch(self):\n%s" % "".join(["    %s\n" % l for l in lines])
+        exec(compile(src, "<z80si %02x>" % code, "exec"), ns)
+        return ns["_si_dispatch"]
+
+    def run(self, tstates):
+        """run() using superinstructions"""
+        cpu = self.cpu
+        base = cpu.opcodes
+        if self.tables[0] is not base:
+            self.tables = self.build(base)
+        (base, table, margin) = self.tables
+        clks = 0
+        if tstates > margin:
+            (clks, stop) = cpu._run(tstates - margin, table)
+            if stop != z80.STOP_BUDGET:
+                return (clks, stop)
+        if clks < tstates:
+            (n, stop) = cpu._run(tstates - clks)
+            return (clks + n, stop)
+        return (clks, stop)
+
+
+# -----------------------------------------------------------------------------
+
+
+def enable(cpu):
+    """dispatch to the superinstructions of the cpu core"""
+    if cpu.fused is None:
+        cpu.fused = dispatcher(cpu)
+    return cpu.fused
+
+
+def disable(cpu):
+    """stop dispatching to superinstructions"""
+    cpu.fused = None
+
+
+# -----------------------------------------------------------------------------
@@ -4,6 +4,8 @@ Z80 CPU Emulation
 """
 # -----------------------------------------------------------------------------
 
+import struct
+import operator
 import z80da
 
 # -----------------------------------------------------------------------------
@@ -33,6 +35,37 @@ class Error(Exception):
     pass
 
 
+# -----------------------------------------------------------------------------
+# run loop stop reasons
+
+STOP_BUDGET = "budget"  # the t-state budget has been spent
+STOP_HALT = "halt"  # a halt instruction was executed
+STOP_ERROR = "error"  # an unimplemented instruction was decoded
+STOP_ADDRESS = "address"  # the run_until stop address was reached
+STOP_BREAK = "break"  # the pc reached a breakpoint
+STOP_WATCH = "watch"  # an instruction accessed a watched memory location
+
+# repeating block instructions: ed opcode -> (bulk method, address step)
+_repeats = {
+    0xB0: ("_ldxr", 1),  # ldir
+    0xB1: ("_cpxr", 1),  # cpir
+    0xB2: ("_inxr", 1),  # inir
+    0xB3: ("_otxr", 1),  # otir
+    0xB8: ("_ldxr", -1),  # lddr
+    0xB9: ("_cpxr", -1),  # cpdr
+    0xBA: ("_inxr", -1),  # indr
+    0xBB: ("_otxr", -1),  # otdr
+}
+
+# register file: the cpu state saved by get_state() and restored by set_state()
+_state_regs = (
+    "a", "f", "b", "c", "d", "e", "h", "l",
+    "alt_af", "alt_bc", "alt_de", "alt_hl", "ix", "iy", "sp", "pc",
+    "i", "r", "im", "iff1", "iff2", "halt",
+)
+_state = struct.Struct("<8B8H6B")
+_state_get = operator.attrgetter(*_state_regs)
+
 # -----------------------------------------------------------------------------
 
 
@@ -91,6 +124,7 @@ class cpu:
     def _enter_halt(self):
         """enter halt mode"""
         self.halt = 1
+        self.stop = 1
         self._dec_pc(1)
 
     def _leave_halt(self):
@@ -99,6 +133,17 @@ class cpu:
             self._inc_pc(1)
             self.halt = 0
 
+    def _halted(self, tstates):
+        """
+        Fast forward a halted cpu: the halt instructions that would start within
+        tstates clock cycles are accounted for without executing them.
+        Return the number of clock cycles taken.
+        """
+        n = max(0, (tstates + 3) >> 2)
+        self.instructions += n
+        self.r = (self.r + n) & 0x7F
+        return n << 2
+
     def _push(self, val):
         """push a 16 bit quantity onto the stack"""
         self.mem[self.sp - 1] = val >> 8
@@ -196,13 +241,512 @@ class cpu:
         Execute a single instruction at the current mem[pc] location.
         Return the number of clock cycles taken.
         """
+        clks = self._execute()
+        self.tstates += clks
+        return clks
+
+    def _execute(self):
+        """execute() without counting the clock cycles"""
+        self.instructions += 1
         self.r = (self.r + 1) & 0x7F
-        code = self._get_n()
-        return self.opcodes[code]()
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        return self.opcodes[self.mem[pc]](self)
+
+    def run(self, tstates):
+        """
+        Execute instructions until at least tstates clock cycles have elapsed,
+        a halt instruction is executed or an unimplemented instruction is found.
+        A cpu that is already halted spends the whole budget executing halt.
+        Return (clock cycles taken, stop reason).
+        """
+        if self.halt:
+            x = (self._halted(tstates), STOP_HALT)
+        elif self.trace is not None:
+            x = self._run_trace(tstates)
+        elif self.breaks is not None:
+            x = self._run_break(tstates)
+        elif self.translator is not None:
+            x = self._run_translated(tstates)
+        elif self.predecode is not None:
+            x = self._run_predecoded(tstates)
+        elif self.fused is not None:
+            x = self.fused.run(tstates)
+        else:
+            x = self._run(tstates)
+        self.tstates += x[0]
+        return x
+
+    def _run(self, tstates, opcodes=None):
+        """run() using the interpreter (and an alternative opcode table)"""
+        mem = self.mem
+        if opcodes is None:
+            opcodes = self.opcodes
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                n += 1
+                self.r = (self.r + 1) & 0x7F
+                self.pc = (pc + 1) & 0xFFFF
+                clks += opcodes[mem[pc]](self)
+                if self.stop:
+                    self.stop = 0
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    clks += self._repeat(tstates - clks)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            self.instructions += n
+        return (clks, STOP_BUDGET)
+
+    def _run_predecoded(self, tstates):
+        """run() using the predecoded instruction cache"""
+        cache = self.predecode
+        entries = cache.entries
+        decode = cache.decode
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                entry = entries[pc]
+                if entry is None:
+                    entry = decode(pc)
+                n += 1
+                self.r = (self.r + 1) & 0x7F
+                self.pc = (pc + entry[1]) & 0xFFFF
+                clks += entry[0](self)
+                if self.stop:
+                    self.stop = 0
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    clks += self._repeat(tstates - clks)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            cache.lookups += n
+            self.instructions += n
+        return (clks, STOP_BUDGET)
+
+    def _run_translated(self, tstates):
+        """run() using the translated block cache"""
+        cache = self.translator
+        blocks = cache.blocks
+        translate = cache.translate
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                entry = blocks[pc]
+                if entry is None:
+                    entry = translate(pc)
+                if clks + entry[1] < tstates:
+                    n += 1
+                    clks += entry[0](self, tstates - clks)
+                else:
+                    # the block would start an instruction after the budget is spent
+                    clks += self._execute()
+                if self.stop:
+                    self.stop = 0
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    clks += self._repeat(tstates - clks)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            cache.executed += n
+        return (clks, STOP_BUDGET)
+
+    def run_until(self, adr, tstates):
+        """
+        As run(), but also stop when the pc reaches adr.
+        At least one instruction is executed.
+        Return (clock cycles taken, stop reason).
+        """
+        if self.halt:
+            x = (self._halted(tstates), STOP_HALT)
+        else:
+            x = self._run_until(adr, tstates)
+        self.tstates += x[0]
+        return x
+
+    def _condition(self, cond):
+        """return the value of a breakpoint condition, a condition that raises an exception stops the cpu"""
+        try:
+            return cond(self, self.mem)
+        except Exception as e:
+            self.cond_error = e
+            return True
+
+    def _run_break(self, tstates):
+        """run() using the interpreter, stopping before the instruction at a breakpoint"""
+        self.cond_error = None
+        mem = self.mem
+        opcodes = self.opcodes
+        breaks = self.breaks
+        conditions = self.conditions
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                if breaks[pc]:
+                    cond = conditions.get(pc)
+                    if cond is None or self._condition(cond):
+                        return (clks, STOP_BREAK)
+                n += 1
+                self.r = (self.r + 1) & 0x7F
+                self.pc = (pc + 1) & 0xFFFF
+                clks += opcodes[mem[pc]](self)
+                if self.stop:
+                    self.stop = 0
+                    if self.watched:
+                        self.watched = [(pc,) + x for x in self.watched]
+                        return (clks, STOP_WATCH)
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    # don't repeat or skip past a breakpoint (or a watched access)
+                    adr = breaks.find(1, self.pc)
+                    if adr != self.pc and self.watched is None:
+                        clks += self._repeat(tstates - clks, adr)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            self.instructions += n
+        return (clks, STOP_BUDGET)
+
+    def _run_trace(self, tstates):
+        """run() using the interpreter, recording each instruction in the trace buffer (and stopping at breakpoints)"""
+        self.cond_error = None
+        mem = self.mem
+        opcodes = self.opcodes
+        breaks = self.breaks
+        conditions = self.conditions
+        t = self.trace
+        mask = t.mask
+        (pcs, ops, afs, bcs, des, hls, sps, ts) = (t.pc, t.op, t.af, t.bc, t.de, t.hl, t.sp, t.tstates)
+        t0 = self.tstates
+        k = t.count
+        flush = t.flush
+        # the opcode bytes are read without the watchpoints seeing them
+        peek = mem.peek
+        # direct access window for reading the opcode bytes
+        (wm, lo, hi, delta) = (None, 0, 0, 0)
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                if breaks is not None and breaks[pc]:
+                    cond = conditions.get(pc)
+                    if cond is None or self._condition(cond):
+                        return (clks, STOP_BREAK)
+                i = k & mask
+                k += 1
+                pcs[i] = pc
+                if not lo <= pc < hi:
+                    (wm, lo, hi, delta) = mem.window(pc) or (None, 0, 0, 0)
+                    # room for 4 bytes
+                    hi -= 3
+                if lo <= pc < hi:
+                    j = pc - delta
+                    ops[i] = wm[j] | (wm[j + 1] << 8) | (wm[j + 2] << 16) | (wm[j + 3] << 24)
+                else:
+                    ops[i] = peek(pc) | (peek((pc + 1) & 0xFFFF) << 8) | (peek((pc + 2) & 0xFFFF) << 16) | (peek((pc + 3) & 0xFFFF) << 24)
+                afs[i] = (self.a << 8) | self.f
+                bcs[i] = (self.b << 8) | self.c
+                des[i] = (self.d << 8) | self.e
+                hls[i] = (self.h << 8) | self.l
+                sps[i] = self.sp
+                ts[i] = t0 + clks
+                if k == flush:
+                    flush = t.drain(k)
+                n += 1
+                self.r = (self.r + 1) & 0x7F
+                self.pc = (pc + 1) & 0xFFFF
+                clks += opcodes[mem[pc]](self)
+                if self.stop:
+                    self.stop = 0
+                    if self.watched:
+                        self.watched = [(pc,) + x for x in self.watched]
+                        return (clks, STOP_WATCH)
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    # don't repeat or skip past a breakpoint (or a watched access)
+                    adr = -1
+                    if breaks is not None:
+                        adr = breaks.find(1, self.pc)
+                    if adr != self.pc and self.watched is None:
+                        clks += self._repeat(tstates - clks, adr)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            self.instructions += n
+            t.count = k
+        return (clks, STOP_BUDGET)
+
+    def _run_until(self, adr, tstates):
+        """run_until() using the interpreter"""
+        mem = self.mem
+        opcodes = self.opcodes
+        clks = 0
+        n = 0
+        pc = self.pc
+        try:
+            while clks < tstates:
+                pc = self.pc
+                n += 1
+                self.r = (self.r + 1) & 0x7F
+                self.pc = (pc + 1) & 0xFFFF
+                clks += opcodes[mem[pc]](self)
+                if self.stop:
+                    self.stop = 0
+                    if self.halt:
+                        return (clks, STOP_HALT)
+                    if self.pc != adr:
+                        clks += self._repeat(tstates - clks, adr)
+                if self.pc == adr:
+                    return (clks, STOP_ADDRESS)
+        except Error as e:
+            self.error = e
+            self.pc = pc
+            return (clks, STOP_ERROR)
+        finally:
+            self.instructions += n
+        return (clks, STOP_BUDGET)
+
+    def _repeat(self, left, stop=None):
+        """
+        Continue the repeating block instruction at the pc (ldir, cpir, inir, otir, ...)
+        for the iterations that start within left clock cycles. The result is the same
+        as executing the instruction one iteration at a time. Otherwise pass an idle
+        loop at the pc to the idle loop detector (stop is a run_until address).
+        Return the number of clock cycles taken.
+        """
+        mem = self.mem
+        pc = self.pc
+        if left <= 0:
+            return 0
+        if mem[pc] == 0xED:
+            x = _repeats.get(mem[(pc + 1) & 0xFFFF])
+            if x is not None:
+                # each iteration that is not the last takes 21 clock cycles
+                return getattr(self, x[0])((left + 20) // 21, x[1])
+        if self.idle is not None:
+            return self.idle.skip(left, stop)
+        return 0
+
+    def _repeated(self, n, done):
+        """account for n iterations of a repeating block instruction"""
+        self.instructions += n
+        self.r = (self.r + n) & 0x7F
+        if done:
+            self.pc = (self.pc + 2) & 0xFFFF
+            return (21 * n) - 5
+        return 21 * n
+
+    def _intact(self, op):
+        """return True if the repeating instruction at the pc has not been overwritten"""
+        mem = self.mem
+        return mem[self.pc] == 0xED and mem[(self.pc + 1) & 0xFFFF] == op
+
+    def _ldxr(self, k, step):
+        """ldir/lddr: up to k iterations"""
+        mem = self.mem
+        op = (0xB8, 0xB0)[step > 0]
+        # direct access locations of the instruction bytes: a copy over them stops the bulk copy
+        guards = []
+        for a in (self.pc, (self.pc + 1) & 0xFFFF):
+            w = mem.window(a)
+            if w is not None:
+                guards.append((w[0], a - w[3]))
+        s = (self.h << 8) | self.l
+        d = (self.d << 8) | self.e
+        n = ((self.b << 8) | self.c) or 0x10000
+        k = min(k, n)
+        i = 0
+        while i < k:
+            src = mem.window(s)
+            dst = mem.window(d, True)
+            if src is None or dst is None:
+                val = mem[s]
+                mem[d] = val
+                m = 1
+            else:
+                (sm, slo, shi, sdelta) = src
+                (dm, dlo, dhi, ddelta) = dst
+                si = s - sdelta
+                di = d - ddelta
+                if step > 0:
+                    m = min(k - i, shi - s, dhi - d)
+                    for (gm, gi) in guards:
+                        if gm is dm and di <= gi < di + m:
+                            m = gi - di + 1
+                    # overlapping forward copy: each byte is read after it was written
+                    p = di - si
+                    if sm is dm and 0 < p < m:
+                        dm[di : di + m] = (sm[si : si + p] * ((m // p) + 1))[:m]
+                    else:
+                        dm[di : di + m] = sm[si : si + m]
+                    val = dm[di + m - 1]
+                else:
+                    m = min(k - i, s - slo + 1, d - dlo + 1)
+                    for (gm, gi) in guards:
+                        if gm is dm and di - m < gi <= di:
+                            m = di - gi + 1
+                    p = si - di
+                    if sm is dm and 0 < p < m:
+                        dm[di - m + 1 : di + 1] = ((sm[si - p + 1 : si + 1][::-1] * ((m // p) + 1))[:m])[::-1]
+                    else:
+                        dm[di - m + 1 : di + 1] = sm[si - m + 1 : si + 1]
+                    val = dm[di - m + 1]
+            s = (s + (step * m)) & 0xFFFF
+            d = (d + (step * m)) & 0xFFFF
+            i += m
+            if not self._intact(op):
+                break
+        n -= i
+        self._set_hl(s)
+        self._set_de(d)
+        self._set_bc(n)
+        f = self.f & (_SF | _ZF | _CF)
+        if (self.a + val) & 0x02:
+            f |= _YF
+        if (self.a + val) & _XF:
+            f |= _XF
+        if n:
+            f |= _VF
+        self.f = f
+        return self._repeated(i, n == 0)
+
+    def _cpxr(self, k, step):
+        """cpir/cpdr: up to k iterations"""
+        mem = self.mem
+        a = self.a
+        s = (self.h << 8) | self.l
+        n = ((self.b << 8) | self.c) or 0x10000
+        k = min(k, n)
+        i = 0
+        found = False
+        while i < k and not found:
+            w = mem.window(s)
+            if w is None:
+                val = mem[s]
+                found = val == a
+                m = 1
+            else:
+                (sm, lo, hi, delta) = w
+                si = s - delta
+                if step > 0:
+                    m = min(k - i, hi - s)
+                    j = sm[si : si + m].tobytes().find(a)
+                    if j >= 0:
+                        found = True
+                        m = j + 1
+                    val = sm[si + m - 1]
+                else:
+                    m = min(k - i, s - lo + 1)
+                    j = sm[si - m + 1 : si + 1].tobytes().rfind(a)
+                    if j >= 0:
+                        found = True
+                        m -= j
+                    val = sm[si - m + 1]
+            s = (s + (step * m)) & 0xFFFF
+            i += m
+        n -= i
+        self._set_hl(s)
+        self._set_bc(n)
+        res = a - val
+        f = (self.f & _CF) | _NF
+        f |= self.f_sz[res] & ~(_YF | _XF)
+        f |= (a ^ val ^ res) & _HF
+        if f & _HF:
+            res -= 1
+        if res & 0x02:
+            f |= _YF
+        if res & _XF:
+            f |= _XF
+        if n:
+            f |= _VF
+        self.f = f
+        return self._repeated(i, found or n == 0)
+
+    def _block_io_flags(self, val, t):
+        """flags for ini/ind/outi/outd"""
+        f = self.f_sz[self.b]
+        if val & _SF:
+            f |= _NF
+        if t & 0x100:
+            f |= _HF | _CF
+        self.f = f | (self.f_szp[(t & 0x07) ^ self.b] & _PF)
+
+    def _inxr(self, k, step):
+        """inir/indr: up to k iterations"""
+        mem = self.mem
+        op = (0xBA, 0xB2)[step > 0]
+        rd = self.io.rd
+        b = self.b
+        c = self.c
+        s = (self.h << 8) | self.l
+        k = min(k, b or 0x100)
+        for i in range(k):
+            val = rd((b << 8) | c)
+            b = (b - 1) & 0xFF
+            mem[s] = val
+            s = (s + step) & 0xFFFF
+            if not self._intact(op):
+                k = i + 1
+                break
+        self.b = b
+        self._set_hl(s)
+        self._block_io_flags(val, ((c + step) & 0xFF) + val)
+        return self._repeated(k, b == 0)
+
+    def _otxr(self, k, step):
+        """otir/otdr: up to k iterations"""
+        mem = self.mem
+        op = (0xBB, 0xB3)[step > 0]
+        wr = self.io.wr
+        b = self.b
+        c = self.c
+        s = (self.h << 8) | self.l
+        k = min(k, b or 0x100)
+        for i in range(k):
+            val = mem[s]
+            b = (b - 1) & 0xFF
+            wr((b << 8) | c, val)
+            s = (s + step) & 0xFFFF
+            if not self._intact(op):
+                k = i + 1
+                break
+        self.b = b
+        self._set_hl(s)
+        self._block_io_flags(val, (s & 0xFF) + val)
+        return self._repeated(k, b == 0)
 
     def interrupt(self, x=0):
         """
         Perform interrupt actions
+        Return the number of clock cycles taken.
         """
         if self.iff1 == 0:
             return 0
@@ -212,13 +756,15 @@ class cpu:
         self._push(self.pc)
         if self.im == 0:
             self.pc = x & 0x38
-            return 13
+            clks = 13
         elif self.im == 1:
             self.pc = 0x38
-            return 11
+            clks = 11
         else:
             self._set_pc(self._peek((self.i << 8) + (x & 0xFF)))
-            return 17
+            clks = 17
+        self.tstates += clks
+        return clks
 
     def reset(self):
         """
@@ -245,7 +791,30 @@ class cpu:
         self.iff1 = 0
         self.iff2 = 0
         self.halt = 0
+        self.stop = 0
         self.pc = 0
+        self.error = None
+
+    def watch(self, access, adr, old, new):
+        """
+        Memory watchpoint hit: the breakpoint run loop stops after the current instruction.
+        Watchpoints need cpu.watched = [] and a breakpoint bitmap (which may be empty).
+        """
+        if self.watched is not None:
+            self.watched.append((access, adr, old, new))
+            self.stop = 1
+
+    def get_state(self):
+        """return the register file as a bytes object"""
+        return _state.pack(*_state_get(self))
+
+    def set_state(self, state):
+        """restore the register file from get_state()"""
+        regs = dict(zip(_state_regs, _state.unpack(state)))
+        # f is a property with lazy flag evaluation: setting it also drops pending lazy flags
+        self.f = regs.pop("f")
+        self.__dict__.update(regs)
+        self.stop = 0
 
     def _repeated_prefix(self):
         """A prefix code hase been repeated. NOP and re-run the current prefix"""
@@ -253,42 +822,48 @@ class cpu:
         return 0
 
     def _execute_dddd(self):
-        self._repeated_prefix()
+        return self._repeated_prefix()
 
     def _execute_ddfd(self):
-        self._repeated_prefix()
+        return self._repeated_prefix()
 
     def _execute_fddd(self):
-        self._repeated_prefix()
+        return self._repeated_prefix()
 
     def _execute_fdfd(self):
-        self._repeated_prefix()
+        return self._repeated_prefix()
 
     def _execute_cb(self):
-        code = self._get_n()
-        return 4 + self.opcodes_cb[code]()
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        return 4 + self.opcodes_cb[self.mem[pc]](self)
 
     def _execute_dd(self):
-        code = self._get_n()
-        return 4 + self.opcodes_dd[code]()
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        return 4 + self.opcodes_dd[self.mem[pc]](self)
 
     def _execute_ed(self):
-        code = self._get_n()
-        return 4 + self.opcodes_ed[code]()
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        return 4 + self.opcodes_ed[self.mem[pc]](self)
 
     def _execute_fd(self):
-        code = self._get_n()
-        return 4 + self.opcodes_fd[code]()
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        return 4 + self.opcodes_fd[self.mem[pc]](self)
 
     def _execute_ddcb(self):
-        d = _signed(self._get_n())
-        code = self._get_n()
-        return 8 + self.opcodes_ddcb00[code](d)
+        pc = self.pc
+        self.pc = (pc + 2) & 0xFFFF
+        d = _signed(self.mem[pc])
+        return 8 + self.opcodes_ddcb00[self.mem[pc + 1]](self, d)
 
     def _execute_fdcb(self):
-        d = _signed(self._get_n())
-        code = self._get_n()
-        return 8 + self.opcodes_fdcb00[code](d)
+        pc = self.pc
+        self.pc = (pc + 2) & 0xFFFF
+        d = _signed(self.mem[pc])
+        return 8 + self.opcodes_fdcb00[self.mem[pc + 1]](self, d)
 
     def __str__(self):
         """return a string with processor state"""
@@ -316,4 +891,21 @@ class cpu:
     def __init__(self, mem, io):
         self.mem = mem
         self.io = io
+        # clock cycles and instructions (including block instruction iterations) since the cpu was created
+        self.tstates = 0
+        self.instructions = 0
+        self.predecode = None
+        self.translator = None
+        self.fused = None
+        self.idle = None
+        # execution trace ring buffer (see z80trace.py)
+        self.trace = None
+        # execution breakpoints: 64K bitmap with a 1 at each breakpoint address (None: no breakpoints)
+        self.breaks = None
+        # breakpoint address -> condition function f(cpu, mem), the breakpoint stops the cpu if it returns True
+        self.conditions = {}
+        # exception raised by the condition of the breakpoint the last run stopped at
+        self.cond_error = None
+        # watchpoint hits: (pc, access, adr, old value, new value) (None: no watchpoints)
+        self.watched = None
         self.reset()
@@ -0,0 +1,136 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Execution Trace Ring Buffer
+
+While a trace is attached to the cpu, run() uses a tracing interpreter loop
+that records the state before each instruction: pc, the 4 bytes at the pc
+(the opcode bytes, little endian), af, bc, de, hl, sp and the T-state
+counter. The entries are stored in preallocated arrays indexed by the
+instruction count modulo the (power of 2) buffer size, so recording creates
+no objects and the buffer holds the last n instructions.
+
+The tracing loop also stops at breakpoints and watchpoints. The iterations of
+a repeating block instruction run in bulk and idle loop iterations skipped by
+the idle loop detector are recorded as a single entry, the T-state counter of
+the next entry includes them.
+
+A trace file writer (z80tracefile) can be attached to the trace: every time
+the loop has recorded its chunk of entries they are handed over to the writer
+before the buffer wraps.
+"""
+# -----------------------------------------------------------------------------
+
+import array
+import z80da
+
+# -----------------------------------------------------------------------------
+
+# default number of entries
+_ENTRIES = 1 << 12
+
+# -----------------------------------------------------------------------------
+
+
+class _opcode:
+    """the recorded opcode bytes of an entry at its pc, for the disassembler"""
+
+    def __init__(self, pc, op):
+        self.pc = pc
+        self.op = op
+
+    def __getitem__(self, adr):
+        return (self.op >> (((adr - self.pc) & 3) << 3)) & 0xFF
+
+
+class trace:
+    """execution trace ring buffer"""
+
+    def __init__(self, n=_ENTRIES):
+        """n: number of entries (rounded up to a power of 2)"""
+        size = 1
+        while size < n:
+            size <<= 1
+        self.mask = size - 1
+        self.pc = array.array("H", [0]) * size
+        self.op = array.array("I", [0]) * size
+        self.af = array.array("H", [0]) * size
+        self.bc = array.array("H", [0]) * size
+        self.de = array.array("H", [0]) * size
+        self.hl = array.array("H", [0]) * size
+        self.sp = array.array("H", [0]) * size
+        self.tstates = array.array("Q", [0]) * size
+        # number of instructions recorded
+        self.count = 0
+        # trace file writer, and the count at which entries are handed over to it (-1: never)
+        self.writer = None
+        self.flush = -1
+
+    def clear(self):
+        """forget the recorded instructions"""
+        if self.writer is not None:
+            self.writer.drain(self)
+            self.writer.start = 0
+            self.flush = self.writer.chunk
+        self.count = 0
+
+    def resized(self, n):
+        """return a trace buffer of n entries holding the last entries of this one"""
+        t = trace(n)
+        k = min(self.count, self.mask + 1, t.mask + 1)
+        for name in ("pc", "op", "af", "bc", "de", "hl", "sp", "tstates"):
+            src = getattr(self, name)
+            dst = getattr(t, name)
+            for j in range(self.count - k, self.count):
+                dst[j & t.mask] = src[j & self.mask]
+        t.count = self.count
+        return t
+
+    def drain(self, count):
+        """hand the entries up to count over to the writer, return the count of the next hand over"""
+        self.count = count
+        self.flush = self.writer.drain(self)
+        return self.flush
+
+    def entries(self, k):
+        """return the last k entries: (tstates, pc, opcode bytes, af, bc, de, hl, sp), oldest first"""
+        k = min(k, self.count, self.mask + 1)
+        x = []
+        for j in range(self.count - k, self.count):
+            i = j & self.mask
+            x.append((self.tstates[i], self.pc[i], self.op[i], self.af[i], self.bc[i], self.de[i], self.hl[i], self.sp[i]))
+        return x
+
+    def report(self, k=16):
+        """return a report of the last k entries"""
+        return listing(self.entries(k))
+
+
+# -----------------------------------------------------------------------------
+
+
+def listing(entries):
+    """return a listing of trace entries with disassembly"""
+    s = ["%-10s %-4s %-12s %-18s %-4s %-4s %-4s %-4s %-4s" % ("tstates", "pc", "bytes", "instruction", "af", "bc", "de", "hl", "sp")]
+    for tstates, pc, op, af, bc, de, hl, sp in entries:
+        (operation, operands, n) = z80da.disassemble(_opcode(pc, op), pc)
+        ops = " ".join(["%02x" % ((op >> (8 * j)) & 0xFF) for j in range(n)])
+        s.append("%-10d %04x %-12s %-5s %-12s %04x %04x %04x %04x %04x" % (tstates, pc, ops, operation, operands, af, bc, de, hl, sp))
+    return "\n".join(s)
+
+
+def enable(cpu, n=_ENTRIES):
+    """attach a trace buffer of n entries to the cpu"""
+    if cpu.trace is None:
+        cpu.trace = trace(n)
+    return cpu.trace
+
+
+def disable(cpu):
+    """detach the trace buffer from the cpu (closing its trace file)"""
+    t = cpu.trace
+    cpu.trace = None
+    if t is not None and t.writer is not None:
+        t.writer.close()
+
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,268 @@
+# -----------------------------------------------------------------------------
+"""
+Z80 Compressed Trace Files
+
+A writer streams the full instruction trace to a file. It is attached to the
+cpu's trace buffer (z80trace): every time the tracing loop has recorded a
+chunk of entries, the writer copies them out of the buffer and queues them.
+A background thread compresses the chunks (zlib or lzma, both release the
+GIL while they work) and writes them, so the emulation never waits for the
+compression or the file I/O.
+
+The file is a header followed by chunks. Each chunk holds the fixed size
+records (24 bytes) of a run of consecutive instructions, stored column by
+column (pc, opcode bytes, af, bc, de, hl, sp, tstates, little endian), and an
+uncompressed index: the sorted list of the distinct pcs in the chunk.
+
+A reader maps the file and reads the chunk headers and pc indices only. The
+state at an instruction number decompresses one chunk, and the search for
+the instructions at a pc decompresses only the chunks whose index has the pc.
+"""
+# -----------------------------------------------------------------------------
+
+import sys
+import mmap
+import zlib
+import lzma
+import array
+import queue
+import bisect
+import struct
+import threading
+import z80trace
+
+# -----------------------------------------------------------------------------
+
+# instructions per chunk
+_CHUNK = 1 << 16
+
+# magic, version, compression method
+_header = struct.Struct("<8sHH")
+_MAGIC = b"Z80TRACE"
+_VERSION = 1
+
+# first instruction number, number of instructions, pc index size, compressed data size
+_chunk = struct.Struct("<QIII")
+
+# compression methods: (compress, decompress)
+_methods = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+_method_ids = ("zlib", "lzma")
+
+# trace buffer arrays in column order
+_columns = ("pc", "op", "af", "bc", "de", "hl", "sp", "tstates")
+
+# typecodes and sizes of the columns
+_types = ("H", "I", "H", "H", "H", "H", "H", "Q")
+_sizes = (2, 4, 2, 2, 2, 2, 2, 8)
+
+# -----------------------------------------------------------------------------
+
+
+def _array(typecode, data):
+    """return an array from little endian data"""
+    x = array.array(typecode)
+    x.frombytes(data)
+    if sys.byteorder == "big":
+        x.byteswap()
+    return x
+
+
+def _little(x):
+    """return the data of an array in little endian byte order"""
+    if sys.byteorder == "big":
+        x = array.array(x.typecode, x)
+        x.byteswap()
+    return x.tobytes()
+
+
+# -----------------------------------------------------------------------------
+
+
+class writer:
+    """stream the instruction trace of a cpu to a compressed trace file"""
+
+    def __init__(self, cpu, fname, chunk=_CHUNK, method="zlib", level=1):
+        """chunk: instructions per chunk, method: zlib or lzma, level: compression level"""
+        if method not in _methods:
+            raise ValueError("unknown compression method %s" % method)
+        t = cpu.trace
+        if t is not None and t.writer is not None:
+            t.writer.close()
+        # open the file before changing the trace buffer
+        f = open(fname, "wb")
+        if t is None:
+            t = z80trace.enable(cpu, max(chunk, z80trace._ENTRIES))
+        elif t.mask + 1 < chunk:
+            # the buffer must hold a chunk: keep the recorded entries in a larger buffer
+            t = t.resized(chunk)
+            cpu.trace = t
+        self.trace = t
+        self.chunk = chunk
+        self.compress = _methods[method][0]
+        self.level = level
+        # count of the first trace entry not yet written
+        self.start = t.count
+        # number of instructions written
+        self.n = 0
+        # exception raised by the background thread
+        self.error = None
+        self.f = f
+        self.f.write(_header.pack(_MAGIC, _VERSION, _method_ids.index(method)))
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        t.writer = self
+        t.flush = self.start + chunk
+
+    def drain(self, t):
+        """queue the trace entries that have not been written, return the count of the next hand over"""
+        a = self.start
+        b = t.count
+        if b > a:
+            size = t.mask + 1
+            i = a & t.mask
+            j = i + (b - a)
+            cols = []
+            for name in _columns:
+                x = getattr(t, name)
+                if j <= size:
+                    cols.append(x[i:j])
+                else:
+                    cols.append(x[i:] + x[: j - size])
+            self.queue.put((self.n, b - a, cols))
+            self.n += b - a
+            self.start = b
+        return b + self.chunk
+
+    def run(self):
+        """background thread: compress and write the queued chunks"""
+        while True:
+            x = self.queue.get()
+            if x is None:
+                break
+            if self.error is not None:
+                continue
+            (first, n, cols) = x
+            try:
+                index = _little(array.array("H", sorted(set(cols[0]))))
+                data = self.compress(b"".join([_little(c) for c in cols]), self.level)
+                self.f.write(_chunk.pack(first, n, len(index), len(data)))
+                self.f.write(index)
+                self.f.write(data)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """write the remaining entries, finish the file and detach the writer"""
+        t = self.trace
+        if t.writer is not self:
+            return
+        self.drain(t)
+        t.writer = None
+        t.flush = -1
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+
+# -----------------------------------------------------------------------------
+
+
+class reader:
+    """indexed reader for compressed trace files"""
+
+    def __init__(self, fname):
+        self.f = open(fname, "rb")
+        self.m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, method) = _header.unpack_from(self.m, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError("%s is not a trace file" % fname)
+        self.decompress = _methods[_method_ids[method]][1]
+        # first instruction number of each chunk
+        self.first = []
+        # chunks: (number of instructions, offset of the compressed data, compressed size, pc index)
+        self.chunks = []
+        ofs = _header.size
+        size = len(self.m)
+        while ofs + _chunk.size <= size:
+            (first, n, isize, dsize) = _chunk.unpack_from(self.m, ofs)
+            ofs += _chunk.size
+            if ofs + isize + dsize > size:
+                # incomplete chunk (the file is still being written)
+                break
+            index = _array("H", self.m[ofs : ofs + isize])
+            ofs += isize
+            self.first.append(first)
+            self.chunks.append((n, ofs, dsize, index))
+            ofs += dsize
+        # the most recently decompressed chunk: (chunk number, columns)
+        self.cached = (None, None)
+
+    def close(self):
+        """close the file"""
+        self.m.close()
+        self.f.close()
+
+    def __len__(self):
+        """return the number of instructions in the trace"""
+        if not self.chunks:
+            return 0
+        return self.first[-1] + self.chunks[-1][0]
+
+    def columns(self, c):
+        """return the columns of chunk c"""
+        if self.cached[0] != c:
+            (n, ofs, dsize, index) = self.chunks[c]
+            data = self.decompress(self.m[ofs : ofs + dsize])
+            cols = []
+            ofs = 0
+            for typecode, size in zip(_types, _sizes):
+                cols.append(_array(typecode, data[ofs : ofs + n * size]))
+                ofs += n * size
+            self.cached = (c, cols)
+        return self.cached[1]
+
+    def __getitem__(self, i):
+        """return the entry of instruction i: (tstates, pc, opcode bytes, af, bc, de, hl, sp)"""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("instruction %d is not in the trace" % i)
+        c = bisect.bisect_right(self.first, i) - 1
+        (pc, op, af, bc, de, hl, sp, tstates) = self.columns(c)
+        j = i - self.first[c]
+        return (tstates[j], pc[j], op[j], af[j], bc[j], de[j], hl[j], sp[j])
+
+    def entries(self, i, k):
+        """return the entries of k instructions from instruction i"""
+        return [self[j] for j in range(max(i, 0), min(i + k, len(self)))]
+
+    def hits(self, adr):
+        """yield the numbers of the instructions executed at adr"""
+        for c, (n, ofs, dsize, index) in enumerate(self.chunks):
+            j = bisect.bisect_left(index, adr)
+            if j == len(index) or index[j] != adr:
+                continue
+            pcs = self.columns(c)[0]
+            first = self.first[c]
+            j = pcs.index(adr)
+            while True:
+                yield first + j
+                try:
+                    j = pcs.index(adr, j + 1)
+                except ValueError:
+                    break
+
+    def report(self, i, k=16):
+        """return a listing of k instructions from instruction i"""
+        return z80trace.listing(self.entries(i, k))
+
+
+# -----------------------------------------------------------------------------